@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import logging
+
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+
+from change_feed import change_feed
+from db_wrapper import DbWrapper
+from exports import EXPORT_BATCH_SIZE, EXPORT_PROJECTIONS, ndjson_chunks_async
+from mongo_client import client_settings
+from read_routing import catalogue_read_preference
+
+logger = logging.getLogger(__name__)
+
+# seconds between the wake-ups measuring the event loop lag in the benchmark
+LAG_TICK = 0.005
+
+
+class AsyncDbWrapper(DbWrapper):
+    """
+    Motor based variant of DbWrapper. Its methods are DbWrapper's own, which
+    return their coroutine here instead of running it, so the FastAPI
+    handlers await them without blocking the event loop. Only what cannot be
+    shared is overridden: the client, the change feed task, the streamed
+    exports and the blocking uploads.
+    """
+
+    asynchronous = True
+
+    def create_client(self):
+        """
+        :return: the asynchronous MongoDB client used by this wrapper
+        """
+        return AsyncIOMotorClient(self.connection_string, **client_settings())
+
+    async def watch_document_changes(self) -> bool:
+        """
+        Motor counterpart of DbWrapper.watch_document_changes, consuming the
+        change stream in a task of the running event loop.
+        """
+        if not await self.supports_transactions():
+            logger.info("Standalone server, cached documents expire by TTL only.")
+            return False
+
+        self.change_feed_task = asyncio.create_task(
+            change_feed.watch_async(self.get_database("horses"))
+        )
+
+        return True
+
+    async def export_collection(
+        self, collection_name: str, batch_size: int = EXPORT_BATCH_SIZE
+    ):
+        """
+        :param collection_name: one of EXPORT_PROJECTIONS
+        :param batch_size: documents fetched per round trip and written per chunk
+        :return: a generator of NDJSON chunks, None if the collection is not exported
+        """
+        if collection_name not in EXPORT_PROJECTIONS:
+            return None
+
+        collection = self.get_collection(collection_name, catalogue_read_preference())
+        cursor = collection.find(
+            {}, EXPORT_PROJECTIONS[collection_name], batch_size=batch_size
+        ).sort("_id", ASCENDING)
+
+        return ndjson_chunks_async(cursor, batch_size)
+
+    async def horse_ipfs_upload(self, img_name: str):
+        # w3storage is a blocking HTTP client, keep it off the event loop
+        return await asyncio.to_thread(super().horse_ipfs_upload, img_name)
+
+    async def profile_image_upload(self, img_name: str):
+        # pyuploadcare is a blocking HTTP client, keep it off the event loop
+        return await asyncio.to_thread(super().profile_image_upload, img_name)
+
+    async def horse_image_upload(self, img_name: str):
+        return await asyncio.to_thread(super().horse_image_upload, img_name)
+
+
+async def loop_lag(stopped: asyncio.Event, lags: list):
+    """
+    Wakes up every LAG_TICK seconds and records how late it woke up, which is
+    how long the event loop was blocked.
+    """
+    while not stopped.is_set():
+        started_at = time.perf_counter()
+        await asyncio.sleep(LAG_TICK)
+        lags.append(time.perf_counter() - started_at - LAG_TICK)
+
+
+async def serve(call, requests: int, concurrency: int) -> dict:
+    """
+    :param call: returns the coroutine of one request
+    :param requests: the number of requests served
+    :param concurrency: the requests in flight at once
+    :return: the requests served per second and the worst event loop lag
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    stopped = asyncio.Event()
+    lags = []
+    ticker = asyncio.create_task(loop_lag(stopped, lags))
+
+    async def request():
+        async with semaphore:
+            await call()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(requests)))
+    elapsed = time.perf_counter() - started_at
+
+    stopped.set()
+    await ticker
+
+    return {
+        "requests_per_second": requests / elapsed,
+        "loop_lag_max_ms": max(lags, default=0) * 1000,
+    }
+
+
+async def concurrency_benchmark(requests: int, concurrency: int, limit: int) -> dict:
+    """
+    Serves the same users pages on the event loop three ways: the synchronous
+    DbWrapper called inline, as before the Motor wrapper, the DbWrapper on
+    the thread pool, and AsyncDbWrapper.
+
+    :param limit: the page size of each request
+    :return: the throughput and worst event loop lag of each
+    """
+    from threadpool_db_wrapper import ThreadPoolDbWrapper
+
+    wrapper = DbWrapper()
+    threadpool = ThreadPoolDbWrapper(wrapper)
+    motor = AsyncDbWrapper()
+
+    async def inline():
+        wrapper.get_users_page(limit)
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "inline": await serve(inline, requests, concurrency),
+        "threadpool": await serve(
+            lambda: threadpool.get_users_page(limit), requests, concurrency
+        ),
+        "motor": await serve(
+            lambda: motor.get_users_page(limit), requests, concurrency
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the Motor wrapper with the synchronous DbWrapper."
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print(
+        asyncio.run(concurrency_benchmark(args.requests, args.concurrency, args.limit))
+    )
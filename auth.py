@@ -0,0 +1,310 @@
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+from dotenv import find_dotenv, load_dotenv
+
+from request_context import current_principal
+from shared_store import shared_store
+
+logger = logging.getLogger(__name__)
+
+load_dotenv(find_dotenv())
+
+# the signing keys are read once; rotating one takes a restart
+JWT_SECRET = os.environ.get("SECRET")
+ADMIN_JWT_SECRET = os.environ.get("ADMIN_SECRET", "YEKLABS")
+JWT_ALGORITHM = "HS256"
+
+# verified tokens whose claims are kept, the least recently used dropped first
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+
+# the public addresses of the admins, comma separated; the admin routes
+# refuse the admin tokens of any other address
+ADMIN_ADDRESSES = os.environ.get("ADMIN_ADDRESSES", "")
+
+
+class TokenRevoked(jwt.InvalidTokenError):
+    pass
+
+
+def admin_addresses(addresses: str) -> frozenset:
+    """
+    :param addresses: comma separated public addresses
+    :return: the addresses in lower case, as they are compared
+    """
+    return frozenset(
+        address.strip().lower() for address in addresses.split(",") if address.strip()
+    )
+
+
+def token_key(token: str) -> str:
+    """
+    :return: the digest tokens are known by, so none is kept in the clear
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class Principal:
+    """
+    Who a request is authenticated as: the verified claims of its token.
+    """
+
+    def __init__(self, verifier: str, key: str, claims: dict):
+        """
+        :param verifier: the name of the TokenVerifier that verified it
+        :param key: the token_key of the token
+        """
+        self.verifier = verifier
+        self.key = key
+        self.claims = claims
+
+    @property
+    def public_address(self) -> str:
+        return self.claims.get("publicAddress")
+
+
+class TokenVerifier:
+    """
+    Issues and verifies the JWTs signed with one key. A token is decoded once:
+    its claims are then kept by token_key until the token expires. Revoked
+    tokens are refused until they expire; with a shared store, revocations
+    are shared by every instance and checked on every verification.
+    """
+
+    def __init__(self, name: str, secret: str, max_size: int = TOKEN_CACHE_SIZE):
+        self.name = name
+        self.secret = secret
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # token_key -> (expiry, claims)
+            self.claims = OrderedDict()
+            # token_key -> expiry of the revoked tokens
+            self.revoked = {}
+            self.hits = 0
+            self.misses = 0
+            self.failures = 0
+
+    def issue(self, claims: dict) -> str:
+        return jwt.encode(claims, self.secret, algorithm=JWT_ALGORITHM)
+
+    def cached(self, key: str):
+        with self.lock:
+            entry = self.claims.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.claims[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.claims.move_to_end(key)
+            return entry[1]
+
+    def decode(self, key: str, token: str) -> dict:
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[JWT_ALGORITHM])
+        except jwt.InvalidTokenError:
+            with self.lock:
+                self.failures += 1
+            raise
+
+        with self.lock:
+            self.claims[key] = (claims.get("exp", float("inf")), claims)
+            while len(self.claims) > self.max_size:
+                self.claims.popitem(last=False)
+
+        return claims
+
+    def revoked_key(self, key: str) -> str:
+        return f"revoked:{self.name}:{key}"
+
+    def check_revoked(self, key: str, shared: bytes = None):
+        """
+        :param shared: what the shared store holds for the token, if any
+        """
+        with self.lock:
+            expiry = self.revoked.get(key)
+            if expiry is None and shared is not None:
+                # seen revoked elsewhere, the next check needs no round trip
+                expiry = self.revoked[key] = float(shared)
+            if expiry is not None and expiry > time.time():
+                self.failures += 1
+                raise TokenRevoked("Token has been revoked")
+
+    def principal(self, key: str, token: str) -> Principal:
+        claims = self.cached(key) or self.decode(key, token)
+
+        return Principal(self.name, key, claims)
+
+    def verify(self, token: str) -> Principal:
+        """
+        :param token: a JWT
+        :return: who the token authenticates
+        :raise jwt.InvalidTokenError: if it is invalid, expired or revoked
+        """
+        key = token_key(token)
+        principal = self.principal(key, token)
+        self.check_revoked(
+            key, shared_store.get(self.revoked_key(key)) if shared_store else None
+        )
+
+        return principal
+
+    async def verify_async(self, token: str) -> Principal:
+        """
+        Asyncio counterpart of verify.
+        """
+        key = token_key(token)
+        principal = self.principal(key, token)
+        self.check_revoked(
+            key,
+            await shared_store.get_async(self.revoked_key(key))
+            if shared_store
+            else None,
+        )
+
+        return principal
+
+    def authenticated(self, token: str) -> Principal:
+        """
+        :return: the principal of the current request if token is the one it
+        was authenticated with, else the token verified
+        """
+        principal = current_principal.get()
+        if (
+            principal is not None
+            and principal.verifier == self.name
+            and principal.key == token_key(token)
+        ):
+            return principal
+
+        return self.verify(token)
+
+    def revocation(self, token: str):
+        """
+        :return: the token_key of the token and when its revocation ends
+        """
+        principal = self.principal(token_key(token), token)
+        now = time.time()
+        expiry = principal.claims.get("exp", now + 7 * 24 * 3600)
+        with self.lock:
+            self.revoked = {k: e for k, e in self.revoked.items() if e > now}
+            self.revoked[principal.key] = expiry
+            self.claims.pop(principal.key, None)
+
+        return principal.key, expiry
+
+    def revoke(self, token: str):
+        """
+        :param token: a valid token to refuse from now on, until it expires
+        """
+        key, expiry = self.revocation(token)
+        if shared_store is not None:
+            shared_store.set(
+                self.revoked_key(key),
+                str(expiry).encode(),
+                max(1, int((expiry - time.time()) * 1000)),
+            )
+
+    async def revoke_async(self, token: str):
+        key, expiry = self.revocation(token)
+        if shared_store is not None:
+            await shared_store.set_async(
+                self.revoked_key(key),
+                str(expiry).encode(),
+                max(1, int((expiry - time.time()) * 1000)),
+            )
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            now = time.time()
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.claims),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "failures": self.failures,
+                "revoked": sum(1 for e in self.revoked.values() if e > now),
+            }
+
+
+token_verifier = TokenVerifier("users", JWT_SECRET)
+admin_token_verifier = TokenVerifier("admins", ADMIN_JWT_SECRET)
+
+
+async def authenticate(request, token: str, verifier: TokenVerifier = None):
+    """
+    Verifies the token a request carries and attaches the principal to
+    request.state and to current_principal, where DbWrapper.verify finds it.
+
+    :param request: the starlette Request
+    :param verifier: token_verifier unless given
+    :return: the principal, None if the token is not valid
+    """
+    verifier = verifier or token_verifier
+    try:
+        principal = await verifier.verify_async(token)
+    except jwt.InvalidTokenError as e:
+        logger.info("Request not authenticated: %s", e)
+        return None
+
+    request.state.principal = principal
+    current_principal.set(principal)
+
+    return principal
+
+
+def bearer_token(authorization: str):
+    """
+    :param authorization: the Authorization header of a request
+    :return: the token of a "Bearer" header, else None
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+
+    return token.strip()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time verifying a token with and without the claims cache."
+    )
+    parser.add_argument("--verifications", type=int, default=100000)
+    args = parser.parse_args()
+
+    verifier = TokenVerifier("check", "check-secret")
+    token = verifier.issue({"publicAddress": "0x0", "exp": time.time() + 3600})
+
+    started_at = time.perf_counter()
+    for _ in range(args.verifications):
+        jwt.decode(token, verifier.secret, algorithms=[JWT_ALGORITHM])
+    decoded = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    for _ in range(args.verifications):
+        verifier.verify(token)
+    cached = time.perf_counter() - started_at
+
+    print(
+        {
+            "verifications": args.verifications,
+            "decode_us": decoded / args.verifications * 1e6,
+            "cached_us": cached / args.verifications * 1e6,
+            "verifier": verifier.as_dict(),
+        }
+    )
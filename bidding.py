@@ -0,0 +1,370 @@
+import argparse
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from metrics import bids_placed
+from sync_driver import ReadyDatabase, pause, run
+from versioning import backoff, bump, contention
+
+# attempts at placing a bid while other bids keep landing on the auction
+BID_RETRIES = 20
+
+
+class BidError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Bid:
+    """
+    A bid planned from one read of the horse: the conditional update of the
+    current auction, the myBids entry of the bidder and the writes undoing
+    the auction update when the myBids entry cannot be written.
+    """
+
+    def __init__(
+        self,
+        query: dict,
+        update: dict,
+        array_filters: list,
+        user_bid_info: dict,
+        undo: list,
+    ):
+        self.query = query
+        self.update = update
+        self.array_filters = array_filters
+        self.user_bid_info = user_bid_info
+        self.undo = undo
+
+
+def plan_bid(horse: dict, public_address: str, amount: int, date: str) -> Bid:
+    """
+    Bids add up: the bidder's total is the new amount plus their previous bid
+    on the same auction. The update only matches while the auction still is
+    in the state the plan was made from.
+
+    :param horse: the horse on auction
+    :param public_address: the bidder
+    :param amount: the amount added to the bidder's previous bid
+    :param date: the date of the bid
+    :return: the planned bid
+    """
+    if horse["publicAddress"] == public_address:
+        raise BidError(401, "User is the owner of horse")
+    # check if horse not already on auction
+    if horse["status"] != 4:
+        raise BidError(401, "Horse is not on auction")
+
+    x = len(horse["auctionInfo"]) - 1
+    auction = horse["auctionInfo"][x]
+    prefix = "auctionInfo." + str(x)
+
+    previous = next(
+        (
+            bid
+            for bid in auction.get("bidHistory", [])
+            if bid["bidderAddress"] == public_address
+        ),
+        None,
+    )
+    total = amount + (int(previous["bidAmount"]) if previous else 0)
+
+    query = {
+        "horseId": horse["horseId"],
+        "status": 4,
+        # no newer auction was started in the meantime
+        "auctionInfo." + str(x + 1): {"$exists": False},
+    }
+    update = {"$set": {}}
+    array_filters = None
+    undo = []
+
+    if total > int(auction["highestBid"]):
+        # compare-and-set: lost if another bid raised highestBid first
+        query[prefix + ".highestBid"] = auction["highestBid"]
+        update["$set"][prefix + ".highestBid"] = str(total)
+        update["$set"][prefix + ".highestBidder"] = public_address
+        # unless a higher bid landed since
+        undo.append(
+            UpdateOne(
+                {
+                    "horseId": horse["horseId"],
+                    prefix + ".highestBid": str(total),
+                    prefix + ".highestBidder": public_address,
+                },
+                bump(
+                    {
+                        "$set": {
+                            prefix + ".highestBid": auction["highestBid"],
+                            prefix + ".highestBidder": auction["highestBidder"],
+                        }
+                    }
+                ),
+            )
+        )
+
+    if previous:
+        query[prefix + ".bidHistory"] = {
+            "$elemMatch": {
+                "bidderAddress": public_address,
+                "bidAmount": previous["bidAmount"],
+            }
+        }
+        update["$set"][prefix + ".bidHistory.$[bidder].bidAmount"] = str(total)
+        array_filters = [{"bidder.bidderAddress": public_address}]
+        undo.append(
+            UpdateOne(
+                {"horseId": horse["horseId"]},
+                bump(
+                    {
+                        "$set": {
+                            prefix
+                            + ".bidHistory.$[bidder].bidAmount": previous["bidAmount"]
+                        }
+                    }
+                ),
+                array_filters=[
+                    {
+                        "bidder.bidderAddress": public_address,
+                        "bidder.bidAmount": str(total),
+                    }
+                ],
+            )
+        )
+    else:
+        query[prefix + ".bidHistory.bidderAddress"] = {"$ne": public_address}
+        update["$push"] = {
+            prefix
+            + ".bidHistory": {
+                "bidAmount": str(total),
+                "bidderAddress": public_address,
+                "date": date,
+            }
+        }
+        undo.append(
+            UpdateOne(
+                {"horseId": horse["horseId"]},
+                bump(
+                    {
+                        "$pull": {
+                            prefix
+                            + ".bidHistory": {
+                                "bidderAddress": public_address,
+                                "bidAmount": str(total),
+                            }
+                        }
+                    }
+                ),
+            )
+        )
+
+    if not update["$set"]:
+        del update["$set"]
+    update = bump(update)
+
+    user_bid_info = {
+        "auctionId": x,
+        "horseId": horse["horseId"],
+        "isClaimed": False,
+        "sellerAddress": horse["publicAddress"],
+        "status": "Pending",  # Pending, Accepted, Rejected
+        "bidInfo": {"bidAmount": str(total), "date": date},
+    }
+
+    return Bid(query, update, array_filters, user_bid_info, undo)
+
+
+def my_bid_updates(public_address: str, horse_id: int, user_bid_info: dict) -> list:
+    """
+    :return: the writes replacing the bidder's myBids entry for the horse, or
+    adding it; exactly one of them matches
+    """
+    return [
+        UpdateOne(
+            {"publicAddress": public_address, "myBids.horseId": horse_id},
+            bump({"$set": {"myBids.$": user_bid_info}}),
+        ),
+        UpdateOne(
+            {"publicAddress": public_address, "myBids.horseId": {"$ne": horse_id}},
+            bump({"$push": {"myBids": user_bid_info}}),
+        ),
+    ]
+
+
+async def apply_bid(
+    horses, users, bid: Bid, public_address: str, horse_id: int, session=None
+) -> bool:
+    """
+    Writes the bid on the auction, then the bidder's myBids entry. Outside a
+    transaction a failed myBids write is compensated by undoing the auction
+    update before the error is raised again.
+
+    :return: False if the auction changed since the bid was planned
+    """
+    if not await horses.find_one_and_update(
+        bid.query,
+        bid.update,
+        projection={"_id": 1},
+        array_filters=bid.array_filters,
+        session=session,
+    ):
+        return False
+
+    try:
+        await users.bulk_write(
+            my_bid_updates(public_address, horse_id, bid.user_bid_info),
+            ordered=False,
+            session=session,
+        )
+    except PyMongoError:
+        if session is None or not session.in_transaction:
+            await horses.bulk_write(bid.undo, ordered=False, session=session)
+        raise
+
+    return True
+
+
+async def place_bid(
+    horses,
+    users,
+    horse: dict,
+    public_address: str,
+    amount: int,
+    date: str = None,
+    session=None,
+    transactions: bool = False,
+) -> Bid:
+    """
+    :param horses: the horses collection, Motor's or a ready pymongo one
+    :param users: the users collection
+    :param horse: the horse as last read
+    :param public_address: the bidder
+    :param amount: the amount added to the bidder's previous bid
+    :param session: the session the bid is written in
+    :param transactions: True to write the auction and myBids in one
+    transaction of the session, False on a standalone server
+    :return: the applied bid
+    """
+    if amount <= 0:
+        raise BidError(400, "Bid amount must be positive")
+
+    date = date or datetime.now().strftime("%d/%m/%Y")
+    horse_id = horse["horseId"]
+
+    for retry in range(BID_RETRIES):
+        bid = plan_bid(horse, public_address, amount, date)
+
+        if transactions and session is not None:
+            applied = await session.with_transaction(
+                lambda session: apply_bid(
+                    horses, users, bid, public_address, horse_id, session
+                )
+            )
+        else:
+            applied = await apply_bid(
+                horses, users, bid, public_address, horse_id, session
+            )
+
+        if applied:
+            contention.record("place_a_bid", retry)
+            bids_placed.inc()
+            return bid
+
+        await pause(backoff(retry))
+
+        horse = await horses.find_one({"horseId": horse_id}, session=session)
+        if horse is None:
+            raise BidError(200, "Horse does not exist")
+
+    contention.record("place_a_bid", BID_RETRIES, exhausted=True)
+    raise BidError(409, "The auction is busy, please try again")
+
+
+def concurrency_check(db, bidders: int, bids: int) -> dict:
+    """
+    Lets `bidders` threads place `bids` random bids on the same auction, then
+    checks every bidder's total and the highest bid against what was sent.
+
+    :param db: a DbWrapper, its "bidding_check" database is overwritten
+    :return: bids per second and whether the auction is consistent
+    """
+    database = db.get_database("bidding_check")
+    database["horses"].drop()
+    database["users"].drop()
+
+    addresses = [f"0xbidder{i}" for i in range(bidders)]
+    database["users"].insert_many(
+        [{"publicAddress": address, "myBids": []} for address in addresses]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 0,
+            "publicAddress": "0xowner",
+            "status": 4,
+            "auctionInfo": [{"highestBid": "0", "highestBidder": "", "bidHistory": []}],
+        }
+    )
+
+    ready = ReadyDatabase(database)
+    sent = {address: 0 for address in addresses}
+    failures = [0]
+    lock = threading.Lock()
+
+    def bid(address, count):
+        for _ in range(count):
+            amount = random.randint(1, 100)
+            try:
+                horse = database["horses"].find_one({"horseId": 0})
+                run(place_bid(ready["horses"], ready["users"], horse, address, amount))
+                with lock:
+                    sent[address] += amount
+            except BidError:
+                with lock:
+                    failures[0] += 1
+
+    threads = [
+        threading.Thread(target=bid, args=(address, bids // bidders))
+        for address in addresses
+    ]
+    started_at = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started_at
+
+    auction = database["horses"].find_one({"horseId": 0})["auctionInfo"][-1]
+    totals = {b["bidderAddress"]: int(b["bidAmount"]) for b in auction["bidHistory"]}
+    placed = (bids // bidders) * bidders - failures[0]
+
+    return {
+        "bidders": bidders,
+        "bids": placed,
+        "failures": failures[0],
+        "bids_per_second": placed / elapsed,
+        "totals_match": totals == {a: s for a, s in sent.items() if s},
+        "highest_bid_matches": int(auction["highestBid"]) == max(sent.values()),
+    }
+
+
+if __name__ == "__main__":
+    from db_wrapper import DbWrapper
+
+    parser = argparse.ArgumentParser(
+        description="Place concurrent bids on one auction and check the result."
+    )
+    parser.add_argument("--bidders", type=int, default=50)
+    parser.add_argument("--bids", type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print(concurrency_check(DbWrapper(), args.bidders, args.bids))
@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import logging
+import threading
+import time
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from document_cache import caches, horse_cache
+from membership import (
+    build_filters,
+    filters,
+    filters_enabled,
+    filters_ready,
+    invalidate_filters,
+)
+from sync_driver import ReadyDatabase, run
+
+logger = logging.getLogger(__name__)
+
+# changes that modify a single cached document, known by its _id
+DOCUMENT_CHANGES = ("insert", "update", "replace", "delete")
+
+# changes carrying the whole document, whose key goes to the membership filter
+MEMBER_CHANGES = ("insert", "replace")
+
+# changes after which any cached document of the collection may be stale
+COLLECTION_CHANGES = ("drop", "rename")
+
+# changes after which any cached document may be stale; an invalidate event
+# also closes the stream for good
+DATABASE_CHANGES = ("dropDatabase", "invalidate")
+
+# errors meaning the resume token can no longer be resumed from
+# (InvalidResumeToken, ChangeStreamFatalError, ChangeStreamHistoryLost)
+HISTORY_LOST_CODES = (260, 280, 286)
+
+# pause before reopening a change stream that failed, in seconds
+CHANGE_STREAM_RETRY_SECONDS = 1.0
+
+# how long a getMore waits for changes, so the consumer notices it is stopped
+CHANGE_STREAM_AWAIT_MS = 1000
+
+
+class ChangeFeed:
+    """
+    Tails the change stream of the horses and users collections and drops the
+    changed documents from this process' caches, so a write made by another
+    worker or instance is seen without waiting for the TTL. The last resume
+    token is kept, a stream that fails is reopened where it left off; only
+    when that is no longer possible are the caches flushed.
+
+    The keys of inserted documents are added to the membership filters, which
+    are built once the stream is open, so no insert falls between the two.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.resume_token = None
+        self.changes = 0
+        self.reopened = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def pipeline(self) -> list:
+        return [
+            {
+                "$match": {
+                    "$or": [
+                        {
+                            "ns.coll": {"$in": list(caches)},
+                            "operationType": {
+                                "$in": list(DOCUMENT_CHANGES + COLLECTION_CHANGES)
+                            },
+                        },
+                        {"operationType": {"$in": list(DATABASE_CHANGES)}},
+                    ]
+                }
+            },
+            # the _id of the changed document is all the caches need, and
+            # the key of an inserted one all the filters need
+            {
+                "$project": {
+                    "operationType": 1,
+                    "ns": 1,
+                    "documentKey": 1,
+                    **{f"fullDocument.{f.key}": 1 for f in filters.values()},
+                }
+            },
+        ]
+
+    def add_member(self, change: dict):
+        if change["operationType"] in MEMBER_CHANGES and "fullDocument" in change:
+            member_filter = filters[change["ns"]["coll"]]
+            member_filter.add(change["fullDocument"].get(member_filter.key))
+
+    def apply(self, change: dict):
+        """
+        :param change: a change event of the stream
+        """
+        if change["operationType"] in DOCUMENT_CHANGES:
+            caches[change["ns"]["coll"]].forget_id(change["documentKey"]["_id"])
+            self.add_member(change)
+        elif change["operationType"] in COLLECTION_CHANGES:
+            caches[change["ns"]["coll"]].clear()
+        else:
+            self.flush()
+
+        self.applied(change)
+
+    async def apply_async(self, change: dict):
+        """
+        Motor counterpart of apply.
+        """
+        if change["operationType"] in DOCUMENT_CHANGES:
+            await caches[change["ns"]["coll"]].forget_id_async(
+                change["documentKey"]["_id"]
+            )
+            self.add_member(change)
+        elif change["operationType"] in COLLECTION_CHANGES:
+            await caches[change["ns"]["coll"]].clear_async()
+        else:
+            await self.flush_async()
+
+        self.applied(change)
+
+    def applied(self, change: dict):
+        with self.lock:
+            # a stream cannot be resumed after its invalidate event
+            if change["operationType"] == "invalidate":
+                self.resume_token = None
+            else:
+                self.resume_token = change["_id"]
+            self.changes += 1
+
+    def flush(self):
+        # the filters may lack inserts too, they are built again on reopening
+        invalidate_filters()
+        for cache in caches.values():
+            cache.clear()
+
+        with self.lock:
+            self.flushes += 1
+
+    async def flush_async(self):
+        invalidate_filters()
+        for cache in caches.values():
+            await cache.clear_async()
+
+        with self.lock:
+            self.flushes += 1
+
+    def failed(self, error: PyMongoError) -> bool:
+        """
+        :param error: what closed the stream
+        :return: True if changes were missed and the caches must be flushed
+        """
+        with self.lock:
+            self.errors += 1
+            self.reopened += 1
+
+        if isinstance(error, OperationFailure) and error.code in HISTORY_LOST_CODES:
+            logger.warning("Change stream history lost, flushing caches: %s", error)
+            with self.lock:
+                self.resume_token = None
+            return True
+
+        logger.error("Change stream failed, resuming: %s", error)
+        return False
+
+    def watch(self, database):
+        """
+        Consumes the change stream of database until stopped.
+
+        :param database: the pymongo database holding horses and users
+        """
+        while not self.stopped.is_set():
+            try:
+                with database.watch(
+                    self.pipeline(),
+                    resume_after=self.resume_token,
+                    max_await_time_ms=CHANGE_STREAM_AWAIT_MS,
+                ) as stream:
+                    if filters_enabled() and not filters_ready():
+                        run(build_filters(ReadyDatabase(database)))
+                    while stream.alive and not self.stopped.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self.apply(change)
+                        elif stream.resume_token is not None:
+                            # resume after the empty batch, not the last change
+                            with self.lock:
+                                self.resume_token = stream.resume_token
+
+            except PyMongoError as e:
+                if self.failed(e):
+                    self.flush()
+                self.stopped.wait(CHANGE_STREAM_RETRY_SECONDS)
+
+    async def watch_async(self, database):
+        """
+        Motor counterpart of watch.
+        """
+        while not self.stopped.is_set():
+            try:
+                async with database.watch(
+                    self.pipeline(),
+                    resume_after=self.resume_token,
+                    max_await_time_ms=CHANGE_STREAM_AWAIT_MS,
+                ) as stream:
+                    if filters_enabled() and not filters_ready():
+                        await build_filters(database)
+                    while stream.alive and not self.stopped.is_set():
+                        change = await stream.try_next()
+                        if change is not None:
+                            await self.apply_async(change)
+                        elif stream.resume_token is not None:
+                            with self.lock:
+                                self.resume_token = stream.resume_token
+
+            except PyMongoError as e:
+                if self.failed(e):
+                    await self.flush_async()
+                await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "running": not self.stopped.is_set(),
+                "changes": self.changes,
+                "reopened": self.reopened,
+                "flushes": self.flushes,
+                "errors": self.errors,
+                "resumable": self.resume_token is not None,
+            }
+
+
+change_feed = ChangeFeed()
+
+
+def propagation_check(db, writes: int) -> dict:
+    """
+    Caches a horse, updates it through a second client as another worker
+    would, and measures how long the change stream takes to evict it.
+
+    :param db: a DbWrapper on a replica set, its "change_feed_check"
+    database is overwritten
+    :return: the eviction delays
+    """
+    database = db.get_database("change_feed_check")
+    database["horses"].drop()
+    database["horses"].insert_one({"horseId": 0, "status": 1})
+
+    thread = threading.Thread(target=change_feed.watch, args=(database,), daemon=True)
+    thread.start()
+    # changes made before the stream is open would never be seen
+    while not change_feed.as_dict()["resumable"]:
+        time.sleep(0.01)
+
+    other = MongoClient(db.connection_string)["change_feed_check"]["horses"]
+    delays = []
+    for status in range(writes):
+        ticket = horse_cache.ticket()
+        horse_cache.put(0, database["horses"].find_one({"horseId": 0}), ticket)
+
+        written_at = time.monotonic()
+        other.update_one({"horseId": 0}, {"$set": {"status": status}})
+        while horse_cache.get(0, copied=False) is not None:
+            time.sleep(0.001)
+        delays.append(time.monotonic() - written_at)
+
+    change_feed.stopped.set()
+    thread.join()
+
+    return {
+        "writes": writes,
+        "delay_avg_ms": sum(delays) / len(delays) * 1000,
+        "delay_max_ms": max(delays) * 1000,
+        "feed": change_feed.as_dict(),
+    }
+
+
+if __name__ == "__main__":
+    from db_wrapper import DbWrapper
+
+    parser = argparse.ArgumentParser(
+        description="Check that writes of another client evict cached documents."
+    )
+    parser.add_argument("--writes", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print(propagation_check(DbWrapper(), args.writes))
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import gzip
+import importlib
+import importlib.util
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import compressed_responses, compression_bytes, compression_variants
+
+logger = logging.getLogger(__name__)
+
+# bodies smaller than this are sent as they are, compressing them saves less
+# than the Content-Encoding costs
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+
+# bodies from this size on are compressed on a thread, off the event loop
+COMPRESSION_THREAD_BYTES = int(os.environ.get("COMPRESSION_THREAD_BYTES", 65536))
+
+# compressed catalogue responses kept for the next client asking for them
+COMPRESSION_VARIANT_CACHE_BYTES = int(
+    os.environ.get("COMPRESSION_VARIANT_CACHE_BYTES", 64 * 1024 * 1024)
+)
+
+# content encodings in order of preference, when the client accepts several
+# equally, and the module each one needs
+RESPONSE_ENCODINGS = os.environ.get("RESPONSE_ENCODINGS", "zstd,br,gzip")
+ENCODING_MODULES = {"zstd": "zstandard", "br": "brotli", "gzip": "gzip"}
+
+# levels suited to compressing responses as they are served
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "text/")
+
+
+def available_encodings(requested: str) -> list:
+    """
+    :param requested: comma separated encodings, e.g. "zstd,br,gzip"
+    :return: the requested encodings whose library is installed
+    """
+    encodings = []
+    for name in filter(None, (n.strip() for n in requested.split(","))):
+        if name not in ENCODING_MODULES:
+            logger.warning("Unknown response encoding %s is ignored.", name)
+        elif importlib.util.find_spec(ENCODING_MODULES[name]) is None:
+            logger.warning("Response encoding %s is not installed.", name)
+        else:
+            encodings.append(name)
+
+    return encodings
+
+
+encodings = available_encodings(RESPONSE_ENCODINGS)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        # no timestamp, so the same body always compresses to the same bytes
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return importlib.import_module("brotli").compress(body, quality=BROTLI_QUALITY)
+    if encoding == "zstd":
+        # a compressor is not safe to share between threads
+        zstandard = importlib.import_module("zstandard")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def negotiate(accept_encoding: str):
+    """
+    :param accept_encoding: the Accept-Encoding header of the request
+    :return: the available encoding the client prefers, ties going to the
+    order of RESPONSE_ENCODINGS; None to send the body as it is
+    """
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        weight = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    ranked = [
+        (weights.get(name, weights.get("*", 0.0)), -rank, name)
+        for rank, name in enumerate(encodings)
+    ]
+    weight, _, name = max(ranked, default=(0.0, 0, None))
+
+    return name if weight > 0 else None
+
+
+class VariantCache:
+    """
+    Compressed bodies of the catalogue responses by request and ETag. An
+    ETag changes with every write of the collection, so an entry is never
+    stale; the least recently used are dropped past max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = COMPRESSION_VARIANT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.variants = OrderedDict()
+        self.size = 0
+
+    def get(self, key: tuple):
+        with self.lock:
+            body = self.variants.get(key)
+            if body is not None:
+                self.variants.move_to_end(key)
+
+        compression_variants.labels("hit" if body is not None else "miss").inc()
+        return body
+
+    def put(self, key: tuple, body: bytes):
+        with self.lock:
+            if key in self.variants or len(body) > self.max_bytes:
+                return
+
+            self.variants[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, dropped = self.variants.popitem(last=False)
+                self.size -= len(dropped)
+
+
+variant_cache = VariantCache()
+
+
+def variant_key(scope: dict, headers: MutableHeaders, encoding: str):
+    """
+    :return: what the compressed body is cached by, None if it is not: only
+    GET responses with an ETag, whose body that ETag, the URL and the format
+    identify
+    """
+    etag = headers.get("ETag")
+    if scope["method"] != "GET" or etag is None:
+        return None
+
+    return (
+        scope["path"],
+        scope.get("query_string", b""),
+        headers.get("Content-Type"),
+        etag,
+        encoding,
+    )
+
+
+def compressible(start: dict, headers: MutableHeaders, body: bytes) -> bool:
+    return (
+        200 <= start["status"] < 300
+        and start["status"] not in (204, 206)
+        and "Content-Encoding" not in headers
+        and headers.get("Content-Type", "").startswith(COMPRESSIBLE_TYPES)
+        and len(body) >= COMPRESSION_MIN_BYTES
+    )
+
+
+async def encoded_body(body: bytes, encoding: str) -> bytes:
+    if len(body) < COMPRESSION_THREAD_BYTES:
+        return compress(body, encoding)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, compress, body, encoding)
+
+
+class CompressionMiddleware:
+    """
+    Compresses response bodies with the Content-Encoding the client prefers
+    among zstd, br and gzip. Only whole bodies of at least
+    COMPRESSION_MIN_BYTES are compressed, large ones on a thread; streamed
+    responses such as the exports are sent as they are. The compressed
+    bodies of catalogue responses are kept by ETag and reused.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("Accept-Encoding"))
+        start = None
+
+        async def send_encoded(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+
+            start, held = None, start
+            body = message.get("body", b"")
+            if message.get("more_body", False):
+                await send(held)
+                await send(message)
+                return
+
+            held, body = await self.encode(scope, held, body, encoding)
+            await send(held)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_encoded)
+
+    async def encode(self, scope: dict, start: dict, body: bytes, encoding: str):
+        """
+        :return: the response start and body to send in their place
+        """
+        headers = MutableHeaders(raw=list(start["headers"]))
+        start = dict(start, headers=headers.raw)
+        if not compressible(start, headers, body):
+            return start, body
+
+        # shared caches must keep a copy per encoding
+        headers.add_vary_header("Accept-Encoding")
+        if encoding is None:
+            return start, body
+
+        key = variant_key(scope, headers, encoding)
+        encoded = variant_cache.get(key) if key is not None else None
+        if encoded is None:
+            started_at = time.perf_counter()
+            encoded = await encoded_body(body, encoding)
+            logger.debug(
+                "Compressed %s bytes to %s with %s in %.1f ms",
+                len(body),
+                len(encoded),
+                encoding,
+                (time.perf_counter() - started_at) * 1000,
+            )
+            if key is not None:
+                variant_cache.put(key, encoded)
+
+        if len(encoded) >= len(body):
+            return start, body
+
+        compressed_responses.labels(encoding).inc()
+        compression_bytes.labels(encoding, "identity").inc(len(body))
+        compression_bytes.labels(encoding, "encoded").inc(len(encoded))
+
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(encoded))
+        etag = headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            # the bytes differ from the identity response's, the document
+            # does not; If-None-Match compares ETags weakly (see etags.py)
+            headers["ETag"] = "W/" + etag
+
+        return start, encoded
+
+
+if __name__ == "__main__":
+    from fastapi.exceptions import HTTPException
+
+    from json_responses import respond, sample_horses
+
+    parser = argparse.ArgumentParser(
+        description="Compare the encodings on a /get_horses/ payload."
+    )
+    parser.add_argument("--horses", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    horses = sample_horses(args.horses)
+    body = respond(
+        HTTPException(status_code=200, detail={i: h for i, h in enumerate(horses)})
+    ).body
+
+    results = {"identity_bytes": len(body)}
+    for encoding in encodings:
+        started_at = time.perf_counter()
+        for _ in range(args.rounds):
+            encoded = compress(body, encoding)
+        elapsed = (time.perf_counter() - started_at) / args.rounds
+        results[encoding] = {
+            "bytes": len(encoded),
+            "ratio": len(body) / len(encoded),
+            "compress_ms": elapsed * 1000,
+            # at 1 Mbit/s, a slow mobile link
+            "transfer_ms_at_1mbps": len(encoded) * 8 / 1000,
+        }
+    results["identity_transfer_ms_at_1mbps"] = len(body) * 8 / 1000
+
+    print(results)
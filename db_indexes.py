@@ -0,0 +1,193 @@
+import argparse
+import logging
+import os
+
+from pymongo import ASCENDING, IndexModel
+
+from sync_driver import ReadyDatabase, run
+
+logger = logging.getLogger(__name__)
+
+# Indexes every DbWrapper lookup depends on, per collection of the "horses"
+# database. Names are fixed so an existing index is recognised on restart.
+INDEXES = {
+    "users": [
+        IndexModel([("publicAddress", ASCENDING)], name="publicAddress_1", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_1"),
+        # filtered listing pages, sorted by _id
+        IndexModel(
+            [("userType", ASCENDING), ("_id", ASCENDING)], name="userType_1__id_1"
+        ),
+    ],
+    "horses": [
+        IndexModel([("horseId", ASCENDING)], name="horseId_1", unique=True),
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_1__id_1"),
+    ],
+    "listings": [
+        IndexModel([("horseId", ASCENDING)], name="horseId_1", unique=True),
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_1__id_1"),
+    ]
+    + [
+        IndexModel(
+            [("status", ASCENDING), (field, ASCENDING), ("_id", ASCENDING)],
+            name=f"status_1_{field}_1__id_1",
+        )
+        for field in ("price", "highestBid", "deadline", "sharesOnMarket")
+    ],
+    "sellers": [
+        IndexModel([("public_address", ASCENDING)], name="public_address_1"),
+    ],
+    "ip": [
+        IndexModel([("ip", ASCENDING)], name="ip_1", unique=True),
+    ],
+    "emails": [
+        IndexModel([("email", ASCENDING)], name="email_1", unique=True),
+    ],
+}
+
+# Query shapes issued by DbWrapper, explained at startup to make sure none of
+# them falls back to a collection scan.
+QUERY_SHAPES = {
+    "users": [{"publicAddress": ""}, {"username": ""}, {"userType": ""}],
+    "horses": [{"horseId": 0}, {"status": 0}],
+    "listings": [{"horseId": 0}, {"status": 0}],
+    "sellers": [{"public_address": ""}],
+    "ip": [{"ip": ""}],
+    "emails": [{"email": ""}],
+}
+
+MODES = ("off", "warn", "strict")
+
+
+class IndexVerificationError(Exception):
+    pass
+
+
+def get_mode(mode: str = None) -> str:
+    """
+    :param mode: "off", "warn" or "strict", DB_INDEX_MODE (default warn) if None
+    :return: the validated mode
+    """
+    mode = mode or os.environ.get("DB_INDEX_MODE", "warn")
+
+    if mode not in MODES:
+        raise ValueError(f"DB_INDEX_MODE must be one of {MODES}, got {mode!r}")
+
+    return mode
+
+
+def missing_indexes(collection_name: str, existing: dict) -> list:
+    """
+    :param collection_name: the collection the indexes belong to
+    :param existing: the collection's index_information()
+    :return: the declared IndexModels that do not exist yet
+    """
+    return [
+        index
+        for index in INDEXES.get(collection_name, [])
+        if index.document["name"] not in existing
+    ]
+
+
+def is_collection_scan(plan: dict) -> bool:
+    """
+    :param plan: a winningPlan (or any stage) from an explain() output
+    :return: True if any stage of the plan scans the whole collection
+    """
+    if plan.get("stage") == "COLLSCAN":
+        return True
+
+    children = [plan.get("inputStage"), plan.get("queryPlan")]
+    children += plan.get("inputStages", [])
+
+    return any(is_collection_scan(child) for child in children if child)
+
+
+def winning_plan(explain: dict) -> dict:
+    return explain.get("queryPlanner", {}).get("winningPlan", {})
+
+
+def report(created: dict, scans: list, mode: str) -> dict:
+    for collection_name, names in created.items():
+        logger.info("Created indexes %s on %s.", names, collection_name)
+
+    for collection_name, shape in scans:
+        logger.warning("Query %s on %s is a collection scan.", shape, collection_name)
+
+    if scans and mode == "strict":
+        raise IndexVerificationError(f"Collection scans detected: {scans}")
+
+    return {"created": created, "collection_scans": scans}
+
+
+async def bootstrap_indexes(database, mode: str = None, create: bool = True) -> dict:
+    """
+    :param database: the database holding the collections, Motor's or a
+    ready pymongo one
+    :param mode: "off", "warn" or "strict" (raise on collection scans)
+    :param create: create the missing indexes before verifying
+    :return: the created indexes and the query shapes that scan
+    """
+    mode = get_mode(mode)
+    if mode == "off":
+        return {"created": {}, "collection_scans": []}
+
+    try:
+        created = {}
+        for collection_name in INDEXES:
+            collection = database[collection_name]
+            missing = missing_indexes(
+                collection_name, await collection.index_information()
+            )
+
+            if missing and create:
+                created[collection_name] = await collection.create_indexes(missing)
+
+        scans = []
+        for collection_name, shapes in QUERY_SHAPES.items():
+            for shape in shapes:
+                cursor = database[collection_name].find(shape).limit(1)
+                if is_collection_scan(winning_plan(await cursor.explain())):
+                    scans.append((collection_name, shape))
+
+        return report(created, scans, mode)
+
+    except IndexVerificationError:
+        raise
+
+    except Exception as e:
+        if mode == "strict":
+            raise
+        logger.error(e)
+        return {"created": {}, "collection_scans": [], "error": str(e)}
+
+
+if __name__ == "__main__":
+    from db_wrapper import DbWrapper
+
+    parser = argparse.ArgumentParser(
+        description="Create and verify the MongoDB indexes DbWrapper relies on."
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only verify the query plans, do not create missing indexes",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="exit with an error if a query would scan a whole collection",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    db = DbWrapper()
+    result = run(
+        bootstrap_indexes(
+            ReadyDatabase(db.get_database("horses")),
+            mode="strict" if args.strict else "warn",
+            create=not args.check,
+        )
+    )
+    print(result)
@@ -1,29 +1,125 @@
 import os
-import jwt
 import random
 import base64
+import inspect
 import logging
 import math
+import threading
 from dotenv import find_dotenv, load_dotenv
 from datetime import datetime, timedelta, timezone
 
 import time
+from contextlib import asynccontextmanager
 from functools import wraps
 
 import w3storage
 from pyuploadcare import File, Uploadcare
 
 from web3 import Web3
-from eth_account.messages import encode_defunct
 from fastapi.exceptions import HTTPException
-from pymongo import MongoClient
+from jwt import InvalidTokenError
+from pymongo import ASCENDING, DESCENDING, MongoClient
 
 from PIL import Image
 
+from auth import (
+    ADMIN_ADDRESSES,
+    admin_addresses,
+    admin_token_verifier,
+    authenticate,
+    token_verifier,
+)
+from bidding import BidError, place_bid
+from change_feed import change_feed
+from db_indexes import bootstrap_indexes
+from document_cache import caches, horse_cache, invalidates, user_cache
+from etags import (
+    COUNTERS_COLLECTION,
+    collection_etag,
+    counts_changes,
+    document_etag,
+    etag_matches,
+    not_modified,
+)
+from exports import EXPORT_BATCH_SIZE, EXPORT_PROJECTIONS, ndjson_chunks
+from log_config import SAMPLED
+from listings import (
+    InvalidSort,
+    build_listings,
+    reconcile_listings,
+    listing_sort,
+    relist_horse,
+    relists,
+)
+from membership import (
+    MEMBERSHIP_FILTERS,
+    adds_members,
+    build_filters,
+    filters as membership_filters,
+    horse_filter,
+    user_filter,
+)
+from metrics import auctions_ended, counts_rate_limit, times_upload
+from mongo_client import client_settings, pool_metrics
+from pagination import (
+    InvalidCursor,
+    page_detail,
+    page_filter,
+    page_limit,
+    sorted_page_filter,
+)
+from plans import (
+    cancelled_bid_status,
+    check_auction_ending,
+    check_bid_cancellable,
+    plan_add_my_horse,
+    plan_auction,
+    plan_claim_bid,
+    plan_listing,
+    plan_offer,
+    plan_pass_horse,
+    plan_pull_bid,
+    plan_remove_my_bid,
+    plan_remove_my_horse,
+    plan_sale,
+    plan_take_off_auction,
+    plan_take_off_sale,
+)
+from query_metrics import command_metrics
+from read_routing import catalogue_read_preference, causal_clock
+from repositories import (
+    HorseRepository,
+    Repositories,
+    SellerRepository,
+    UserRepository,
+)
+from settlement import SettlementError, settle, transactions_supported
+from shared_store import shared_store
+from sync_driver import ReadyClient, drives, synchronous
+from signatures import (
+    MAX_SIGNATURE_BATCH,
+    SignatureQueueFull,
+    signature_recovery,
+    signs,
+)
+from versioning import WriteRejected, bump, contention, update_versioned
+
+logger = logging.getLogger(__name__)
+
 load_dotenv(find_dotenv())
 
 
+@drives
 class DbWrapper:
+    """
+    The data layer. Every method that talks to MongoDB is written once, as a
+    coroutine: called on a DbWrapper it runs synchronously over pymongo (see
+    sync_driver.py), AsyncDbWrapper awaits the same code over Motor.
+    """
+
+    # True if the methods return coroutines for the event loop to await
+    asynchronous = False
+
     def __init__(self):
         self.setup()
 
@@ -33,7 +129,11 @@ class DbWrapper:
         """
         try:
             self.connection_string = os.environ.get("MONGODB_PWD")
-            self.client = MongoClient(self.connection_string)
+            # the client itself is created on first use, see client
+            self.mongo_client = None
+            self.client_pid = None
+            self.client_lock = threading.Lock()
+            self.transactions = None
             self.web3 = Web3()
 
             self.storage = w3storage.API(os.environ.get("W3STORAGE_PWD"))
@@ -45,27 +145,164 @@ class DbWrapper:
             self.ip_rate_limit_count = 1500
             self.ip_rate_limit_time_seconds = 60
 
-            logging.info("Connected to MongoDB. Setup has completed.")
+            self.admins = admin_addresses(ADMIN_ADDRESSES)
+            if not self.admins:
+                logger.warning("ADMIN_ADDRESSES is empty, admin routes refuse all.")
+
+            logger.info("Connected to MongoDB. Setup has completed.")
 
             return True
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
+            return e
+
+    @property
+    def client(self):
+        """
+        The MongoDB client of the current process. It is created lazily and
+        again after a fork, so every uvicorn/gunicorn worker gets its own
+        connection pool instead of sockets inherited from the parent.
+        """
+        if self.client_pid != os.getpid():
+            with self.client_lock:
+                if self.client_pid != os.getpid():
+                    self.mongo_client = self.create_client()
+                    self.client_pid = os.getpid()
+
+        # the pymongo client, behind Motor's interface for driven methods
+        if synchronous():
+            return ReadyClient(self.mongo_client)
+
+        return self.mongo_client
+
+    def create_client(self):
+        """
+        :return: the MongoDB client used by this wrapper, configured from the
+        MONGODB_* environment variables (see mongo_client.py)
+        """
+        return MongoClient(self.connection_string, **client_settings())
+
+    async def supports_transactions(self) -> bool:
+        """
+        :return: True if the server can run multi-document transactions
+        """
+        if self.transactions is None:
+            self.transactions = transactions_supported(
+                await self.client.admin.command("hello")
+            )
+
+        return self.transactions
+
+    def watch_document_changes(self) -> bool:
+        """
+        Starts evicting the horses and users written by other processes from
+        the document caches, following the change stream on a daemon thread.
+
+        :return: False on a standalone server, which has no change streams
+        """
+        if not self.supports_transactions():
+            logger.info("Standalone server, cached documents expire by TTL only.")
+            return False
+
+        threading.Thread(
+            target=change_feed.watch,
+            args=(self.get_database("horses"),),
+            name="change-feed",
+            daemon=True,
+        ).start()
+
+        return True
+
+    @asynccontextmanager
+    async def causal_session(self, public_address: str = None):
+        """
+        :param public_address: the user the session reads or writes for
+        :return: a causally consistent session that sees the user's own
+        writes, None if there is no user
+        """
+        if public_address is None:
+            yield None
+            return
+
+        async with await self.client.start_session(causal_consistency=True) as session:
+            await causal_clock.advance_async(session, public_address)
+            yield session
+            await causal_clock.record_async(session, public_address)
+
+    @asynccontextmanager
+    async def catalogue_session(self):
+        """
+        :return: a causally consistent session, so documents read after a
+        change counter are never older than it, whichever members serve them
+        """
+        async with await self.client.start_session(causal_consistency=True) as session:
+            yield session
+
+    async def count_change(self, counter: str):
+        """
+        :param counter: the counter of a collection that was written
+        """
+        try:
+            await self.get_collection(COUNTERS_COLLECTION).update_one(
+                {"_id": counter}, {"$inc": {"changes": 1}}, upsert=True
+            )
+
+        except Exception as e:
+            logger.error(e)
             return e
 
-    def get_database_names(self):
+    async def change_etag(self, counter: str, session=None) -> str:
+        """
+        :param counter: the counter of the collection about to be read
+        :param session: the session the collection is read in
+        :return: the ETag of any response read from the collection now
+        """
+        found = await self.get_collection(
+            COUNTERS_COLLECTION, catalogue_read_preference()
+        ).find_one({"_id": counter}, session=session)
+
+        return collection_etag(counter, found["changes"] if found else 0)
+
+    def get_stats(self) -> dict:
+        """
+        :return: runtime statistics of the data layer, keyed by component
+        """
+        return {
+            "contention": contention.as_dict(),
+            "pool": pool_metrics.as_dict(),
+            "commands": command_metrics.as_dict(),
+            "caches": {name: cache.as_dict() for name, cache in caches.items()},
+            "change_feed": change_feed.as_dict(),
+            "shared_store": shared_store.as_dict() if shared_store else None,
+            "tokens": {
+                "users": token_verifier.as_dict(),
+                "admins": admin_token_verifier.as_dict(),
+            },
+            "signatures": signature_recovery.as_dict(),
+            "membership": {name: f.as_dict() for name, f in membership_filters.items()},
+        }
+
+    async def ensure_indexes(self, mode: str = None) -> dict:
+        """
+        :param mode: "off", "warn" or "strict", defaults to DB_INDEX_MODE
+        :return: the indexes created and the queries that would scan a collection
+        """
+        return await bootstrap_indexes(self.get_database("horses"), mode)
+
+    async def get_database_names(self):
         """
         :return: a list of all the database names
         """
         try:
-            dbs = self.client.list_database_names()
+            dbs = await self.client.list_database_names()
 
-            logging.info("Database names method was called.")
+            logger.debug("Database names method was called.")
 
             return dbs
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
     def get_database(self, db_name: str):
@@ -76,72 +313,97 @@ class DbWrapper:
         try:
             db = self.client[db_name]
 
-            logging.info("Database method was called.")
+            logger.debug("Database method was called.", extra=SAMPLED)
 
             return db
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_collections_names(self, db_name: str):
+    async def get_collections_names(self, db_name: str):
         """
         :param db_name: the name of the database to get the collections from
         :return: a list of all the collections in the database
         """
         try:
             db = self.get_database(db_name)
-            collections = db.list_collection_names()
+            collections = await db.list_collection_names()
 
-            logging.info("Collections names method was called.")
+            logger.debug("Collections names method was called.")
 
             return collections
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_collection(self, collection_name: str):
+    def get_collection(self, collection_name: str, read_preference=None):
         """
         :param db_name: the name of the database to get the collection from
         :param collection_name: the name of the collection to get
+        :param read_preference: where reads go, the primary if None
         :return: the collection object
         """
         try:
             db = self.get_database("horses")
             collection = db[collection_name]
+            if read_preference is not None:
+                collection = collection.with_options(read_preference=read_preference)
 
-            logging.info("Collection method was called.")
+            logger.debug("Collection method was called.", extra=SAMPLED)
 
             return collection
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def user_exists(self, user_public_address: str):
+    def repositories(
+        self, read_preference=None, session=None, cached: bool = False
+    ) -> Repositories:
+        """
+        :param read_preference: where the repositories read from, the primary
+        if None
+        :param session: the session the repositories read in
+        :param cached: True to share users and horses through the document
+        caches, for reads that are not followed by a write
+        :return: fresh users, horses and sellers repositories for one call
+        """
+        return Repositories(
+            users=UserRepository(
+                self.get_collection("users", read_preference),
+                session,
+                user_cache if cached else None,
+            ),
+            horses=HorseRepository(
+                self.get_collection("horses", read_preference),
+                session,
+                horse_cache if cached else None,
+            ),
+            sellers=SellerRepository(
+                self.get_collection("sellers", read_preference), session
+            ),
+        )
+
+    async def user_exists(self, user_public_address: str):
         """
         :param user_public_address: the public address of the user to check
         :return: True if the user exists, False otherwise
         """
         try:
-            collection_name = "users"
-
-            collection = self.get_collection(collection_name)
-            user = collection.find_one({"publicAddress": user_public_address})
-
-            logging.info(user)
-
-            if user is not None:
-                return True
-            else:
+            if user_filter.excludes(user_public_address):
                 return False
 
+            return await self.repositories(cached=True).users.exists(
+                user_public_address
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def username_exists(self, username: str):
+    async def username_exists(self, username: str):
         """
         :param username: the username to check
         :return: True if the username exists, False otherwise
@@ -150,7 +412,7 @@ class DbWrapper:
             collection_name = "users"
 
             collection = self.get_collection(collection_name)
-            user = collection.find_one({"username": username})
+            user = await collection.find_one({"username": username})
 
             if user is not None:
                 return HTTPException(
@@ -162,19 +424,20 @@ class DbWrapper:
                 )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_users(self):
+    async def get_users(self):
         """
         :return: a list of all the users
         """
         try:
             collection_name = "users"
 
-            collection = self.get_collection(collection_name)
-            users = collection.find()
-            users_list = [i for i in users]
+            collection = self.get_collection(
+                collection_name, catalogue_read_preference()
+            )
+            users_list = await collection.find().to_list(length=None)
 
             return HTTPException(
                 status_code=200,
@@ -182,25 +445,34 @@ class DbWrapper:
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_horses(self):
+    async def get_horses(self, if_none_match: str = None):
         """
-        :return: a list of all the users
+        :param if_none_match: the If-None-Match header of the request
+        :return: a list of all the users, 304 if the client's copy is current
         """
         try:
             collection_name = "horses"
 
-            collection = self.get_collection(collection_name)
-            horses = collection.find()
-            horses_list = [i for i in horses]
-            print(horses_list)
+            collection = self.get_collection(
+                collection_name, catalogue_read_preference()
+            )
+            async with self.catalogue_session() as session:
+                etag = await self.change_etag(collection_name, session)
+                if etag_matches(if_none_match, etag):
+                    return not_modified(etag)
+
+                horses_list = await collection.find(session=session).to_list(
+                    length=None
+                )
 
             if horses_list:
                 return HTTPException(
                     status_code=200,
                     detail={i: horses_list[i] for i in range(len(horses_list))},
+                    headers={"ETag": etag},
                 )
             else:
                 return HTTPException(
@@ -208,23 +480,236 @@ class DbWrapper:
                 )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
+            return e
+
+    async def get_page(
+        self,
+        collection_name: str,
+        limit: int = None,
+        cursor: str = None,
+        filters: dict = None,
+        if_none_match: str = None,
+        counted: bool = False,
+    ):
+        """
+        :param collection_name: the collection to list
+        :param limit: the page size, at most MAX_PAGE_SIZE
+        :param cursor: the nextCursor of the previous page
+        :param filters: equality filters on the documents
+        :param if_none_match: the If-None-Match header of the request
+        :param counted: True if the collection has a change counter, which
+        the page is tagged with
+        :return: a page of documents sorted by _id and the cursor of the next
+        one, 304 if the client's copy is current
+        """
+        try:
+            limit = page_limit(limit)
+            query = page_filter(cursor, filters)
+
+            collection = self.get_collection(
+                collection_name, catalogue_read_preference()
+            )
+            if not counted:
+                documents = await (
+                    collection.find(query)
+                    .sort("_id", ASCENDING)
+                    .to_list(length=limit + 1)
+                )
+                return HTTPException(
+                    status_code=200, detail=page_detail(documents, limit)
+                )
+
+            async with self.catalogue_session() as session:
+                etag = await self.change_etag(collection_name, session)
+                if etag_matches(if_none_match, etag):
+                    return not_modified(etag)
+
+                documents = await (
+                    collection.find(query, session=session)
+                    .sort("_id", ASCENDING)
+                    .to_list(length=limit + 1)
+                )
+
+            return HTTPException(
+                status_code=200,
+                detail=page_detail(documents, limit),
+                headers={"ETag": etag},
+            )
+
+        except InvalidCursor as e:
+            return HTTPException(status_code=400, detail={"message": str(e)})
+
+        except Exception as e:
+            logger.error(e)
+            return e
+
+    async def get_users_page(
+        self, limit: int = None, cursor: str = None, user_type: str = None
+    ):
+        """
+        :param limit: the page size
+        :param cursor: the nextCursor of the previous page
+        :param user_type: only list users of this userType
+        :return: a page of users
+        """
+        return await self.get_page("users", limit, cursor, {"userType": user_type})
+
+    async def get_horses_page(
+        self,
+        limit: int = None,
+        cursor: str = None,
+        status: int = None,
+        if_none_match: str = None,
+    ):
+        """
+        :param limit: the page size
+        :param cursor: the nextCursor of the previous page
+        :param status: only list horses with this status
+        :param if_none_match: the If-None-Match header of the request
+        :return: a page of horses
+        """
+        return await self.get_page(
+            "horses", limit, cursor, {"status": status}, if_none_match, counted=True
+        )
+
+    async def get_listings(
+        self,
+        status: int = None,
+        sort: str = None,
+        limit: int = None,
+        cursor: str = None,
+        if_none_match: str = None,
+    ):
+        """
+        :param status: only list horses with this status, 3 sale or 4 auction
+        :param sort: a field of SORT_FIELDS, "-" prefixed for descending
+        :param limit: the page size
+        :param cursor: the nextCursor of the previous page
+        :param if_none_match: the If-None-Match header of the request
+        :return: a page of marketplace listings, tagged with the horses
+        counter they are derived from
+        """
+        try:
+            limit = page_limit(limit)
+            field, descending = listing_sort(sort)
+
+            if field is None:
+                query = page_filter(cursor, {"status": status})
+                order = [("_id", ASCENDING)]
+            else:
+                query = sorted_page_filter(
+                    cursor, {"status": status}, field, descending
+                )
+                direction = DESCENDING if descending else ASCENDING
+                order = [(field, direction), ("_id", direction)]
+
+            collection = self.get_collection("listings", catalogue_read_preference())
+            async with self.catalogue_session() as session:
+                etag = await self.change_etag("horses", session)
+                if etag_matches(if_none_match, etag):
+                    return not_modified(etag)
+
+                documents = await (
+                    collection.find(query, {"version": 0}, session=session)
+                    .sort(order)
+                    .to_list(length=limit + 1)
+                )
+
+            return HTTPException(
+                status_code=200,
+                detail=page_detail(documents, limit, field),
+                headers={"ETag": etag},
+            )
+
+        except (InvalidCursor, InvalidSort) as e:
+            return HTTPException(status_code=400, detail={"message": str(e)})
+
+        except Exception as e:
+            logger.error(e)
+            return e
+
+    async def refresh_listing(self, horse_id: int):
+        """
+        :param horse_id: a horse that was written; if its listing cannot be
+        written now, reconcile_listings writes it later
+        """
+        try:
+            await relist_horse(self.get_database("horses"), horse_id)
+
+        except Exception as e:
+            logger.error(e)
             return e
 
-    def get_user(self, user_info: dict):
+    async def rebuild_listings(self) -> int:
+        """
+        :return: the number of horses listed after rebuilding every listing
+        """
+        return await build_listings(self.get_database("horses"))
+
+    async def reconcile_listings(self) -> int:
+        """
+        :return: the number of horses relisted as their listing lagged them
+        """
+        return await reconcile_listings(self.get_database("horses"))
+
+    async def ensure_listings(self):
+        """
+        Builds the listings when there are none yet, e.g. on first deployment,
+        else relists the horses whose listing lags them.
+
+        :return: the number of horses listed, or relisted
+        """
+        if await self.get_collection("listings").estimated_document_count():
+            return await self.reconcile_listings()
+
+        return await self.rebuild_listings()
+
+    async def ensure_membership(self):
+        """
+        Builds the membership filters when MEMBERSHIP_FILTERS is "on". In
+        "auto" mode the change feed builds them once it follows the inserts of
+        the other workers, and without a feed they stay unused.
+
+        :return: the number of documents read per collection, None if nothing
+        was built
+        """
+        if MEMBERSHIP_FILTERS != "on":
+            return None
+
+        return await build_filters(self.get_database("horses"))
+
+    def export_collection(
+        self, collection_name: str, batch_size: int = EXPORT_BATCH_SIZE
+    ):
+        """
+        :param collection_name: one of EXPORT_PROJECTIONS
+        :param batch_size: documents fetched per round trip and written per chunk
+        :return: a generator of NDJSON chunks, None if the collection is not exported
+        """
+        if collection_name not in EXPORT_PROJECTIONS:
+            return None
+
+        collection = self.get_collection(collection_name, catalogue_read_preference())
+        cursor = collection.find(
+            {}, EXPORT_PROJECTIONS[collection_name], batch_size=batch_size
+        ).sort("_id", ASCENDING)
+
+        return ndjson_chunks(cursor, batch_size)
+
+    async def get_user(self, user_info: dict):
         """
         :param user_info: the user information to get
         :return: existing user info if exists, else does not exist
         """
         try:
-            if self.user_exists(user_info["publicAddress"]):
-                collection_name = "users"
-
-                collection = self.get_collection(collection_name)
-                user = collection.find_one(
-                    {"publicAddress": user_info["publicAddress"]}
+            async with self.causal_session(user_info["publicAddress"]) as session:
+                repositories = self.repositories(
+                    catalogue_read_preference(), session, cached=True
                 )
+                user = await repositories.users.get(user_info["publicAddress"])
 
+            if user is not None:
                 return HTTPException(
                     status_code=200, detail={"message": "User exists", "user": user}
                 )
@@ -234,16 +719,18 @@ class DbWrapper:
                 )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def set_user(self, user_info: dict):
+    @invalidates(users=("user_info.publicAddress",))
+    @adds_members(users=("user_info.publicAddress",))
+    async def set_user(self, user_info: dict):
         """
         :param user_info: the user information to add
         :return: the user information that was added
         """
         try:
-            if self.user_exists(user_info["publicAddress"]):
+            if await self.user_exists(user_info["publicAddress"]):
                 return HTTPException(
                     status_code=200, detail={"message": "User already exists"}
                 )
@@ -251,26 +738,26 @@ class DbWrapper:
             collection_name = "users"
 
             collection = self.get_collection(collection_name)
-            user = collection.insert_one(user_info).inserted_id
-
-            userInfo = collection.find_one({"_id": user})
+            # insert_one sets the generated _id on user_info
+            await collection.insert_one(user_info)
 
             return HTTPException(
-                status_code=200, detail={"message": "User added", "user": userInfo}
+                status_code=200, detail={"message": "User added", "user": user_info}
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def update_user(self, user_info: dict, token: str):
+    @invalidates(users=("user_info.publicAddress",))
+    async def update_user(self, user_info: dict, token: str):
         """
         :param user_info: the user information to update
         :param token: the token to check
         :return: the user information that was updated
         """
         try:
-            if not self.user_exists(user_info["publicAddress"]):
+            if not await self.user_exists(user_info["publicAddress"]):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
@@ -299,7 +786,7 @@ class DbWrapper:
             collection = self.get_collection(collection_name)
 
             # update the user
-            collection.update_one(
+            await collection.update_one(
                 {"publicAddress": user_info["publicAddress"]},
                 {"$set": user_info},
             )
@@ -307,16 +794,17 @@ class DbWrapper:
             return HTTPException(status_code=200, detail={"message": "User updated"})
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def update_user_type(self, user_info: dict):
+    @invalidates(users=("user_info.publicAddress",))
+    async def update_user_type(self, user_info: dict):
         """
         :param user_info: the user information to update
         :return: the user information that was updated
         """
         try:
-            if not self.user_exists(user_info["publicAddress"]):
+            if not await self.user_exists(user_info["publicAddress"]):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
@@ -324,7 +812,7 @@ class DbWrapper:
             collection_name = "users"
 
             collection = self.get_collection(collection_name)
-            user = collection.update_one(
+            user = await collection.update_one(
                 {"public_address": user_info["publicAddress"]},
                 {"$set": {"userType": user_info["userType"]}},
             )
@@ -334,21 +822,26 @@ class DbWrapper:
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def allow_horse(self, horse_info: dict):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_info.horseId",), users=("horse_info.publicAddress",))
+    @relists("horse_info.horseId")
+    async def allow_horse(self, horse_info: dict):
         """
         :param horse_info: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(horse_info["publicAddress"]):
+            repositories = self.repositories()
+
+            if not await repositories.users.exists(horse_info["publicAddress"]):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_info["horseId"]):
+            if not await repositories.horses.exists(horse_info["horseId"]):
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -356,15 +849,17 @@ class DbWrapper:
             user_collection_name = "users"
 
             userCollection = self.get_collection(user_collection_name)
-            userCollection.update_one(
+            await update_versioned(
+                userCollection,
                 {"publicAddress": horse_info["publicAddress"]},
-                {"$push": {"myHorses": horse_info["horseId"]}},
+                lambda user: plan_add_my_horse(user, horse_info["horseId"]),
+                "allow_horse",
             )
 
             horse_collection_name = "horses"
             horseCollection = self.get_collection(horse_collection_name)
-            horseCollection.update_one(
-                {"horseId": horse_info["horseId"]}, {"$set": {"status": 2}}
+            await horseCollection.update_one(
+                {"horseId": horse_info["horseId"]}, bump({"$set": {"status": 2}})
             )
 
             return HTTPException(
@@ -372,25 +867,36 @@ class DbWrapper:
                 detail={"message": "Horse added", "status": "success"},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def reject_horse(self, horseId: str):
+    @counts_changes("horses")
+    @invalidates(horses=("horseId",))
+    @relists("horseId")
+    async def reject_horse(self, horseId: str):
         """
         :param horse_info: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.horse_exists(horseId):
-                return HTTPException(
-                    status_code=200, detail={"message": "Horse does not exist"}
-                )
-
             collection_name = "horses"
 
             collection = self.get_collection(collection_name)
-            collection.update_one({"horseId": horseId}, {"$set": {"status": 1}})
+            result = await collection.update_one(
+                {"horseId": horseId}, bump({"$set": {"status": 1}})
+            )
+
+            if result.matched_count == 0:
+                return HTTPException(
+                    status_code=200, detail={"message": "Horse does not exist"}
+                )
 
             return HTTPException(
                 status_code=200,
@@ -398,19 +904,26 @@ class DbWrapper:
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def put_on_sale(
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    @relists("horse_id")
+    async def put_on_sale(
         self, horse_id: int, public_address: str, sale_info: dict, token: str
     ) -> HTTPException:
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            user = await repositories.users.get(public_address)
+            if user is None:
                 return HTTPException(
                     status_code=404,
                     detail={"message": "User does not exist", "response": False},
                 )
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=404,
                     detail={"message": "Horse does not exist", "response": False},
@@ -434,99 +947,72 @@ class DbWrapper:
 
             userCollection_name = "users"
             userCollection = self.get_collection(userCollection_name)
-            user = userCollection.find_one({"publicAddress": public_address})
-            userCollection.update_one(
+
+            # refused while the horse is on sale or on auction
+            await update_versioned(
+                userCollection,
                 {"publicAddress": public_address},
-                {"$set": {"nonce": user["nonce"] + 1}},
+                lambda user: plan_listing(user, horse_id, 3),
+                "put_on_sale",
+                document=user,
             )
-            print(user)
 
             horseCollection_name = "horses"
             horseCollection = self.get_collection(horseCollection_name)
-            # check if horse is owned by user
-            horse = horseCollection.find_one({"horseId": horse_id})
-            if user["publicAddress"] != public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "User does not own horse", "response": False},
-                )
 
-            # index = len(user["myHorses"]) - 1
-
-            for index, myHorses in enumerate(user["myHorses"], start=0):
-                if myHorses["horseId"] == horse_id:
-
-                    userCollection.update_one(
-                        {"publicAddress": public_address},
-                        {"$set": {"myHorses." + str(index) + ".status": 3}},
-                    )
-
-            sale_info["saleId"] = len(horse["saleInfo"])
-
-            horseCollection.update_one(
+            await update_versioned(
+                horseCollection,
                 {"horseId": horse_id},
-                {"$push": {"saleInfo": sale_info}},
+                lambda horse: plan_sale(horse, sale_info),
+                "put_on_sale",
+                document=horse,
             )
 
-            if user["myHorses"]["status"] == 3:
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "Horse already on sale",
-                        "response": False,
-                    },
-                )
-
-            if user["myHorses"]["status"] == 4:
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "Horse already on auction",
-                        "response": False,
-                    },
-                )
-
             return HTTPException(
                 status_code=200,
                 detail={"message": "Horse put on sale", "response": True},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
     # if this will be on production then we need to iplement update nonce function to contract
-    def remove_from_sale(self, horse_id: int, public_address: str) -> HTTPException:
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    @relists("horse_id")
+    async def remove_from_sale(
+        self, horse_id: int, public_address: str
+    ) -> HTTPException:
         try:
             collection_name = "horses"
             collection = self.get_collection(collection_name)
+            repositories = self.repositories()
 
-            if not self.user_exists(public_address):
+            if not await repositories.users.exists(public_address):
                 return HTTPException(
                     status_code=404,
                     detail={"message": "User does not exist", "response": False},
                 )
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=404,
                     detail={"message": "Horse does not exist", "response": False},
                 )
-            # check if horse is owned by user
-            horse = collection.find_one({"horseId": horse_id})
-            if horse["publicAddress"] != public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "User does not own horse", "response": False},
-                )
-            # check if horse is already on sale
-            if horse["status"] != 3:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "Horse not on sale", "response": False},
-                )
 
-            collection.update_one(
-                {"horseId": horse_id}, {"$set": {"saleInfo": {}, "status": 2}}
+            await update_versioned(
+                collection,
+                {"horseId": horse_id},
+                lambda horse: plan_take_off_sale(horse, public_address),
+                "remove_from_sale",
+                document=horse,
             )
 
             return HTTPException(
@@ -534,11 +1020,22 @@ class DbWrapper:
                 detail={"message": "Horse removed from sale", "response": True},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def buy_horse(
+    @counts_changes("horses")
+    @invalidates(
+        horses=("horse_id",), users=("buyer_public_address", "seller_public_address")
+    )
+    @relists("horse_id")
+    async def buy_horse(
         self,
         horse_id: int,
         buyer_public_address: str,
@@ -547,235 +1044,71 @@ class DbWrapper:
         ps: int,
         totalAmount: int,
         saleId: int,
+        repositories: Repositories = None,
+        auction_id: int = None,
     ) -> HTTPException:
+        """
+        :param saleId: the sale the shares are bought from, None for shares
+        won at auction
+        :param auction_id: the auction the shares are won at, which the
+        settlement ends along with accepting the winner's bid
+        :param repositories: the caller's repositories, which forget the
+        settled horse and users so the caller reads them again
+        """
         try:
-
-            if not self.horse_exists(horse_id):
-                return HTTPException(
-                    status_code=404,
-                    detail={"message": "Horse does not exist", "response": False},
-                )
-            if not self.user_exists(buyer_public_address):
-                return HTTPException(
-                    status_code=404,
-                    detail={"message": "User does not exist", "response": False},
-                )
-            ##print(horse_id)
-            # Check token id owner is public address
-            collection_name = "users"
-            userCollection = self.get_collection(collection_name)
-            user = userCollection.find_one({"publicAddress": buyer_public_address})
-
-            if user["publicAddress"] == buyer_public_address:
-                if not user["myHorses"]:
-                    userCollection.update_one(
-                        {"publicAddress": buyer_public_address},
-                        {"$push": {"myHorses": {"horseId": horse_id, "status": 2}}},
-                    )
-            print("GO ON")
-
-            filterHorse = list(
-                filter(lambda x: x["horseId"] == horse_id, user["myHorses"])
+            await settle(
+                self.client,
+                self.get_database("horses"),
+                horse_id,
+                buyer_public_address,
+                seller_public_address,
+                price,
+                ps,
+                saleId,
+                transactions=await self.supports_transactions(),
+                auction_id=auction_id,
             )
-            if len(filterHorse) >= 0:
-                for s in filterHorse:
-                    print("SSS", s)
-                    # filterAround = s["horseId"]
-            else:
-                userCollection.update_one(
-                    {"publicAddress": buyer_public_address},
-                    {"$push": {"myHorses": {"horseId": horse_id, "status": 2}}},
-                )
-
-            collection_name = "horses"
-            horseCollection = self.get_collection(collection_name)
-            horse = horseCollection.find_one({"horseId": horse_id})
-            # publicAddress, seller -> buyer OK + ownerName, seller -> buyer OK +Status, 3->2 OK
-            # saleInfo, will be empty OK + saleHistory, seller, buyer, date, price  OK
-
-            # for index, shareHolders in enumerate(horse["shareHolders"]):
-            #     if shareHolders["publicAddress"] == seller_public_address:
-            #         ##continue
-            #         print("HERE I AM")
-            #         if not shareHolders["publicAddress"] == buyer_public_address:
-            #             print("Ayni ayni YAMA")
-            #             horseCollection.update_one(
-            #                 {"horseId": horse_id},
-            #                 {
-            #                     "$set": {
-            #                         # "publicAddress": buyer_public_address,
-            #                         "ownerName": buyer_ownerName,
-            #                         # "status": 2,  # Change to set horse current status under myHorses
-            #                     },
-            #                     "$push": {
-            #                         "saleHistory": {
-            #                             "seller": seller_public_address,
-            #                             "buyer": buyer_public_address,
-            #                             "price": price,
-            #                             "amountBought": ps,
-            #                             # "shareLeft": totalAmount - ps,
-            #                             "date": datetime.now().strftime("%d/%m/%Y"),
-            #                         },
-            #                         "shareHolders": {
-            #                             "publicAddress": buyer_public_address,
-            #                             "percentage": ps,
-            #                             # "shareLeft": totalAmount - ps,
-            #                         },
-            #                     },
-            #                 },
-            #             )
-            #         else:
-            #             print("Nah you could NOT")
-            #             break
-
-            filterAddress = list(
-                filter(
-                    lambda x: x["publicAddress"] == buyer_public_address,
-                    horse["shareHolders"],
-                )
-            )
-            print("PublicAddress", len(filterAddress))
-            print("NERELEREGELDİK")
-            if len(filterAddress) < 1:
-                print("printtt")
-                horseCollection.update_one(
-                    {"horseId": horse_id},
-                    {
-                        "$push": {
-                            "saleHistory": {
-                                "seller": seller_public_address,
-                                "buyer": buyer_public_address,
-                                "price": price,
-                                "amountBought": ps,
-                                # "shareLeft": totalAmount - ps,
-                                "date": datetime.now().strftime("%d/%m/%Y"),
-                            },
-                            "shareHolders": {
-                                "publicAddress": buyer_public_address,
-                                "percentage": ps,
-                                # "shareLeft": totalAmount - ps,
-                            },
-                        },
-                    },
-                )
-
-            # For general horse collection
-            for index, shareHolders in enumerate(horse["shareHolders"]):
-                if shareHolders["publicAddress"] == buyer_public_address:
-                    horseCollection.update_one(
-                        {"horseId": horse_id},
-                        {
-                            "$set": {
-                                "shareHolders."
-                                + str(index)
-                                + ".percentage": shareHolders["percentage"]
-                                + ps
-                            }
-                        },
-                        {
-                            "$push": {
-                                "saleHistory": {
-                                    "seller": seller_public_address,
-                                    "buyer": buyer_public_address,
-                                    "price": price,
-                                    "amountBought": ps,
-                                    # "shareLeft": totalAmount - ps,
-                                    "date": datetime.now().strftime("%d/%m/%Y"),
-                                },
-                            }
-                        },
-                    )
-                    break
-
-            # For seller account
-            for index, shareholder in enumerate(horse["shareHolders"]):
-                if shareholder["publicAddress"] == seller_public_address:
-                    if shareholder["percentage"] - ps == 0:
-                        horseCollection.update_one(
-                            {"horseId": horse_id},
-                            {
-                                "$pull": {
-                                    "shareHolders": {
-                                        "publicAddress": seller_public_address
-                                    }
-                                }
-                            },
-                        ),
-                        userCollection.update_one(
-                            {"publicAddress": seller_public_address},
-                            {
-                                "$pull": {
-                                    "myHorses": {"horseId": horse_id, "status": 3}
-                                },
-                                "$push": {"soldHorses": {"horseId": horse_id}},
-                            },
-                        ),
-                    else:
-                        horseCollection.update_one(
-                            {"horseId": horse_id},
-                            {
-                                "$set": {
-                                    "shareHolders."
-                                    + str(index)
-                                    + ".percentage": shareholder["percentage"]
-                                    - ps
-                                },
-                            },
-                        )
-                        break
-
-            # Check if seller still has an percentage if not delete saleInfo and pull the horse
-            for index, sales in enumerate(horse["saleInfo"]):
-                if sales["saleId"] == saleId:
-                    if sales["onMarket"] - ps == 0:
-                        horseCollection.update_one(
-                            {"horseId": horse_id},
-                            {"$pull": {"saleInfo": {"saleId": saleId}}},
-                            {
-                                "$set": {
-                                    "saleInfo": {
-                                        "sellerAddress": seller_public_address,
-                                        "onMarket": totalAmount,
-                                        "price": price,
-                                    },
-                                }
-                            },
-                        ),
-                    else:
-                        horseCollection.update_one(
-                            {"horseId": horse_id},
-                            {
-                                "$set": {
-                                    "saleInfo."
-                                    + str(index)
-                                    + ".onMarket": sales["onMarket"]
-                                    - ps
-                                },
-                            },
-                        )
-                        break
+            if repositories is not None:
+                repositories.horses.forget(horse_id)
+                repositories.users.forget(buyer_public_address)
+                repositories.users.forget(seller_public_address)
 
             return HTTPException(
                 status_code=200,
                 detail={"message": "Horse bought", "response": True},
             )
 
+        except SettlementError as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def put_on_auction(self, horse_id: int, public_address: str, auction_info: dict):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    @relists("horse_id")
+    async def put_on_auction(
+        self, horse_id: int, public_address: str, auction_info: dict
+    ):
         """
         :param saleInfo: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            user = await repositories.users.get(public_address)
+            if user is None:
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -785,76 +1118,56 @@ class DbWrapper:
 
             user_collection_name = "users"
             userCollection = self.get_collection(user_collection_name)
-            user = userCollection.find_one({"publicAddress": public_address})
-
-            for index, myHorses in enumerate(user["myHorses"]):
-                if myHorses["horseId"] == horse_id:
-
-                    # Checck if user public address is valid
-                    if user["publicAddress"] != public_address:
-                        return HTTPException(
-                            status_code=401,
-                            detail={
-                                "message": "User does not own horse",
-                                "response": False,
-                            },
-                        )
-                    # Check if horse is already on sale
-                    if user["myHorses"]["status"] == 3:
-                        return HTTPException(
-                            status_code=401,
-                            detail={
-                                "message": "Horse already on sale",
-                                "response": False,
-                            },
-                        )
-
-                    # Check if horse is already on auction
-                    if user["myHorses"]["status"] == 4:
-                        return HTTPException(
-                            status_code=401,
-                            detail={
-                                "message": "Horse already on auction",
-                                "response": False,
-                            },
-                        )
 
-                    userCollection.update_one(
-                        {"publicAddress": public_address},
-                        {
-                            "$set": {"myHorses." + str(index) + ".status": 4},
-                        },
-                    )
-                    horseCollection.update_one(
-                        {"horseId": horse_id},
-                        {"$push": {"auctionInfo": dict(auction_info)}},
-                    )
-                    userCollection.update_one(
-                        {"publicAddress": public_address},
-                        {"$set": {"nonce": user["nonce"] + 1}},
-                    )
+            # refused while the horse is on sale or on auction
+            await update_versioned(
+                userCollection,
+                {"publicAddress": public_address},
+                lambda user: plan_listing(user, horse_id, 4),
+                "put_on_auction",
+                document=user,
+            )
+            await update_versioned(
+                horseCollection,
+                {"horseId": horse_id},
+                lambda horse: plan_auction(horse, auction_info),
+                "put_on_auction",
+                document=horse,
+            )
 
             return HTTPException(
                 status_code=200,
                 detail={"message": "Horse put on auction", "status": "success"},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def remove_from_auction(self, horse_id: int, public_address: str):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    @relists("horse_id")
+    async def remove_from_auction(self, horse_id: int, public_address: str):
         """
         :param saleInfo: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            if not await repositories.users.exists(public_address):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -862,30 +1175,12 @@ class DbWrapper:
             collection_name = "horses"
             collection = self.get_collection(collection_name)
 
-            horse = collection.find_one({"horseId": horse_id})
-
-            if horse["publicAddress"] != public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "User does not own horse", "response": False},
-                )
-            # check if horse not already on auction
-            if horse["status"] != 4:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "Horse not on auction", "response": False},
-                )
-
-            collection.update_one(
+            await update_versioned(
+                collection,
                 {"horseId": horse_id},
-                {
-                    "$set": {
-                        "status": 2,
-                        "auctionInfo."
-                        + str(len(horse["auctionInfo"]) - 1)
-                        + ".status": "Ended",
-                    }
-                },
+                lambda horse: plan_take_off_auction(horse, public_address),
+                "remove_from_auction",
+                document=horse,
             )
 
             return HTTPException(
@@ -893,142 +1188,48 @@ class DbWrapper:
                 detail={"message": "Horse removed from auction", "status": "success"},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def place_a_bid(self, horse_id: int, public_address: str, bid_info: int):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    @relists("horse_id")
+    async def place_a_bid(self, horse_id: int, public_address: str, bid_info: int):
         """
         :param saleInfo: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            if not await repositories.users.exists(public_address):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
 
-            collection_name = "horses"
-            collection = self.get_collection(collection_name)
-
-            horse = collection.find_one({"horseId": horse_id})
-
-            if horse["publicAddress"] == public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "User is the owner of horse", "response": False},
-                )
-            # check if horse not already on auction
-            if horse["status"] != 4:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "Horse is not on auction", "response": False},
-                )
-
-            bid_info["bidderAddress"] = public_address
-            bid_info["date"] = datetime.now().strftime("%d/%m/%Y")
-
-            x = len(horse["auctionInfo"]) - 1
-
-            for bid in horse["auctionInfo"][-1].get("bidHistory"):
-                if bid["bidderAddress"] == public_address:
-                    print("688")
-                    bid_info["bidAmount"] = int(bid_info["bidAmount"]) + int(
-                        bid["bidAmount"]
-                    )
-                    print("xy", bid_info["bidAmount"])
-                    if int(bid_info["bidAmount"]) > int(
-                        horse["auctionInfo"][x]["highestBid"]
-                    ):
-                        print("691")
-                        collection.update_one(
-                            {"horseId": horse_id},
-                            {
-                                "$set": {
-                                    "auctionInfo."
-                                    + str(x)
-                                    + ".highestBid": str(bid_info["bidAmount"]),
-                                    "auctionInfo."
-                                    + str(x)
-                                    + ".highestBidder": public_address,
-                                }
-                            },
-                        )
-                    print("696")
-                    collection.update_one(
-                        {"horseId": horse_id},
-                        {
-                            "$set": {
-                                "auctionInfo."
-                                + str(x)
-                                + ".bidHistory.$[bidder].bidAmount": str(
-                                    bid_info["bidAmount"]
-                                )
-                            }
-                        },
-                        array_filters=[{"bidder.bidderAddress": public_address}],
-                    )
-                    break
-            else:
-                print("703")
-                if int(bid_info["bidAmount"]) > int(
-                    horse["auctionInfo"][-1]["highestBid"]
-                ):
-                    print("705")
-                    collection.update_one(
-                        {"horseId": horse_id},
-                        {
-                            "$set": {
-                                "auctionInfo."
-                                + str(x)
-                                + ".highestBid": str(bid_info["bidAmount"]),
-                                "auctionInfo."
-                                + str(x)
-                                + ".highestBidder": public_address,
-                            }
-                        },
-                    )
-                print("710")
-                collection.update_one(
-                    {"horseId": horse_id},
-                    {"$push": {"auctionInfo." + str(x) + ".bidHistory": bid_info}},
-                )
-
-            collection_name = "users"
-            collection = self.get_collection(collection_name)
-
-            user = collection.find_one({"publicAddress": public_address})
-
-            user_bid_info = {
-                "auctionId": x,
-                "horseId": horse_id,
-                "isClaimed": False,
-                "sellerAddress": horse["publicAddress"],
-                "status": "Pending",  # Pending, Accepted, Rejected
-                "bidInfo": {
-                    "bidAmount": str(bid_info["bidAmount"]),
-                    "date": bid_info["date"],
-                },
-            }
-            print("726")
-            for index, info in enumerate(user["myBids"]):
-                if info["horseId"] == horse_id:
-                    print("729")
-                    collection.update_one(
-                        {"publicAddress": public_address},
-                        {"$set": {"myBids." + str(index): user_bid_info}},
-                    )
-                    break
-            else:
-                print("736")
-                collection.update_one(
-                    {"publicAddress": public_address},
-                    {"$push": {"myBids": user_bid_info}},
+            # the bidder's next reads, even from a secondary, include the bid
+            async with self.causal_session(public_address) as session:
+                await place_bid(
+                    self.get_collection("horses"),
+                    self.get_collection("users"),
+                    horse,
+                    public_address,
+                    int(bid_info["bidAmount"]),
+                    session=session,
+                    transactions=await self.supports_transactions(),
                 )
 
             return HTTPException(
@@ -1036,22 +1237,33 @@ class DbWrapper:
                 detail={"message": "Bid placed", "status": "success"},
             )
 
+        except BidError as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def make_offer(self, horse_id: int, public_address: str, place_info: dict):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    async def make_offer(self, horse_id: int, public_address: str, place_info: dict):
         """
         :param saleInfo: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            if not await repositories.users.exists(public_address):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -1059,28 +1271,15 @@ class DbWrapper:
             collection_name = "horses"
             collection = self.get_collection(collection_name)
 
-            horse = collection.find_one({"horseId": horse_id})
-
-            if horse["publicAddress"] == public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "User is the owner of horse", "response": False},
-                )
-            # check if horse not already on auction
-            if horse["status"] != 2:
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "The horse is not eligible for an offer",
-                        "response": False,
-                    },
-                )
-
             place_info["date"] = datetime.now().strftime("%d/%m/%Y")
 
-            collection.update_one(
+            # the owner and status are checked on the version written
+            await update_versioned(
+                collection,
                 {"horseId": horse_id},
-                {"$push": {"offerHistory": place_info}},
+                lambda horse: plan_offer(horse, public_address, place_info),
+                "make_offer",
+                document=horse,
             )
 
             return HTTPException(
@@ -1088,22 +1287,35 @@ class DbWrapper:
                 detail={"message": "Place placed", "status": "success"},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def cancel_a_bid(self, horse_id: int, public_address: str, token: str):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address",))
+    @relists("horse_id")
+    async def cancel_a_bid(self, horse_id: int, public_address: str, token: str):
         """
         :param saleInfo: the horse information to add
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            user = await repositories.users.get(public_address)
+            if user is None:
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -1128,97 +1340,42 @@ class DbWrapper:
             collection_name = "users"
             collection = self.get_collection(collection_name)
 
-            user = collection.find_one({"publicAddress": public_address})
-
             # check if user has bid on horse
             for bid in user["myBids"]:
                 if bid["horseId"] == horse_id:
                     auctionId = bid["auctionId"]
-                    if bid["isClaimed"] == True:
-                        return HTTPException(
-                            status_code=401,
-                            detail={
-                                "message": "Bid has already been claimed",
-                                "response": False,
-                            },
-                        )
+                    check_bid_cancellable(horse, bid, public_address)
+
                     collection_name = "horses"
                     collection = self.get_collection(collection_name)
 
-                    horse = collection.find_one({"horseId": horse_id})
-
                     deadline = horse["auctionInfo"][auctionId]["deadline"]
 
-                    if horse["publicAddress"] == public_address:
-                        return HTTPException(
-                            status_code=401,
-                            detail={
-                                "message": "User is the owner of horse",
-                                "response": False,
-                            },
-                        )
-                    if (
-                        horse["auctionInfo"][auctionId]["highestBidder"]
-                        == public_address
-                    ):
-                        return HTTPException(
-                            status_code=401,
-                            detail={
-                                "message": "User is the highest bidder, you cannot claim your bid!",
-                                "response": False,
-                            },
-                        )
-
                     # find bid of user in auctionInfo and remove it
-                    for index, bid in enumerate(
-                        horse["auctionInfo"][auctionId]["bidHistory"]
-                    ):
-                        if bid["bidderAddress"] == public_address:
-                            collection.update_one(
-                                {"horseId": horse_id},
-                                {
-                                    "$pull": {
-                                        "auctionInfo."
-                                        + str(auctionId)
-                                        + ".bidHistory": bid
-                                    }
-                                },
-                            )
-                            break
+                    await update_versioned(
+                        collection,
+                        {"horseId": horse_id},
+                        lambda horse: plan_pull_bid(horse, public_address, auctionId),
+                        "cancel_a_bid",
+                        document=horse,
+                    )
 
                     collection_name = "users"
                     collection = self.get_collection(collection_name)
 
+                    # if deadline is passed, set status to rejected
+                    status = cancelled_bid_status(
+                        deadline, math.floor(datetime.now().timestamp())
+                    )
+
                     # set specific bid to isClaimed
-                    for index, info in enumerate(user["myBids"]):
-                        if info["horseId"] == horse_id:
-                            # if deadline is passed, set status to rejected
-                            if math.floor(datetime.now().timestamp()) > deadline:
-                                collection.update_one(
-                                    {"publicAddress": public_address},
-                                    {
-                                        "$set": {
-                                            "myBids." + str(index) + ".isClaimed": True,
-                                            "myBids."
-                                            + str(index)
-                                            + ".status": "Rejected",
-                                        }
-                                    },
-                                )
-                                break
-                            else:
-                                collection.update_one(
-                                    {"publicAddress": public_address},
-                                    {
-                                        "$set": {
-                                            "myBids." + str(index) + ".isClaimed": True,
-                                            "myBids."
-                                            + str(index)
-                                            + ".status": "Cancelled",
-                                        }
-                                    },
-                                )
-                                break
+                    await update_versioned(
+                        collection,
+                        {"publicAddress": public_address},
+                        lambda user: plan_claim_bid(user, horse_id, status),
+                        "cancel_a_bid",
+                        document=user,
+                    )
 
                     return HTTPException(
                         status_code=200,
@@ -1230,11 +1387,23 @@ class DbWrapper:
                     detail={"message": "User has not bid on horse", "response": False},
                 )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def end_auction(
+    @counts_changes("horses")
+    @invalidates(
+        horses=("horse_id",),
+        users=("highest_bidder_public_address", "seller_public_address"),
+    )
+    @relists("horse_id")
+    async def end_auction(
         self,
         horse_id: int,
         highest_bidder_public_address: str,
@@ -1246,12 +1415,16 @@ class DbWrapper:
         :return: the horse information that was added
         """
         try:
-            if not self.user_exists(highest_bidder_public_address):
+            repositories = self.repositories()
+
+            user = await repositories.users.get(highest_bidder_public_address)
+            if user is None:
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -1264,140 +1437,71 @@ class DbWrapper:
                     detail={"message": "Invalid token", "response": False},
                 )
 
-            collection_name = "horses"
-            collection = self.get_collection(collection_name)
-
-            horse = collection.find_one({"horseId": horse_id})
-
-            if resp.detail["user"].get("publicAddress") != seller_public_address and (
-                resp.detail["user"].get("publicAddress")
-                != horse["auctionInfo"][-1]["highestBidder"]
-                and (horse["auctionInfo"][-1]["deadline"] + (4 * 60))
-                > math.floor(datetime.now().timestamp())
-            ):
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "User is not authorized to end auction",
-                        "response": False,
-                    },
-                )
-
-            if horse["publicAddress"] != seller_public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "That is not the owner of horse",
-                        "response": False,
-                    },
-                )
-
-            if horse["status"] != 4:
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "The horse is not on auction",
-                        "response": False,
-                    },
-                )
-
-            # check if auction is over
-            if horse["auctionInfo"][-1]["deadline"] > math.floor(
-                datetime.now().timestamp()
-            ):
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "The auction is not over yet",
-                        "response": False,
-                    },
-                )
-
-            # check if auction has a winner
-            if horse["auctionInfo"][-1]["highestBidder"] == "":
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "The auction has no winner", "response": False},
-                )
-
-            # check if auction is already ended
-            if horse["auctionInfo"][-1]["status"] == "Ended":
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "The auction has already ended",
-                        "response": False,
-                    },
-                )
+            check_auction_ending(
+                horse,
+                resp.detail["user"].get("publicAddress"),
+                seller_public_address,
+                math.floor(datetime.now().timestamp()),
+            )
 
-            self.buy_horse(
+            # the settlement ends the auction and accepts the winner's bid
+            auction_id = len(horse["auctionInfo"]) - 1
+            auction = horse["auctionInfo"][auction_id]
+            bought = await self.buy_horse(
                 horse_id,
                 highest_bidder_public_address,
                 seller_public_address,
-                horse["auctionInfo"][-1]["highestBid"],
-            )
-
-            # set auction to ended
-            collection.update_one(
-                {"horseId": horse_id},
-                {
-                    "$set": {
-                        "auctionInfo."
-                        + str(len(horse["auctionInfo"]) - 1)
-                        + ".status": "Ended"
-                    }
-                },
+                auction["highestBid"],
+                int(auction["ps"]),
+                horse["totalAmount"],
+                None,
+                repositories=repositories,
+                auction_id=auction_id,
             )
+            if not isinstance(bought, HTTPException) or bought.status_code != 200:
+                return bought
 
-            # set highest bidder's isClaimed and status to claimed
-            collection_name = "users"
-            collection = self.get_collection(collection_name)
-
-            user = collection.find_one({"publicAddress": highest_bidder_public_address})
-
-            for index, info in enumerate(user["myBids"]):
-                if (
-                    info["horseId"] == horse_id
-                    and info["auctionId"] == len(horse["auctionInfo"]) - 1
-                ):
-                    collection.update_one(
-                        {"publicAddress": highest_bidder_public_address},
-                        {
-                            "$set": {
-                                "myBids." + str(index) + ".isClaimed": True,
-                                "myBids." + str(index) + ".status": "Accepted",
-                            }
-                        },
-                    )
-                    break
+            auctions_ended.inc()
 
             return HTTPException(
                 status_code=200,
                 detail={"message": "Auction ended", "status": "success"},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def accept_a_bid(
+    @counts_changes("horses")
+    @invalidates(horses=("horse_id",), users=("public_address", "buyer_address"))
+    @relists("horse_id")
+    async def accept_a_bid(
         self, horse_id: int, public_address: str, buyer_address: str, bid_amount: int
     ):
         """
         :return: status
         """
         try:
-            if not self.user_exists(public_address):
+            repositories = self.repositories()
+
+            if not await repositories.users.exists(public_address):
                 return HTTPException(
                     status_code=200, detail={"message": "User does not exist"}
                 )
 
-            if not self.user_exists(buyer_address):
+            if not await repositories.users.exists(buyer_address):
                 return HTTPException(
                     status_code=200, detail={"message": "Seller does not exist"}
                 )
 
-            if not self.horse_exists(horse_id):
+            horse = await repositories.horses.get(horse_id)
+            if horse is None:
                 return HTTPException(
                     status_code=200, detail={"message": "Horse does not exist"}
                 )
@@ -1405,58 +1509,38 @@ class DbWrapper:
             collection_name = "horses"
             collection = self.get_collection(collection_name)
 
-            horse = collection.find_one({"horseId": horse_id})
-
-            if horse["publicAddress"] != public_address:
-                return HTTPException(
-                    status_code=401,
-                    detail={
-                        "message": "User is not the owner of horse",
-                        "response": False,
-                    },
-                )
-            # check if horse not already on auction
-            if horse["status"] != 4:
-                return HTTPException(
-                    status_code=401,
-                    detail={"message": "Horse not on auction", "response": False},
-                )
-
-            collection.update_one(
+            await update_versioned(
+                collection,
                 {"horseId": horse_id},
-                {
-                    "$set": {
-                        "status": 2,
-                        "publicAddress": buyer_address,
-                        "auctionInfo." + str(-1) + "status": "passive",
-                    },
-                    "$push": {
-                        "saleHistory": {
-                            "seller": public_address,
-                            "buyer": buyer_address,
-                            "price": bid_amount,
-                            "date": datetime.now().strftime("%d/%m/%Y"),
-                        }
-                    },
-                },
+                lambda horse: plan_pass_horse(
+                    horse, public_address, buyer_address, bid_amount
+                ),
+                "accept_a_bid",
+                document=horse,
             )
 
             collection_name = "users"
             collection = self.get_collection(collection_name)
 
-            collection.update_one(
+            await update_versioned(
+                collection,
                 {"publicAddress": public_address},
-                {"$pull": {"myHorses": horse_id}},
+                lambda user: plan_remove_my_horse(user, horse_id),
+                "accept_a_bid",
             )
 
-            collection.update_one(
+            await update_versioned(
+                collection,
                 {"publicAddress": buyer_address},
-                {"$push": {"myHorses": horse_id}},
+                lambda user: plan_add_my_horse(user, horse_id),
+                "accept_a_bid",
             )
 
-            collection.update_one(
+            await update_versioned(
+                collection,
                 {"publicAddress": buyer_address},
-                {"$pull": {"myBids": horse_id}},
+                lambda user: plan_remove_my_bid(user, horse_id),
+                "accept_a_bid",
             )
 
             return HTTPException(
@@ -1464,11 +1548,17 @@ class DbWrapper:
                 detail={"message": "Bid accepted", "status": "success"},
             )
 
+        except WriteRejected as e:
+            return HTTPException(
+                status_code=e.status_code,
+                detail={"message": e.message, "response": False},
+            )
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def seller_exists(self, seller_public_address: str):
+    async def seller_exists(self, seller_public_address: str):
         """
         :param seller_public_address: the public address of the seller to check
         :return: True if the seller exists, False otherwise
@@ -1477,7 +1567,9 @@ class DbWrapper:
             collection_name = "sellers"
 
             collection = self.get_collection(collection_name)
-            seller = collection.find_one({"public_address": seller_public_address})
+            seller = await collection.find_one(
+                {"public_address": seller_public_address}
+            )
 
             if seller is not None:
                 return HTTPException(
@@ -1490,19 +1582,20 @@ class DbWrapper:
                 )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_sellers(self):
+    async def get_sellers(self):
         """
         :return: a list of all the sellers
         """
         try:
             collection_name = "sellers"
 
-            collection = self.get_collection(collection_name)
-            sellers = collection.find()
-            sellers_list = [i for i in sellers]
+            collection = self.get_collection(
+                collection_name, catalogue_read_preference()
+            )
+            sellers_list = await collection.find().to_list(length=None)
 
             return HTTPException(
                 status_code=200,
@@ -1510,21 +1603,29 @@ class DbWrapper:
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def set_seller(self, seller_info: dict):
+    async def get_sellers_page(self, limit: int = None, cursor: str = None):
+        """
+        :param limit: the page size
+        :param cursor: the nextCursor of the previous page
+        :return: a page of sellers
+        """
+        return await self.get_page("sellers", limit, cursor)
+
+    async def set_seller(self, seller_info: dict):
         """
         :param seller_info: the seller information to add
         :return: the seller information that was added
         """
         try:
-            if self.seller_exists(seller_info["publicAddress"]):
+            if await self.seller_exists(seller_info["publicAddress"]):
                 return HTTPException(
                     status_code=200, detail={"message": "Seller already exists"}
                 )
 
-            if self.username_exists(seller_info["username"]):
+            if await self.username_exists(seller_info["username"]):
                 return HTTPException(
                     status_code=200, detail={"message": "Username already exists"}
                 )
@@ -1532,29 +1633,29 @@ class DbWrapper:
             collection_name = "sellers"
 
             collection = self.get_collection(collection_name)
-            seller = collection.insert_one(seller_info).inserted_id
+            seller = (await collection.insert_one(seller_info)).inserted_id
 
             return HTTPException(
                 status_code=200, detail={"message": "Seller added", "seller": seller}
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def update_seller(self, seller_info: dict):
+    async def update_seller(self, seller_info: dict):
         """
         :param seller_info: the seller information to update
         :return: the seller information that was updated
         """
         try:
-            if not self.seller_exists(seller_info["publicAddress"]):
+            if not await self.seller_exists(seller_info["publicAddress"]):
                 return "Seller does not exist!"
 
             collection_name = "sellers"
 
             collection = self.get_collection(collection_name)
-            collection.update_one(
+            await collection.update_one(
                 {"public_address": seller_info["publicAddress"]}, {"$set": seller_info}
             )
 
@@ -1563,10 +1664,14 @@ class DbWrapper:
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def create_horse(self, horse_info: dict):
+    @counts_changes("horses")
+    @invalidates(horses=("horse_info.horseId",), users=("horse_info.publicAddress",))
+    @relists("horse_info.horseId")
+    @adds_members(horses=("horse_info.horseId",))
+    async def create_horse(self, horse_info: dict):
         """
         :param horse_info: the horse information to add
         :param token: the token of the user
@@ -1574,99 +1679,120 @@ class DbWrapper:
         :return: the horse information that was added
         """
         try:
-            if self.horse_exists(horse_info["horseId"]):
+            if await self.repositories().horses.exists(horse_info["horseId"]):
                 return HTTPException(
                     status_code=200, detail={"message": "Horse already exists"}
                 )
 
+            # the creator holds every share, insert it together with the horse
+            horse_info["shareHolders"] = horse_info.get("shareHolders", []) + [
+                {
+                    "publicAddress": horse_info["publicAddress"],
+                    "percentage": horse_info["totalAmount"],
+                    "shareLeft": horse_info["totalAmount"],
+                }
+            ]
+
             horse_collection_name = "horses"
             horseCollection = self.get_collection(horse_collection_name)
-            horse_id = horseCollection.insert_one(horse_info).inserted_id
-            horse = horseCollection.find_one({"_id": horse_id})
-            # add shareholder to horse
-            horseCollection.update_one(
-                {"horseId": horse_info["horseId"]},
-                {
-                    "$push": {
-                        "shareHolders": {
-                            "publicAddress": horse_info["publicAddress"],
-                            "percentage": horse_info["totalAmount"],
-                            "shareLeft": horse_info["totalAmount"],
-                        }
-                    }
-                },
-            )
+            # insert_one sets the generated _id on horse_info
+            await horseCollection.insert_one(horse_info)
 
             user_collection_name = "users"
             userCollection = self.get_collection(user_collection_name)
-            userCollection.update_one(
+            await userCollection.update_one(
                 {"publicAddress": horse_info["publicAddress"]},
-                {"$push": {"myHorses": {"horseId": horse["horseId"], "status": 2}}},
+                bump(
+                    {
+                        "$push": {
+                            "myHorses": {"horseId": horse_info["horseId"], "status": 2}
+                        }
+                    }
+                ),
             )
 
             return HTTPException(
-                status_code=200, detail={"message": "Horse added", "horse": horse}
+                status_code=200,
+                detail={
+                    "message": "Horse added",
+                    "status": "success",
+                    "horse": horse_info,
+                },
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def horse_exists(self, horse_id: int):
+    async def horse_exists(self, horse_id: int):
         try:
-            collection_name = "horses"
-
-            collection = self.get_collection(collection_name)
-            horse = collection.find_one({"horseId": horse_id})
-
-            if horse is not None:
-                return True
-            else:
+            if horse_filter.excludes(horse_id):
                 return False
 
+            return await self.repositories(cached=True).horses.exists(horse_id)
+
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def update_account_settings(self, account_settings: dict):
+    @invalidates(users=("account_settings.publicAddress",))
+    async def update_account_settings(self, account_settings: dict):
         try:
             collection_name = "users"
             collection = self.get_collection(collection_name)
             publicAddress = account_settings["publicAddress"]
 
-            if not self.user_exists(publicAddress):
+            #  set notification list of user from database
+            result = await collection.update_one(
+                {"publicAddress": publicAddress},
+                {"$set": {"notifications": account_settings["notifications"]}},
+            )
+            if result.matched_count == 0:
                 return HTTPException(
                     status_code=404,
                     detail={"message": "User does not exist", "response": False},
                 )
-            #  set notification list of user from database
-            collection.update_one(
-                {"publicAddress": publicAddress},
-                {"$set": {"notifications": account_settings["notifications"]}},
-            )
             return HTTPException(
                 status_code=200,
                 detail={"message": "Account settings updated", "response": True},
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_horse(self, horse_id: int):
+    async def get_horse(
+        self, horse_id: int, public_address: str = None, if_none_match: str = None
+    ):
         """
         :param horse_id: the horse information to get
-        :return: existing user info if exists, else does not exist
+        :param public_address: the user viewing the horse, who sees their own bids
+        :param if_none_match: the If-None-Match header of the request
+        :return: existing user info if exists, else does not exist; 304 if the
+        client's copy is current, checked by reading only the horse's version
         """
         try:
-            if self.horse_exists(horse_id):
-                collection_name = "horses"
+            async with self.causal_session(public_address) as session:
+                repositories = self.repositories(
+                    catalogue_read_preference(), session, cached=True
+                )
+                if if_none_match is not None:
+                    version = await repositories.horses.version(horse_id)
+                    etag = document_etag("horse", horse_id, version)
+                    if version is not None and etag_matches(if_none_match, etag):
+                        return not_modified(etag)
 
-                collection = self.get_collection(collection_name)
-                horse = collection.find_one({"horseId": horse_id})
+                horse = await repositories.horses.get(horse_id)
 
+            if horse is not None:
                 return HTTPException(
-                    status_code=200, detail={"message": "Horse exists", "horse": horse}
+                    status_code=200,
+                    detail={"message": "Horse exists", "horse": horse},
+                    headers={
+                        "ETag": document_etag(
+                            "horse", horse_id, horse.get("version", 0)
+                        )
+                    },
                 )
             else:
                 return HTTPException(
@@ -1674,71 +1800,62 @@ class DbWrapper:
                 )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def get_horse_by_sale_id(self, horse_id: int, sale_id: int):
+    async def get_horse_by_sale_id(self, horse_id: int, sale_id: int):
         """
         :param horse_id: the horse information to get
         :return: existing user info if exists, else does not exist
         """
         try:
-            if self.horse_exists(horse_id):
-                collection_name = "horses"
-
-                collection = self.get_collection(collection_name)
-                horse = collection.find_one({"horseId": horse_id})
-
-                if horse is not None:
-                    for sale in horse["saleInfo"]:
-                        if sale["saleId"] == sale_id:
-                            return HTTPException(
-                                status_code=200,
-                                detail={
-                                    "message": "Horse exists",
-                                    "horse": horse,
-                                    "sale": sale,
-                                },
-                            )
-                        break
-                    return HTTPException(
-                        status_code=404,
-                        detail={"message": "Such sale does not exist"},
-                    )
-                else:
-                    return HTTPException(
-                        status_code=404, detail={"message": "Such horse does not exist"}
-                    )
+            horse = await self.repositories(
+                catalogue_read_preference(), cached=True
+            ).horses.get(horse_id)
+
+            if horse is not None:
+                for sale in horse["saleInfo"]:
+                    if sale["saleId"] == sale_id:
+                        return HTTPException(
+                            status_code=200,
+                            detail={
+                                "message": "Horse exists",
+                                "horse": horse,
+                                "sale": sale,
+                            },
+                        )
+                    break
+                return HTTPException(
+                    status_code=404,
+                    detail={"message": "Such sale does not exist"},
+                )
             else:
                 return HTTPException(
                     status_code=404, detail={"message": "Such horse does not exist"}
                 )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
-    def users_signature(self, user_public_address: str, signature: str):
+    async def users_signature(self, user_public_address: str, signature: str):
         try:
-            userInfo = self.user_check(user_public_address)
+            userInfo = await self.user_check(user_public_address, cached=False)
             if userInfo.status_code == 200:
                 user = userInfo.detail["user"]
                 msg = f'Horse Around Authentication for {user["publicAddress"]} with nonce : {user["nonce"]}'
-                message_hex = encode_defunct(text=msg)
-                expectedAddress = self.web3.eth.account.recover_message(
-                    message_hex, signature=signature
-                )
-                print(expectedAddress.lower())
-                if expectedAddress.lower() == user_public_address:
-                    self.update_user_nonce(user_public_address, user["nonce"] + 1)
-                    token = jwt.encode(
+                expectedAddress = await signature_recovery.recover_async(msg, signature)
+                if (
+                    expectedAddress is not None
+                    and expectedAddress.lower() == user_public_address
+                ):
+                    await self.update_user_nonce(user_public_address, user["nonce"] + 1)
+                    token = token_verifier.issue(
                         {
                             "publicAddress": user_public_address,
                             "nonce": user["nonce"],
                             "exp": datetime.now(tz=timezone.utc) + timedelta(days=7),
-                        },
-                        os.environ.get("SECRET"),
-                        algorithm="HS256",
+                        }
                     )
                     return HTTPException(
                         status_code=200,
@@ -1756,56 +1873,158 @@ class DbWrapper:
                     status_code=404, detail={"message": "User not found"}
                 )
 
+        except SignatureQueueFull as e:
+            return self.signatures_busy(e)
+
+        except Exception as e:
+            logger.error(e)
+            return e
+
+    def signatures_busy(self, error: SignatureQueueFull):
+        logger.warning(error)
+        return HTTPException(
+            status_code=503,
+            detail={"message": "Too many logins, try again shortly"},
+            headers={"Retry-After": "1"},
+        )
+
+    def signature_batch(self, items: list):
+        """
+        :return: the (message, signature) pairs of the items, or the
+        HTTPException refusing them
+        """
+        if len(items) > MAX_SIGNATURE_BATCH:
+            return HTTPException(
+                status_code=413,
+                detail={
+                    "message": f"At most {MAX_SIGNATURE_BATCH} signatures per batch"
+                },
+            )
+        try:
+            return [(item["message"], item["signature"]) for item in items]
+        except (KeyError, TypeError):
+            return HTTPException(
+                status_code=400,
+                detail={
+                    "message": "Each item needs a publicAddress, a message and "
+                    "a signature"
+                },
+            )
+
+    def signature_results(self, items: list, addresses: list):
+        return HTTPException(
+            status_code=200,
+            detail={
+                "results": [
+                    {
+                        "publicAddress": item.get("publicAddress"),
+                        "recovered": address,
+                        "valid": signs(item.get("publicAddress") or "", address),
+                    }
+                    for item, address in zip(items, addresses)
+                ]
+            },
+        )
+
+    async def verify_signatures(self, items: list):
+        """
+        Checks a batch of signed messages in one go, spread over the signature
+        workers.
+
+        :param items: dicts of the publicAddress claimed, the message and the
+        signature of that message
+        :return: for each item, the address recovered and whether it is the
+        one claimed, compared without case
+        """
+        try:
+            pairs = self.signature_batch(items)
+            if isinstance(pairs, HTTPException):
+                return pairs
+
+            return self.signature_results(
+                items, await signature_recovery.recover_many_async(pairs)
+            )
+
+        except SignatureQueueFull as e:
+            return self.signatures_busy(e)
+
         except Exception as e:
-            print(e)
+            logger.error(e)
             return e
 
     def verify(self, token: str):
+        """
+        :param token: the token of the user, decoded only if it is not the one
+        the current request was authenticated with and is not cached
+        :return: the claims of the token, None if it is not valid
+        """
         try:
-            decoded = jwt.decode(token, os.environ.get("SECRET"), algorithms=["HS256"])
+            principal = token_verifier.authenticated(token)
             return HTTPException(
-                status_code=200, detail={"message": "User verified", "user": decoded}
+                status_code=200,
+                detail={"message": "User verified", "user": dict(principal.claims)},
             )
         except Exception as e:
-            print(e)
+            logger.error(e)
             return
 
-    def user_check(self, user_public_address: str):
+    async def revoke_token(self, token: str):
+        """
+        :param token: the token of the user, refused until it expires
+        :return: whether the token was revoked, and whether every worker
+        refuses it; without a shared store only this one does
+        """
+        try:
+            await token_verifier.revoke_async(token)
+            return HTTPException(
+                status_code=200,
+                detail={
+                    "message": "Token revoked",
+                    "response": True,
+                    "shared": shared_store is not None,
+                },
+            )
+
+        except InvalidTokenError:
+            return HTTPException(
+                status_code=401, detail={"message": "Invalid token", "response": False}
+            )
+
+        except Exception as e:
+            logger.error(e)
+            return e
+
+    async def user_check(self, user_public_address: str, cached: bool = True):
         """
         :param user_public_address: the user public address
+        :param cached: False to read the user from the database, e.g. for
+        its current nonce
         :return: the user if exists
         """
         try:
-            collection_name = "users"
+            user = await self.repositories(cached=cached).users.get(user_public_address)
 
-            collection = self.get_collection(collection_name)
-
-            if self.user_exists(user_public_address):
-                user = collection.find_one({"publicAddress": user_public_address})
-                if user:
-                    return HTTPException(
-                        status_code=200,
-                        detail={"message": "User retrieved successfully", "user": user},
-                    )
-                else:
-                    return HTTPException(
-                        status_code=404, detail={"message": "User not found"}
-                    )
+            if user is not None:
+                return HTTPException(
+                    status_code=200,
+                    detail={"message": "User retrieved successfully", "user": user},
+                )
             else:
                 return HTTPException(
                     status_code=404, detail={"message": "User not found"}
                 )
 
         except Exception as e:
-            print(e)
+            logger.error(e)
             return e
 
-    def update_user_nonce(self, user_public_address: str, nonce: int):
+    @invalidates(users=("user_public_address",))
+    async def update_user_nonce(self, user_public_address: str, nonce: int):
         try:
             collection_name = "users"
             collection = self.get_collection(collection_name)
 
-            collection.update_one(
+            await collection.update_one(
                 {"publicAddress": user_public_address}, {"$set": {"nonce": nonce}}
             )
             return HTTPException(
@@ -1814,7 +2033,7 @@ class DbWrapper:
             )
 
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return e
 
     def ip_rate_limit_decorator(self, func):
@@ -1822,6 +2041,8 @@ class DbWrapper:
         async def wrapper(*args, **kwargs):
             user_ip = kwargs["info"].client.host
             response = self.ip_rate_limit(user_ip)
+            if inspect.isawaitable(response):
+                response = await response
 
             if response.status_code == 200:
                 return await func(*args, **kwargs)
@@ -1830,22 +2051,36 @@ class DbWrapper:
 
         return wrapper
 
-    def ip_rate_limit(self, ip: str):
+    @counts_rate_limit
+    async def ip_rate_limit(self, ip: str):
         """
         check the incoming request user ip and limit the number of requests to 10 in a minute period and reset it
         every minute to zero according to the timestamp
         """
         try:
+            if shared_store is not None:
+                # one pipelined round trip, counted across every instance
+                hits = await shared_store.hit_async(
+                    f"ip:{ip}", self.ip_rate_limit_time_seconds * 1000
+                )
+                if hits > self.ip_rate_limit_count:
+                    return HTTPException(
+                        status_code=429, detail={"message": "Too many requests"}
+                    )
+                return HTTPException(
+                    status_code=200, detail={"message": "Request accepted"}
+                )
+
             collection_name = "ip"
             collection = self.get_collection(collection_name)
 
-            ip_info = collection.find_one({"ip": ip})
+            ip_info = await collection.find_one({"ip": ip})
 
             if ip_info:
                 if ip_info["timestamp"] < int(
                     time.time() - self.ip_rate_limit_time_seconds
                 ):
-                    collection.update_one(
+                    await collection.update_one(
                         {"ip": ip},
                         {"$set": {"timestamp": int(time.time()), "count": 1}},
                     )
@@ -1854,7 +2089,7 @@ class DbWrapper:
                     )
                 else:
                     if ip_info["count"] < self.ip_rate_limit_count:
-                        collection.update_one(
+                        await collection.update_one(
                             {"ip": ip}, {"$set": {"count": ip_info["count"] + 1}}
                         )
                         return HTTPException(
@@ -1865,15 +2100,16 @@ class DbWrapper:
                             status_code=429, detail={"message": "Too many requests"}
                         )
             else:
-                collection.insert_one(
+                await collection.insert_one(
                     {"ip": ip, "timestamp": int(time.time()), "count": 1}
                 )
                 return HTTPException(status_code=200, detail={"message": "IP added"})
 
         except Exception as e:
-            print(e)
+            logger.error(e)
             return e
 
+    @times_upload("w3storage")
     def horse_ipfs_upload(self, img_name: str):
         try:
             # Read the image and upload it to IPFS
@@ -1888,6 +2124,7 @@ class DbWrapper:
                 detail={"message": "Error uploading to IPFS", "error": str(e)},
             )
 
+    @times_upload("uploadcare")
     def profile_image_upload(self, img_name: str):
         try:
             # Upload the image on the server to the cloud (Uploadcare)
@@ -1900,6 +2137,7 @@ class DbWrapper:
                 status_code=500, detail={"message": "Image not saved", "error": e}
             )
 
+    @times_upload("uploadcare")
     def horse_image_upload(self, img_name: str):
         try:
             # Upload the image on the server to the cloud (Uploadcare)
@@ -1912,38 +2150,15 @@ class DbWrapper:
                 status_code=500, detail={"message": "Image not saved", "error": e}
             )
 
-    def admin_signature(self, admin_public_address: str, signature: str):
+    async def admin_signature(self, admin_public_address: str, signature: str):
         try:
             msg = f"Horse Around Admin Authentication for {admin_public_address}"
-            message_hex = encode_defunct(text=msg)
-            expectedAddress = self.web3.eth.account.recover_message(
-                message_hex, signature=signature
-            )
-            print("expected:", expectedAddress)
-            print("admin   :", admin_public_address)
-            if expectedAddress == admin_public_address:
-                print("hello")
-                token = jwt.encode(
-                    {
-                        "publicAddress": admin_public_address,
-                        "exp": datetime.now(tz=timezone.utc) + timedelta(days=7),
-                    },
-                    "YEKLABS",
-                    algorithm="HS256",
-                )
-                print("token", token)
-                return HTTPException(
-                    status_code=200,
-                    detail={
-                        "message": "Admin authenticated",
-                        "token": token,
-                    },
-                )
+            expectedAddress = await signature_recovery.recover_async(msg, signature)
 
-            else:
-                return HTTPException(
-                    status_code=401, detail={"message": "Admin not authenticated"}
-                )
+            return self.admin_signed(admin_public_address, expectedAddress)
+
+        except SignatureQueueFull as e:
+            return self.signatures_busy(e)
 
         except Exception as e:
             return HTTPException(
@@ -1951,16 +2166,43 @@ class DbWrapper:
                 detail={"message": "Error authenticating admin", "error": str(e)},
             )
 
+    def admin_signed(self, admin_public_address: str, expectedAddress: str):
+        logger.debug(
+            "Admin signature of %s recovers %s.",
+            admin_public_address,
+            expectedAddress,
+        )
+        if expectedAddress is not None and expectedAddress == admin_public_address:
+            token = admin_token_verifier.issue(
+                {
+                    "publicAddress": admin_public_address,
+                    "exp": datetime.now(tz=timezone.utc) + timedelta(days=7),
+                }
+            )
+            return HTTPException(
+                status_code=200,
+                detail={
+                    "message": "Admin authenticated",
+                    "token": token,
+                },
+            )
+
+        else:
+            return HTTPException(
+                status_code=401, detail={"message": "Admin not authenticated"}
+            )
+
     def admin_verify(self, token: str):
         try:
-            decoded = jwt.decode(token, "YEKLABS", algorithms=["HS256"])
-            if decoded["publicAddress"] in self.admins:
+            principal = admin_token_verifier.authenticated(token)
+            address = principal.public_address
+            if address is not None and address.lower() in self.admins:
                 return True
             else:
                 return False
 
         except Exception as e:
-            print(e)
+            logger.error(e)
             return e
 
     def jwt_check_decorator(self, func):
@@ -1969,9 +2211,11 @@ class DbWrapper:
             req = await kwargs["info"].json()
 
             user_token = req["token"]
+            await authenticate(kwargs["info"], user_token, admin_token_verifier)
             response = self.admin_verify(user_token)
 
-            if response:
+            # admin_verify returns the error, which is truthy, for a bad token
+            if response is True:
                 return await func(*args, **kwargs)
             else:
                 return HTTPException(
@@ -1983,13 +2227,13 @@ class DbWrapper:
 
         return wrapper
 
-    def add_email_subscription(self, email: str):
+    async def add_email_subscription(self, email: str):
         try:
             collection_name = "emails"
             collection = self.get_collection(collection_name)
 
-            if not collection.find_one({"email": email}):
-                collection.insert_one({"email": email})
+            if not await collection.find_one({"email": email}):
+                await collection.insert_one({"email": email})
                 return HTTPException(status_code=200, detail={"message": "Email added"})
             else:
                 return HTTPException(
@@ -2002,15 +2246,14 @@ class DbWrapper:
                 detail={"message": "Error adding email subscription", "error": str(e)},
             )
 
-    def get_email_subscription_list(self):
+    async def get_email_subscription_list(self):
         try:
             collection_name = "emails"
             collection = self.get_collection(collection_name)
-            emails = collection.find()
 
             email_list = []
 
-            for email in emails:
+            async for email in collection.find():
                 email_list.append(email["email"])
 
             return {"emails": email_list}
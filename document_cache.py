@@ -0,0 +1,391 @@
+import copy
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import bson
+
+from shared_store import shared_store
+
+# bounds of the horse and user caches; entries older than the TTL are read
+# again, which is also how writes made by other worker processes show up
+DOCUMENT_CACHE_SIZE = int(os.environ.get("DOCUMENT_CACHE_SIZE", 10000))
+DOCUMENT_CACHE_TTL_SECONDS = float(os.environ.get("DOCUMENT_CACHE_TTL_SECONDS", 5))
+
+# how long a document written is kept out of a shared cache, longer than a
+# read of it may take
+SHARED_CACHE_TOMBSTONE_MS = int(os.environ.get("SHARED_CACHE_TOMBSTONE_MS", 1000))
+
+# what a shared cache holds in place of a document that was written
+TOMBSTONE = b"-"
+
+
+class DocumentCache:
+    """
+    A bounded LRU of documents by key whose entries expire after a TTL.
+    Documents are copied in and out, so callers may modify what they get.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DOCUMENT_CACHE_SIZE,
+        ttl: float = DOCUMENT_CACHE_TTL_SECONDS,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # key -> (expiry, document)
+            self.entries = OrderedDict()
+            # _id -> key of the cached documents, for changes known by _id
+            self.ids = {}
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.invalidations = 0
+            # key -> invalidations when it was last forgotten, the oldest
+            # dropped past max_size
+            self.forgotten = OrderedDict()
+            # invalidations when a document of unknown key, or every one,
+            # was last forgotten
+            self.floor = 0
+
+    def get(self, key, copied: bool = True):
+        """
+        :param key: the key of the document
+        :param copied: False to only check the document is cached
+        :return: a copy of the cached document, None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self.drop(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            document = entry[1]
+
+        return copy.deepcopy(document) if copied else document
+
+    def ticket(self) -> int:
+        """
+        :return: a ticket to take before reading a document from the database
+        and to hand to put, see put
+        """
+        with self.lock:
+            return self.invalidations
+
+    def put(self, key, document: dict, ticket: int):
+        """
+        :param key: the key of the document
+        :param document: the document as read from the database
+        :param ticket: taken before the read; the document is not cached if
+        it was invalidated since, it may predate that write
+        """
+        document = copy.deepcopy(document)
+        with self.lock:
+            if max(self.floor, self.forgotten.get(key, 0)) > ticket:
+                return
+
+            self.entries[key] = (time.monotonic() + self.ttl, document)
+            self.entries.move_to_end(key)
+            if "_id" in document:
+                self.ids[document["_id"]] = key
+            while len(self.entries) > self.max_size:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def drop(self, key):
+        # the caller holds the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.ids.pop(entry[1].get("_id"), None)
+
+    def invalidate(self, key):
+        # the caller holds the lock
+        self.invalidations += 1
+        self.forgotten[key] = self.invalidations
+        self.forgotten.move_to_end(key)
+        if len(self.forgotten) > self.max_size:
+            _, invalidated = self.forgotten.popitem(last=False)
+            self.floor = max(self.floor, invalidated)
+
+    def forget(self, key):
+        """
+        :param key: the key of a document that was or is being modified
+        """
+        with self.lock:
+            self.invalidate(key)
+            self.drop(key)
+
+    def forget_id(self, _id):
+        """
+        :param _id: the _id of a document that was modified
+        """
+        with self.lock:
+            key = self.ids.get(_id)
+            if key is not None:
+                self.invalidate(key)
+                self.drop(key)
+            else:
+                # the document may be being read under a key we do not know
+                self.invalidations += 1
+                self.floor = self.invalidations
+
+    def clear(self):
+        """
+        Forgets every document, when changes may have been missed.
+        """
+        with self.lock:
+            self.invalidations += 1
+            self.floor = self.invalidations
+            self.entries.clear()
+            self.ids.clear()
+            self.forgotten.clear()
+
+    # the process' memory is at hand, the async methods need not wait for it
+
+    async def get_async(self, key, copied: bool = True):
+        return self.get(key, copied)
+
+    async def put_async(self, key, document: dict, ticket: int):
+        self.put(key, document, ticket)
+
+    async def forget_async(self, key):
+        self.forget(key)
+
+    async def forget_id_async(self, _id):
+        self.forget_id(_id)
+
+    async def clear_async(self):
+        self.clear()
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+class SharedDocumentCache:
+    """
+    A DocumentCache kept in the shared store, so every worker and instance
+    reads the same entries and a write made by any of them is seen by all at
+    once. Documents are stored as BSON. Instead of tickets, a written document
+    is replaced by a tombstone for SHARED_CACHE_TOMBSTONE_MS, and documents
+    are only cached where there is nothing, so a read that started before the
+    write cannot cache what it read.
+    """
+
+    def __init__(self, name: str, store, ttl: float = DOCUMENT_CACHE_TTL_SECONDS):
+        """
+        :param name: the collection cached, keys are namespaced by it
+        :param store: the SharedStore
+        """
+        self.name = name
+        self.store = store
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def key(self, key) -> str:
+        return f"cache:{self.name}:{key}"
+
+    def id_key(self, _id) -> str:
+        # the _id of a cached document -> its key, for changes known by _id
+        return f"cache:{self.name}:id:{_id}"
+
+    def entries(self, key, document: dict) -> list:
+        entries = [(self.key(key), bson.encode(document))]
+        if "_id" in document:
+            entries.append((self.id_key(document["_id"]), self.key(key).encode()))
+
+        return entries
+
+    def decoded(self, value: bytes):
+        with self.lock:
+            if value is None or value == TOMBSTONE:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return bson.decode(value)
+
+    def get(self, key, copied: bool = True):
+        """
+        :param key: the key of the document
+        :param copied: ignored, the document is always decoded afresh
+        :return: the cached document, None if missing
+        """
+        return self.decoded(self.store.get(self.key(key)))
+
+    async def get_async(self, key, copied: bool = True):
+        return self.decoded(await self.store.get_async(self.key(key)))
+
+    def ticket(self) -> int:
+        # tombstones stand in for tickets
+        return 0
+
+    def put(self, key, document: dict, ticket: int):
+        """
+        :param key: the key of the document
+        :param document: the document as read from the database
+        """
+        self.store.set_many(
+            self.entries(key, document), int(self.ttl * 1000), missing_only=True
+        )
+
+    async def put_async(self, key, document: dict, ticket: int):
+        await self.store.set_many_async(
+            self.entries(key, document), int(self.ttl * 1000), missing_only=True
+        )
+
+    def invalidated(self):
+        with self.lock:
+            self.invalidations += 1
+
+    def forget(self, key):
+        """
+        :param key: the key of a document that was or is being modified
+        """
+        self.invalidated()
+        self.store.set(self.key(key), TOMBSTONE, SHARED_CACHE_TOMBSTONE_MS)
+
+    async def forget_async(self, key):
+        self.invalidated()
+        await self.store.set_async(self.key(key), TOMBSTONE, SHARED_CACHE_TOMBSTONE_MS)
+
+    def forget_id(self, _id):
+        """
+        :param _id: the _id of a document that was modified
+        """
+        self.invalidated()
+        key = self.store.get(self.id_key(_id))
+        if key is not None:
+            self.store.set(key.decode(), TOMBSTONE, SHARED_CACHE_TOMBSTONE_MS)
+
+    async def forget_id_async(self, _id):
+        self.invalidated()
+        key = await self.store.get_async(self.id_key(_id))
+        if key is not None:
+            await self.store.set_async(
+                key.decode(), TOMBSTONE, SHARED_CACHE_TOMBSTONE_MS
+            )
+
+    def clear(self):
+        """
+        Forgets every document, when changes may have been missed.
+        """
+        self.invalidated()
+        self.store.delete_matching(f"cache:{self.name}:*")
+
+    async def clear_async(self):
+        self.invalidated()
+        await self.store.delete_matching_async(f"cache:{self.name}:*")
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "shared": True,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+def document_cache(name: str):
+    """
+    :param name: the collection cached
+    :return: a cache in the shared store if there is one, else in process
+    """
+    if shared_store is not None:
+        return SharedDocumentCache(name, shared_store)
+
+    return DocumentCache()
+
+
+horse_cache = document_cache("horses")
+user_cache = document_cache("users")
+
+caches = {"horses": horse_cache, "users": user_cache}
+
+
+def argument_values(signature, args: tuple, kwargs: dict, paths: tuple) -> list:
+    """
+    :param signature: the signature of the method called
+    :param paths: argument names, or "name.key" for a key of a dict argument
+    :return: the values of the paths in the call, None values left out
+    """
+    arguments = signature.bind_partial(*args, **kwargs).arguments
+    values = []
+    for path in paths:
+        name, _, key = path.partition(".")
+        value = arguments.get(name)
+        if key and isinstance(value, dict):
+            value = value.get(key)
+        if value is not None:
+            values.append(value)
+
+    return values
+
+
+def invalidates(horses: tuple = (), users: tuple = ()):
+    """
+    Drops the horses and users a DbWrapper method writes from the caches once
+    it returns, whether it succeeded or not.
+
+    :param horses: the arguments holding the ids of the horses written, as
+    "name" or "name.key" for a key of a dict argument
+    :param users: the same for the public addresses of the users written
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def written(args, kwargs):
+            for cache, paths in ((horse_cache, horses), (user_cache, users)):
+                for value in argument_values(signature, args, kwargs, paths):
+                    yield cache, value
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                for cache, value in written(args, kwargs):
+                    await cache.forget_async(value)
+
+        return wrapper
+
+    return decorator
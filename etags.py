@@ -0,0 +1,135 @@
+from functools import wraps
+
+from fastapi.exceptions import HTTPException
+from fastapi.responses import Response
+
+from json_responses import MSGPACK_MEDIA_TYPE
+from request_context import current_media_type
+
+# the collection holding one change counter per counted collection
+COUNTERS_COLLECTION = "counters"
+
+# Cache-Control of the conditional routes; "no-cache" lets clients keep a
+# response but makes them revalidate it with If-None-Match every time
+CACHE_CONTROL = {
+    "/get_horses/": "public, no-cache",
+    "/listings/": "public, no-cache",
+    "/get_horse/": "private, no-cache",
+}
+
+
+def collection_etag(counter: str, changes: int) -> str:
+    """
+    The counter is read before the documents and bumped after a write, so a
+    write landing in between is in the body before it is in the ETag; two
+    bodies may share an ETag for that moment, which only a weak ETag allows.
+
+    :param counter: the change counter of the collection the response is from
+    :param changes: its value read before the documents
+    :return: a weak ETag for any response read from the collection
+    """
+    return f'W/"{counter}-{changes}"'
+
+
+def document_etag(kind: str, key, version: int) -> str:
+    """
+    :param kind: what the document is, e.g. "horse"
+    :param key: the key of the document, the request body may not name it
+    :param version: the version of the document
+    :return: a strong ETag for the document in the media type the request
+    asked for, as its JSON and MessagePack bodies differ
+    """
+    if current_media_type.get() == MSGPACK_MEDIA_TYPE:
+        return f'"{kind}-{key}-v{version}-msgpack"'
+
+    return f'"{kind}-{key}-v{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    :param if_none_match: the If-None-Match header of the request, if any
+    :param etag: the ETag of the current response
+    :return: True if the client already holds the current response
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    # If-None-Match uses the weak comparison, a W/ prefix is ignored
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return opaque_tag(etag) in (opaque_tag(tag) for tag in tags)
+
+
+def opaque_tag(etag: str) -> str:
+    """
+    :return: the ETag without its weakness indicator
+    """
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def not_modified(etag: str) -> HTTPException:
+    return HTTPException(status_code=304, headers={"ETag": etag})
+
+
+def conditional_response(result, response: Response, route: str):
+    """
+    :param result: what the DbWrapper method returned
+    :param response: the response of the route, for the headers
+    :param route: the route, see CACHE_CONTROL
+    :return: an empty 304 response if result is one, else result with its
+    ETag and Cache-Control set on the response
+    """
+    headers = getattr(result, "headers", None) or {}
+    if "ETag" not in headers:
+        return result
+
+    headers = dict(headers, **{"Cache-Control": CACHE_CONTROL[route]})
+    if result.status_code == 304:
+        # the ETag depends on the format, as the 200 respond writes says
+        headers["Vary"] = "Accept"
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return result
+
+
+def wrote(result) -> bool:
+    """
+    :param result: what a DbWrapper method writing the collection returned
+    :return: True if it reports a write; refusals and missing documents are
+    answered without the "status": "success" or "response": True flag, some
+    of them with a 200 too
+    """
+    if not isinstance(result, HTTPException) or result.status_code != 200:
+        return False
+    if not isinstance(result.detail, dict):
+        return False
+
+    return (
+        result.detail.get("status") == "success"
+        or result.detail.get("response") is True
+    )
+
+
+def counts_changes(counter: str):
+    """
+    Counts a change of the collection once a DbWrapper method writing it
+    returns a successful write, through the wrapper's count_change. Decorate
+    above any decorator that writes data derived from the collection, so
+    responses tagged with the new count include it.
+
+    :param counter: the counter of the collection written
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            result = await func(*args, **kwargs)
+            if wrote(result):
+                await args[0].count_change(counter)
+            return result
+
+        return wrapper
+
+    return decorator
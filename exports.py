@@ -0,0 +1,70 @@
+import logging
+
+from json_responses import dumps
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# documents fetched per round trip and written per chunk
+EXPORT_BATCH_SIZE = 500
+
+# collections that can be exported, with the fields left out of the dump
+EXPORT_PROJECTIONS = {
+    "horses": None,
+    "users": {"nonce": 0},
+}
+
+
+def ndjson_line(document: dict) -> bytes:
+    # written by the same serializer as the JSON responses, so an exported
+    # document reads the same as the one the API returns
+    return dumps(document) + b"\n"
+
+
+def ndjson_chunks(cursor, batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    :param cursor: a pymongo cursor
+    :param batch_size: documents per chunk
+    :return: a generator of NDJSON chunks, holding one batch at a time
+    """
+    batch = []
+    try:
+        for document in cursor:
+            batch.append(ndjson_line(document))
+            if len(batch) == batch_size:
+                yield b"".join(batch)
+                batch = []
+
+        if batch:
+            yield b"".join(batch)
+
+    except Exception as e:
+        logger.error(e)
+        raise
+
+    finally:
+        cursor.close()
+
+
+async def ndjson_chunks_async(cursor, batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    Motor counterpart of ndjson_chunks.
+    """
+    batch = []
+    try:
+        async for document in cursor:
+            batch.append(ndjson_line(document))
+            if len(batch) == batch_size:
+                yield b"".join(batch)
+                batch = []
+
+        if batch:
+            yield b"".join(batch)
+
+    except Exception as e:
+        logger.error(e)
+        raise
+
+    finally:
+        await cursor.close()
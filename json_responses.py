@@ -0,0 +1,401 @@
+import argparse
+import json
+import logging
+import time
+from datetime import date, datetime, timezone
+from functools import wraps
+
+import msgpack
+import orjson
+from bson import Decimal128, ObjectId
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from fastapi.responses import Response
+from fastapi.routing import APIRoute
+
+from request_context import current_media_type
+
+logger = logging.getLogger(__name__)
+
+# integer keys, like those of get_horses, are written as strings
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# the names clients use for MessagePack, in Accept and Content-Type
+MSGPACK_MEDIA_TYPES = (
+    MSGPACK_MEDIA_TYPE,
+    "application/x-msgpack",
+    "application/vnd.msgpack",
+)
+
+
+def encode(value):
+    """
+    Called by orjson for what it cannot write itself.
+
+    :return: ObjectIds as strings, Decimal128s as decimal strings so no digit
+    is lost, exceptions such as the HTTPExceptions DbWrapper returns as their
+    attributes, and anything else as jsonable_encoder would
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, Exception):
+        return vars(value)
+
+    return jsonable_encoder(value)
+
+
+def dumps(content) -> bytes:
+    """
+    :return: content as JSON, the same document jsonable_encoder and
+    json.dumps would give for everything DbWrapper returns
+    """
+    try:
+        return orjson.dumps(content, default=encode, option=ORJSON_OPTIONS)
+
+    except orjson.JSONEncodeError as e:
+        # e.g. integers beyond 64 bits, which orjson refuses
+        logger.debug("Falling back to json for %s", e)
+        return json.dumps(
+            jsonable_encoder(content),
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        ).encode()
+
+
+def string_keys(value):
+    # documents only have string keys, integer ones are the result indexes
+    # DbWrapper builds, e.g. {0: horse, 1: horse}, at the top of a detail
+    if isinstance(value, dict) and not all(isinstance(k, str) for k in value):
+        return {str(k): v for k, v in value.items()}
+
+    return value
+
+
+def encode_msgpack(value):
+    """
+    Called by msgpack for what it cannot write itself; values are written as
+    encode writes them to JSON, so both formats hold the same data.
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Exception):
+        return {k: string_keys(v) for k, v in vars(value).items()}
+
+    return encode(value)
+
+
+def packb(content) -> bytes:
+    """
+    :return: content as MessagePack, the document dumps would write
+    """
+    return msgpack.packb(string_keys(content), default=encode_msgpack)
+
+
+def quality(accept: str, media_types: tuple) -> float:
+    """
+    :param accept: the Accept header of a request
+    :param media_types: the names of one media type
+    :return: the q-value the header gives to it, by its most specific range
+    """
+    best = (-1, 0.0)
+    for item in accept.split(","):
+        media_range, *parameters = item.split(";")
+        media_range = media_range.strip().lower()
+        if media_range in media_types:
+            specificity = 2
+        elif media_range == "application/*":
+            specificity = 1
+        elif media_range == "*/*":
+            specificity = 0
+        else:
+            continue
+
+        weight = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        best = max(best, (specificity, weight))
+
+    return best[1]
+
+
+def negotiate_media_type(accept: str) -> str:
+    """
+    :param accept: the Accept header of a request
+    :return: MSGPACK_MEDIA_TYPE if the client names it and takes it at least
+    as readily as JSON, else JSON_MEDIA_TYPE
+    """
+    if not accept or not any(t in accept.lower() for t in MSGPACK_MEDIA_TYPES):
+        return JSON_MEDIA_TYPE
+
+    msgpack_quality = quality(accept, MSGPACK_MEDIA_TYPES)
+    if msgpack_quality > 0 and msgpack_quality >= quality(accept, (JSON_MEDIA_TYPE,)):
+        return MSGPACK_MEDIA_TYPE
+
+    return JSON_MEDIA_TYPE
+
+
+class DocumentRequest(Request):
+    """
+    A request whose json() also reads MessagePack bodies, by Content-Type, so
+    routes read both formats the same way.
+    """
+
+    async def json(self):
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        if content_type.lower() not in MSGPACK_MEDIA_TYPES:
+            return await super().json()
+
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body())
+
+        return self._json
+
+
+class DocumentResponse(Response):
+    """
+    A JSON response written by orjson, or a MessagePack one, from DbWrapper
+    results as they are: documents with ObjectIds and datetimes, inside
+    HTTPExceptions.
+    """
+
+    media_type = JSON_MEDIA_TYPE
+
+    def render(self, content) -> bytes:
+        if self.media_type == MSGPACK_MEDIA_TYPE:
+            try:
+                return packb(content)
+
+            except (OverflowError, TypeError, ValueError) as e:
+                # e.g. integers beyond 64 bits; JSON can still write them
+                logger.debug("Falling back to JSON for %s", e)
+                self.media_type = JSON_MEDIA_TYPE
+
+        return dumps(content)
+
+
+def failed(result) -> bool:
+    """
+    :param result: what a route returned
+    :return: True if it is an exception the route caught or a server error,
+    which routes answer with a 200 all the same
+    """
+    if isinstance(result, HTTPException):
+        return result.status_code >= 500
+
+    return isinstance(result, Exception)
+
+
+def respond(result, response: Response = None) -> Response:
+    """
+    :param result: what a route returned
+    :param response: the response the route was given for its headers and
+    status code, if any
+    :return: result if it is already a response, else result as a
+    DocumentResponse in the media type of the request, carrying those
+    headers and status code, and whether the route failed
+    """
+    if isinstance(result, Response):
+        return result
+
+    media_type = current_media_type.get()
+    document = DocumentResponse(
+        result,
+        status_code=(response.status_code if response else None) or 200,
+        media_type=media_type,
+    )
+    if response is not None:
+        headers = response.headers.raw
+        if document.media_type != media_type:
+            # the ETag names the format the body could not be written in
+            headers = [(k, v) for k, v in headers if k != b"etag"]
+        document.headers.raw.extend(headers)
+    # shared caches must keep a copy per format
+    document.headers.add_vary_header("Accept")
+    document.failed = failed(result)
+
+    return document
+
+
+def responds(endpoint):
+    """
+    Has an async endpoint return a DocumentResponse, so FastAPI sends it as
+    it is instead of running jsonable_encoder over the result first.
+    """
+
+    @wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        result = await endpoint(*args, **kwargs)
+        response = next((v for v in kwargs.values() if isinstance(v, Response)), None)
+
+        return respond(result, response)
+
+    return wrapper
+
+
+class DocumentRoute(APIRoute):
+    """
+    The route class of the app: the results of its endpoints are written by
+    DocumentResponse, in JSON or in MessagePack as the Accept header asks,
+    and request bodies may be either. Endpoints declaring a response_model
+    are left to FastAPI.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if kwargs.get("response_model") is None:
+            endpoint = responds(endpoint)
+
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def document_handler(request: Request) -> Response:
+            token = current_media_type.set(
+                negotiate_media_type(request.headers.get("Accept"))
+            )
+            try:
+                response = await handler(
+                    DocumentRequest(request.scope, request.receive)
+                )
+            finally:
+                current_media_type.reset(token)
+
+            if getattr(response, "failed", False):
+                # for the middleware counting the errors of each route
+                request.state.failed = True
+
+            return response
+
+        return document_handler
+
+
+def sample_horses(count: int) -> list:
+    """
+    :return: count horse documents shaped like those of the horses collection
+    """
+    now = datetime.now(tz=timezone.utc)
+    return [
+        {
+            "_id": ObjectId(),
+            "horseId": i,
+            "name": f"Horse {i}",
+            "publicAddress": f"0x{i:040x}",
+            "status": i % 5,
+            "price": Decimal128(f"{i}.25"),
+            "totalAmount": 100,
+            "registrationDate": now,
+            "image": f"https://example.com/horses/{i}.png",
+            "shareHolders": [
+                {"publicAddress": f"0x{j:040x}", "percentage": 10, "shareLeft": 5}
+                for j in range(10)
+            ],
+            "bidHistory": [
+                {
+                    "bidAmount": str(j),
+                    "bidderAddress": f"0x{j:040x}",
+                    "date": now.strftime("%d/%m/%Y"),
+                }
+                for j in range(10)
+            ],
+            "version": 3,
+        }
+        for i in range(count)
+    ]
+
+
+def timed(serialise, rounds: int) -> tuple:
+    """
+    :return: the time serialise takes on average, and what it returned
+    """
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        result = serialise()
+
+    return (time.perf_counter() - started_at) / rounds, result
+
+
+def format_benchmark(result, rounds: int) -> dict:
+    """
+    :param result: what a route returns
+    :return: the size of its body in JSON and in MessagePack, the time to
+    write it on the server and to read it back on a client, JSON by orjson
+    and by the json module most Python clients use
+    """
+    timings = {}
+    documents = []
+    for media_type, load in (
+        (JSON_MEDIA_TYPE, orjson.loads),
+        (MSGPACK_MEDIA_TYPE, msgpack.unpackb),
+    ):
+        token = current_media_type.set(media_type)
+        try:
+            encode_time, body = timed(lambda: respond(result).body, rounds)
+        finally:
+            current_media_type.reset(token)
+        decode_time, document = timed(lambda: load(body), rounds)
+        documents.append(document)
+        timings[media_type] = {
+            "bytes": len(body),
+            "encode_ms": encode_time * 1000,
+            "decode_ms": decode_time * 1000,
+        }
+        if media_type == JSON_MEDIA_TYPE:
+            stdlib_time, _ = timed(lambda: json.loads(body), rounds)
+            timings[media_type]["decode_stdlib_ms"] = stdlib_time * 1000
+
+    return {"same_data": documents[0] == documents[1], **timings}
+
+
+if __name__ == "__main__":
+    import pydantic
+    from starlette.responses import JSONResponse
+
+    parser = argparse.ArgumentParser(
+        description="Time serialising get_horse and get_horses payloads: with "
+        "jsonable_encoder, with orjson and in MessagePack."
+    )
+    parser.add_argument("--horses", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    # what main.py registers for the jsonable_encoder path
+    pydantic.json.ENCODERS_BY_TYPE[ObjectId] = str
+    pydantic.json.ENCODERS_BY_TYPE[Decimal128] = lambda d: str(d.to_decimal())
+
+    horses = sample_horses(args.horses)
+    get_horses = HTTPException(
+        status_code=200, detail={i: h for i, h in enumerate(horses)}
+    )
+    get_horse = HTTPException(
+        status_code=200, detail={"message": "Horse exists", "horse": horses[0]}
+    )
+
+    encoder_time, before = timed(
+        lambda: JSONResponse(jsonable_encoder(get_horses)).body, args.rounds
+    )
+    orjson_time, after = timed(lambda: respond(get_horses).body, args.rounds)
+
+    print(
+        {
+            "horses": args.horses,
+            "bytes": len(after),
+            "identical": json.loads(before) == json.loads(after),
+            "jsonable_encoder_ms": encoder_time * 1000,
+            "document_response_ms": orjson_time * 1000,
+            "speedup": encoder_time / orjson_time,
+            "get_horse": format_benchmark(get_horse, args.rounds * 100),
+            "get_horses": format_benchmark(get_horses, args.rounds),
+        }
+    )
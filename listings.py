@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import inspect
+import logging
+import os
+from functools import wraps
+
+from pymongo import DeleteMany, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from document_cache import argument_values
+
+logger = logging.getLogger(__name__)
+
+# horse statuses shown on the marketplace: 3 on sale, 4 on auction
+LISTED_STATUSES = (3, 4)
+
+# the horse fields a listing is made from; only the current auction is read
+LISTING_PROJECTION = {
+    "horseId": 1,
+    "horseName": 1,
+    "image": 1,
+    "status": 1,
+    "publicAddress": 1,
+    "totalAmount": 1,
+    "saleInfo": 1,
+    "auctionInfo": {"$slice": -1},
+    "version": 1,
+}
+
+# listings can be sorted by these, ascending or descending with a "-" prefix
+SORT_FIELDS = ("price", "highestBid", "deadline", "sharesOnMarket")
+
+# how often the listings lagging their horse are made again, e.g. after a
+# relist failed, in seconds; 0 disables it
+LISTINGS_RECONCILE_SECONDS = float(os.environ.get("LISTINGS_RECONCILE_SECONDS", 300))
+
+
+class InvalidSort(ValueError):
+    pass
+
+
+def number(value):
+    """
+    :param value: a price or bid, stored as a string by the API
+    :return: the value as a number, None if it is not one
+    """
+    try:
+        return float(value)
+
+    except (TypeError, ValueError):
+        return None
+
+
+def listing_summary(horse: dict):
+    """
+    :param horse: a horse, at least with the fields of LISTING_PROJECTION
+    :return: the listing of the horse, None if it is not on the marketplace
+    """
+    if horse is None or horse.get("status") not in LISTED_STATUSES:
+        return None
+
+    sales = [sale for sale in horse.get("saleInfo", []) if sale.get("onMarket")]
+    prices = [p for p in (number(sale.get("price")) for sale in sales) if p is not None]
+    auction = horse["auctionInfo"][-1] if horse.get("auctionInfo") else {}
+    on_auction = horse["status"] == 4 and bool(auction)
+
+    return {
+        "horseId": horse["horseId"],
+        "horseName": horse.get("horseName"),
+        "image": horse.get("image"),
+        "status": horse["status"],
+        "ownerAddress": horse.get("publicAddress"),
+        "totalAmount": horse.get("totalAmount"),
+        "price": min(prices) if prices else None,
+        "sharesOnMarket": sum(int(sale["onMarket"]) for sale in sales),
+        "highestBid": number(auction.get("highestBid")) if on_auction else None,
+        "openingBid": number(auction.get("openingBid")) if on_auction else None,
+        "deadline": auction.get("deadline") if on_auction else None,
+        "version": horse.get("version", 0),
+    }
+
+
+def listing_sort(sort: str = None) -> tuple:
+    """
+    :param sort: one of SORT_FIELDS, "-" prefixed for descending, None for
+    the listing order
+    :return: the sort field (None for _id) and whether it is descending
+    """
+    if sort is None:
+        return None, False
+
+    field = sort.lstrip("-")
+    if field not in SORT_FIELDS:
+        raise InvalidSort(f"Listings cannot be sorted by {sort!r}")
+
+    return field, sort.startswith("-")
+
+
+def listing_write(horse_id: int, horse: dict):
+    """
+    :param horse_id: the horse whose listing to bring up to date
+    :param horse: the horse as just read, None if it does not exist
+    :return: the write bringing the listing up to date with the horse; a
+    listing made from a newer version of the horse is left as it is
+    """
+    listing = listing_summary(horse)
+    if listing is None:
+        query = {"horseId": horse_id}
+        if horse is not None:
+            query["version"] = {"$lte": horse.get("version", 0)}
+        return DeleteMany(query)
+
+    return ReplaceOne(
+        {"horseId": horse_id, "version": {"$lte": listing["version"]}},
+        listing,
+        upsert=True,
+    )
+
+
+def lost_to_newer(error: BulkWriteError) -> bool:
+    """
+    :return: True if the only failed writes are upserts of listings made from
+    an older horse than the one already listed
+    """
+    details = error.details
+    return not details.get("writeConcernErrors") and all(
+        e["code"] == 11000 for e in details.get("writeErrors", [])
+    )
+
+
+async def relist_horse(database, horse_id: int):
+    """
+    :param database: the database holding horses and listings
+    :param horse_id: a horse that was written
+    """
+    horse = await database["horses"].find_one({"horseId": horse_id}, LISTING_PROJECTION)
+    try:
+        await database["listings"].bulk_write([listing_write(horse_id, horse)])
+
+    except BulkWriteError as e:
+        if not lost_to_newer(e):
+            raise
+
+
+def rebuild_writes(horses: list) -> list:
+    """
+    :param horses: every listed horse
+    :return: the writes making the listings match them exactly
+    """
+    writes = [listing_write(horse["horseId"], horse) for horse in horses]
+    writes.append(DeleteMany({"horseId": {"$nin": [h["horseId"] for h in horses]}}))
+
+    return writes
+
+
+async def build_listings(database) -> int:
+    """
+    :param database: the database holding horses and listings
+    :return: the number of listed horses
+    """
+    horses = (
+        await database["horses"]
+        .find({"status": {"$in": list(LISTED_STATUSES)}}, LISTING_PROJECTION)
+        .to_list(length=None)
+    )
+    try:
+        await database["listings"].bulk_write(rebuild_writes(horses), ordered=False)
+
+    except BulkWriteError as e:
+        if not lost_to_newer(e):
+            raise
+
+    return len(horses)
+
+
+async def stale_listings(database) -> list:
+    """
+    :param database: the database holding horses and listings
+    :return: the ids of the horses whose listing lags them: missing, made
+    from an older version, or listing a horse no longer on the marketplace
+    """
+    versions = {
+        horse["horseId"]: horse.get("version", 0)
+        for horse in await database["horses"]
+        .find({"status": {"$in": list(LISTED_STATUSES)}}, {"horseId": 1, "version": 1})
+        .to_list(length=None)
+    }
+    listed = {
+        listing["horseId"]: listing["version"]
+        for listing in await database["listings"]
+        .find({}, {"horseId": 1, "version": 1})
+        .to_list(length=None)
+    }
+
+    return [h for h, v in versions.items() if listed.get(h, -1) < v] + [
+        h for h in listed if h not in versions
+    ]
+
+
+async def reconcile_listings(database) -> int:
+    """
+    Relists the horses whose listing lags them, reading only the versions of
+    the others.
+
+    :param database: the database holding horses and listings
+    :return: the number of horses relisted
+    """
+    stale = await stale_listings(database)
+    for horse_id in stale:
+        await relist_horse(database, horse_id)
+
+    return len(stale)
+
+
+async def keep_reconciled(wrapper, interval: float = LISTINGS_RECONCILE_SECONDS):
+    """
+    Reconciles the listings every interval seconds, through the wrapper's
+    reconcile_listings, until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            relisted = await wrapper.reconcile_listings()
+            if relisted:
+                logger.warning("Relisted %s horses whose listing lagged", relisted)
+
+        except Exception as e:
+            logger.error(e)
+
+
+def relists(*paths):
+    """
+    Brings the listings of the horses a DbWrapper method writes up to date
+    once it returns, through the wrapper's refresh_listing.
+
+    :param paths: the arguments holding the horse ids, as "name" or
+    "name.key" for a key of a dict argument
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                for horse_id in argument_values(signature, args, kwargs, paths):
+                    await args[0].refresh_listing(horse_id)
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == "__main__":
+    from db_wrapper import DbWrapper
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild the marketplace listings from the horses."
+    )
+    parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print(DbWrapper().rebuild_listings())
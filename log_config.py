@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from request_context import current_request_id, current_route
+
+# fraction of the high-frequency records that are kept, see SAMPLED
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+
+# pass as extra= to log a high-frequency event only for a sample of calls
+SAMPLED = {"sample_rate": LOG_SAMPLE_RATE}
+
+# levels of noisy third-party loggers unless LOG_LEVELS says otherwise
+DEFAULT_LEVELS = {"pymongo": "WARNING", "motor": "WARNING", "urllib3": "WARNING"}
+
+
+def parse_levels(levels: str) -> dict:
+    """
+    :param levels: comma separated logger=LEVEL pairs, e.g.
+    "db_wrapper=DEBUG,pymongo=WARNING"
+    :return: the level of each logger
+    """
+    parsed = {}
+    for pair in filter(None, (p.strip() for p in levels.split(","))):
+        name, _, level = pair.partition("=")
+        parsed[name.strip()] = level.strip().upper()
+
+    return parsed
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Tags records with the request being served and drops the unsampled
+    share of records logged with SAMPLED.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None and random.random() >= sample_rate:
+            return False
+
+        record.request_id = current_request_id.get()
+        record.route = current_route.get()
+
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line; the message is only formatted here, for the
+    records that are actually written.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("request_id", "route", "sample_rate"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """
+    Sets up the root logger from the environment: LOG_LEVEL (default INFO),
+    LOG_LEVELS for per-module levels and LOG_FORMAT ("json", the default, or
+    "text"). Calling it again replaces the previous setup.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(RequestContextFilter())
+    if os.environ.get("LOG_FORMAT", "json") == "text":
+        handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+            )
+        )
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    levels = dict(DEFAULT_LEVELS, **parse_levels(os.environ.get("LOG_LEVELS", "")))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
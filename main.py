@@ -1,20 +1,56 @@
+import asyncio
 import logging
 import pydantic
+from bson.decimal128 import Decimal128
 from bson.objectid import ObjectId
-from db_wrapper import DbWrapper
+from async_db_wrapper import AsyncDbWrapper
+from threadpool_db_wrapper import ThreadPoolDbWrapper
+from request_context import current_principal, current_request_id, current_route
+from log_config import configure_logging
+from query_metrics import command_metrics
+from metrics import (
+    UNMATCHED_ROUTE,
+    in_flight_requests,
+    monitor_event_loop_lag,
+    observe_request,
+    registry,
+)
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from exports import NDJSON_MEDIA_TYPE
+from compression import CompressionMiddleware
+from etags import conditional_response
+from json_responses import DocumentRoute
+from listings import LISTINGS_RECONCILE_SECONDS, keep_reconciled
+from auth import authenticate, bearer_token
 from fastapi import FastAPI, Request, File, UploadFile, Form
+from fastapi.responses import Response, StreamingResponse
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from datetime import datetime, timezone
 import calendar
 import time
 import uuid
 import os
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# DocumentResponse writes these itself, jsonable_encoder is left for the
+# payloads orjson refuses
 pydantic.json.ENCODERS_BY_TYPE[ObjectId] = str
+pydantic.json.ENCODERS_BY_TYPE[Decimal128] = lambda d: str(d.to_decimal())
 
 app = FastAPI()
-db = DbWrapper()
+# route results are written by orjson rather than through jsonable_encoder
+app.router.route_class = DocumentRoute
+
+# "async" (default) awaits Motor natively, "threadpool" runs the synchronous
+# DbWrapper on a bounded thread pool (see threadpool_db_wrapper.py)
+if os.environ.get("DB_EXECUTION_MODE", "async") == "threadpool":
+    db = ThreadPoolDbWrapper()
+else:
+    db = AsyncDbWrapper()
 
 origins = [
     "http://localhost",
@@ -32,6 +68,105 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# gzip, br or zstd for the large catalogue responses, per Accept-Encoding
+app.add_middleware(CompressionMiddleware)
+
+
+def route_template(scope: dict) -> str:
+    """
+    :return: the path template of the route the request is for, so requests
+    are counted per route rather than per path; UNMATCHED_ROUTE if none is
+    """
+    # the router sets scope["route"] only after the middleware has run
+    method_mismatch = None
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and method_mismatch is None:
+            method_mismatch = route.path
+
+    return method_mismatch or UNMATCHED_ROUTE
+
+
+@app.middleware("http")
+async def bind_route(info: Request, call_next):
+    token = current_route.set(route_template(info.scope))
+    request_id = info.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_token = current_request_id.set(request_id)
+    principal_token = current_principal.set(None)
+    started_at = time.perf_counter()
+    status = 500
+    in_flight_requests.inc()
+    try:
+        bearer = bearer_token(info.headers.get("Authorization"))
+        if bearer is not None:
+            await authenticate(info, bearer)
+
+        response = await call_next(info)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        in_flight_requests.dec()
+        route = current_route.get()
+        observe_request(
+            route,
+            info.method,
+            status,
+            time.perf_counter() - started_at,
+            failed=getattr(info.state, "failed", False),
+        )
+        command_metrics.record_request(route)
+        current_principal.reset(principal_token)
+        current_request_id.reset(request_token)
+        current_route.reset(token)
+
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    app.state.event_loop_monitor = asyncio.create_task(monitor_event_loop_lag())
+
+
+@app.on_event("startup")
+async def watch_document_changes():
+    # evicts horses and users cached by this worker when another one writes them
+    try:
+        await db.watch_document_changes()
+
+    except Exception as e:
+        logger.error(e)
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    # creates the missing indexes, DB_INDEX_MODE=strict refuses to start when a
+    # DbWrapper query would still scan a whole collection
+    await db.ensure_indexes()
+
+
+@app.on_event("startup")
+async def ensure_membership():
+    # answers existence checks of unknown users and horses without a query
+    try:
+        await db.ensure_membership()
+
+    except Exception as e:
+        logger.error(e)
+
+
+@app.on_event("startup")
+async def ensure_listings():
+    # the write paths keep the listings up to date once they exist, the ones
+    # they failed to write are made again on a schedule
+    try:
+        await db.ensure_listings()
+
+    except Exception as e:
+        logger.error(e)
+
+    if LISTINGS_RECONCILE_SECONDS > 0:
+        app.state.listings_reconciler = asyncio.create_task(keep_reconciled(db))
 
 
 @app.get("/")
@@ -44,7 +179,7 @@ async def root(info: Request):
         return "Horse Around API"
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -57,41 +192,54 @@ async def user_exists(info: Request) -> bool:
     try:
         req = await info.json()
         if req:
-            exists = db.user_exists(req["publicAddress"])
+            exists = await db.user_exists(req["publicAddress"])
             return exists
         else:
             return "Please provide a public address"
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
 @app.get("/get_users/")
-async def get_users(info: Request) -> list:
+async def get_users(
+    info: Request, limit: int = None, cursor: str = None, userType: str = None
+) -> list:
     """
-    :return: a list of all the users
+    :param limit: page size, pass it (or cursor) to get one page of users
+    :param cursor: the nextCursor of the previous page
+    :param userType: only list users of this type
+    :return: a list of all the users, or a page of them
     """
     try:
-        users = db.get_users()
+        if limit is not None or cursor is not None or userType is not None:
+            return await db.get_users_page(limit, cursor, userType)
+
+        users = await db.get_users()
         return users
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
 @app.get("/get_sellers/")
-async def get_sellers(info: Request) -> list:
+async def get_sellers(info: Request, limit: int = None, cursor: str = None) -> list:
     """
-    :return: a list of all the sellers
+    :param limit: page size, pass it (or cursor) to get one page of sellers
+    :param cursor: the nextCursor of the previous page
+    :return: a list of all the sellers, or a page of them
     """
     try:
-        sellers = db.get_sellers()
+        if limit is not None or cursor is not None:
+            return await db.get_sellers_page(limit, cursor)
+
+        sellers = await db.get_sellers()
         return sellers
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -104,13 +252,13 @@ async def seller_exists(info: Request) -> bool:
     try:
         req = await info.json()
         if req:
-            exists = db.seller_exists(req["publicAddress"])
+            exists = await db.seller_exists(req["publicAddress"])
             return exists
         else:
             return "Please provide a public address"
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -131,11 +279,11 @@ async def set_seller(info: Request) -> dict:
             "email": req["email"],
             "companyLink": req["companyLink"],
         }
-        seller_id = db.set_seller(seller_info)
+        seller_id = await db.set_seller(seller_info)
         return seller_id
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -170,19 +318,20 @@ async def set_user(info: Request) -> dict:
         # Upload image to Uploadcare and return the image public link
         """
         if req["image"]:
-            user_info["image"] = db.profile_image_upload(req["image"])
+            user_info["image"] = await db.profile_image_upload(req["image"])
         """
 
-        user_id = db.set_user(user_info)
+        user_id = await db.set_user(user_info)
         return user_id
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
 @app.post("/update_user/")
 async def update_user(
+    info: Request,
     file: UploadFile = File(None),
     token: str = Form(""),
     publicAddress: str = Form(""),
@@ -217,15 +366,16 @@ async def update_user(
             with open(f"./user_images/{file.filename}", "wb") as f:
                 f.write(contents)
 
-            image_url = db.profile_image_upload(file.filename)
+            image_url = await db.profile_image_upload(file.filename)
 
             user_info["image"] = image_url
 
-        user_id = db.update_user(user_info, user_info["token"])
+        await authenticate(info, token)
+        user_id = await db.update_user(user_info, user_info["token"])
         return user_id
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -241,11 +391,11 @@ async def update_user_type(info: Request) -> dict:
             "publicAddress": req["publicAddress"],
             "userType": req["userType"],
         }
-        user_id = db.update_user_type(user_info)
+        user_id = await db.update_user_type(user_info)
         return user_id
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -264,11 +414,11 @@ async def update_seller(info: Request) -> dict:
             "email": req["email"],
             "companyLink": req["companyLink"],
         }
-        seller_id = db.update_seller(seller_info)
+        seller_id = await db.update_seller(seller_info)
         return seller_id
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -331,11 +481,11 @@ async def create_horse(info: Request) -> dict:
             "raceCount": 0,
         }
 
-        horse_id = db.create_horse(horse_info)
+        horse_id = await db.create_horse(horse_info)
         return horse_id
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -352,10 +502,10 @@ async def allow_horse(info: Request) -> dict:
             "horseId": req["horseId"],
         }
         # add horse to user (myHorses) & update horse
-        horse = db.allow_horse(horse)
+        horse = await db.allow_horse(horse)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -368,10 +518,10 @@ async def reject_horse(info: Request) -> dict:
     try:
         req = await info.json()
         horseId = req["horseId"]
-        horse = db.reject_horse(horseId)
+        horse = await db.reject_horse(horseId)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -387,11 +537,11 @@ async def update_account_settings(info: Request) -> dict:
             "publicAddress": req["publicAddress"],
             "notifications": req["notifications"],
         }
-        db.update_account_settings(account_settings)
+        await db.update_account_settings(account_settings)
         return True
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -406,16 +556,17 @@ async def put_on_sale(info: Request) -> dict:
         horse_id = req["horseId"]
         public_address = req["publicAddress"]
         token = req["token"]
+        await authenticate(info, token)
         sale_info = {
             "sellerAddress": public_address,
             "price": req["price"],
             "onMarket": int(req["onMarket"]),
         }
         # add horse to user (myHorses) & update horse
-        horse = db.put_on_sale(int(horse_id), public_address, sale_info, token)
+        horse = await db.put_on_sale(int(horse_id), public_address, sale_info, token)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -436,7 +587,7 @@ async def buy_horse(info: Request) -> dict:
         saleId = req["saleId"]
 
         # add horse to user (myHorses) & update horse
-        horse = db.buy_horse(
+        horse = await db.buy_horse(
             int(horse_id),
             buyer_public_address,
             seller_public_address,
@@ -445,10 +596,9 @@ async def buy_horse(info: Request) -> dict:
             totalAmount,
             saleId,
         )
-        print(horse)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -463,10 +613,10 @@ async def remove_from_sale(info: Request) -> dict:
         horse_id = req["horseId"]
         public_address = req["publicAddress"]
         # add horse to user (myHorses) & supdate horse
-        horse = db.remove_from_sale(int(horse_id), public_address)
+        horse = await db.remove_from_sale(int(horse_id), public_address)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -497,11 +647,11 @@ async def put_on_auction(info: Request) -> dict:
             "bidHistory": [],
         }
 
-        horse = db.put_on_auction(int(horse_id), public_address, auction_info)
+        horse = await db.put_on_auction(int(horse_id), public_address, auction_info)
         return horse
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -517,10 +667,11 @@ async def end_auction(info: Request) -> dict:
         buyer = req["buyer"]
         seller = req["seller"]
         token = req["token"]
-        horse = db.end_auction(int(horse_id), buyer, seller, token)
+        await authenticate(info, token)
+        horse = await db.end_auction(int(horse_id), buyer, seller, token)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -534,10 +685,10 @@ async def remove_from_auction(info: Request) -> dict:
         req = await info.json()
         horse_id = req["horseId"]
         public_address = req["publicAddress"]
-        horse = db.remove_from_auction(int(horse_id), public_address)
+        horse = await db.remove_from_auction(int(horse_id), public_address)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -555,11 +706,11 @@ async def place_a_bid(info: Request) -> dict:
             "bidAmount": req["bidAmount"],
         }
 
-        horse = db.place_a_bid(int(horse_id), public_address, bid_info)
+        horse = await db.place_a_bid(int(horse_id), public_address, bid_info)
         return horse
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -578,11 +729,11 @@ async def make_offer(info: Request) -> dict:
             "ps": "100",
         }
 
-        horse = db.make_offer(int(horse_id), public_address, offer_info)
+        horse = await db.make_offer(int(horse_id), public_address, offer_info)
         return horse
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -597,10 +748,11 @@ async def cancel_a_bid(info: Request) -> dict:
         horse_id = req["horseId"]
         public_address = req["publicAddress"]
         token = req["token"]
-        horse = db.cancel_a_bid(int(horse_id), public_address, token)
+        await authenticate(info, token)
+        horse = await db.cancel_a_bid(int(horse_id), public_address, token)
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -617,12 +769,12 @@ async def accept_a_bid(info: Request) -> dict:
         buyer_address = req["buyerAddress"]  # seller
         bid_amount = req["bidAmount"]
 
-        horse = db.accept_a_bid(
+        horse = await db.accept_a_bid(
             int(horse_id), public_address, buyer_address, bid_amount
         )
         return horse
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -637,11 +789,11 @@ async def get_user(info: Request) -> dict:
         user_info = {
             "publicAddress": req["publicAddress"],
         }
-        user = db.get_user(user_info)
+        user = await db.get_user(user_info)
         return user
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
     """
@@ -653,7 +805,7 @@ async def get_user(info: Request) -> dict:
         return response
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -664,12 +816,12 @@ async def user_check(info: Request):
     """
     try:
         req = await info.json()
-        user_check = db.user_check(req["publicAddress"])
+        user_check = await db.user_check(req["publicAddress"])
 
         return user_check
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -680,29 +832,34 @@ async def horse_check(info: Request):
     """
     try:
         req = await info.json()
-        horse_check = db.horse_exists(req["horseId"])
+        horse_check = await db.horse_exists(req["horseId"])
 
         return horse_check
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
 @app.post("/get_horse/")
-async def get_horse(info: Request) -> dict:
+async def get_horse(info: Request, response: Response) -> dict:
     """
-    :param info: the horse information to get
-    :return: the horse information that was requested
+    :param info: the horse information to get, If-None-Match may hold the
+    ETag of a previous response
+    :return: the horse information that was requested, 304 if unchanged
     """
     try:
         req = await info.json()
 
-        horse = db.get_horse(req["horseId"])
-        return horse
+        horse = await db.get_horse(
+            req["horseId"],
+            req.get("publicAddress"),
+            info.headers.get("If-None-Match"),
+        )
+        return conditional_response(horse, response, "/get_horse/")
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -715,26 +872,98 @@ async def get_horse(info: Request) -> dict:
     try:
         req = await info.json()
 
-        horse = db.get_horse_by_sale_id(req["horseId"], req["saleId"])
+        horse = await db.get_horse_by_sale_id(req["horseId"], req["saleId"])
         return horse
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
 @app.get("/get_horses/")
-async def get_horses(info: Request) -> dict:
+async def get_horses(
+    info: Request,
+    response: Response,
+    limit: int = None,
+    cursor: str = None,
+    status: int = None,
+) -> dict:
+    """
+    :param limit: page size, pass it (or cursor) to get one page of horses
+    :param cursor: the nextCursor of the previous page
+    :param status: only list horses with this status
+    :return: the horse information that was requested, 304 if unchanged since
+    the response whose ETag is in If-None-Match
     """
-    :return: the horse information that was requested
+    try:
+        if_none_match = info.headers.get("If-None-Match")
+        if limit is not None or cursor is not None or status is not None:
+            horses = await db.get_horses_page(limit, cursor, status, if_none_match)
+        else:
+            horses = await db.get_horses(if_none_match)
+
+        return conditional_response(horses, response, "/get_horses/")
+
+    except Exception as e:
+        logger.error(e)
+        return e
+
+
+@app.get("/listings/")
+async def listings(
+    info: Request,
+    response: Response,
+    status: int = None,
+    sort: str = None,
+    limit: int = None,
+    cursor: str = None,
+):
+    """
+    :param status: 3 for horses on sale, 4 for horses on auction, None for both
+    :param sort: price, highestBid, deadline or sharesOnMarket, "-" prefixed
+    for descending; None lists horses in the order they were listed
+    :param limit: the page size
+    :param cursor: the nextCursor of the previous page
+    :return: a page of compact horse summaries for the marketplace, 304 if
+    unchanged since the response whose ETag is in If-None-Match
     """
     try:
-        horses = db.get_horses()
-        print(horses)
-        return horses
+        page = await db.get_listings(
+            status, sort, limit, cursor, info.headers.get("If-None-Match")
+        )
+        return conditional_response(page, response, "/listings/")
+
+    except Exception as e:
+        logger.error(e)
+        return e
+
+
+@app.get("/export_horses/")
+async def export_horses(info: Request):
+    """
+    :return: every horse as newline delimited JSON, streamed in batches
+    """
+    try:
+        chunks = await db.export_collection("horses")
+        return StreamingResponse(chunks, media_type=NDJSON_MEDIA_TYPE)
+
+    except Exception as e:
+        logger.error(e)
+        return e
+
+
+@app.get("/export_users/")
+async def export_users(info: Request):
+    """
+    :return: every user (without nonce) as newline delimited JSON, streamed in
+    batches
+    """
+    try:
+        chunks = await db.export_collection("users")
+        return StreamingResponse(chunks, media_type=NDJSON_MEDIA_TYPE)
 
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         return e
 
 
@@ -745,7 +974,24 @@ async def users_signature(info: Request):
     """
     try:
         req = await info.json()
-        response = db.users_signature(req["publicAddress"], req["signature"])
+        response = await db.users_signature(req["publicAddress"], req["signature"])
+        return response
+
+    except Exception as e:
+        return e
+
+
+@app.post("/verify_signatures")
+@db.jwt_check_decorator
+async def verify_signatures(info: Request):
+    """
+    :param token: the token of the admin
+    :param items: the publicAddress, message and signature of each signed
+    message to check
+    """
+    try:
+        req = await info.json()
+        response = await db.verify_signatures(req["items"])
         return response
 
     except Exception as e:
@@ -759,6 +1005,7 @@ async def verify(info: Request):
     """
     try:
         req = await info.json()
+        await authenticate(info, req["token"])
         response = db.verify(req["token"])
         return response
 
@@ -766,6 +1013,24 @@ async def verify(info: Request):
         return e
 
 
+@app.post("/logout")
+async def logout(info: Request):
+    """
+    :param token: the token of the user, refused from now on
+    :return: "shared" is False when no shared store (REDIS_URL) is configured:
+    the token is then refused by this worker only, the other workers and
+    instances accept it until it expires
+    """
+    try:
+        req = await info.json()
+        response = await db.revoke_token(req["token"])
+        return response
+
+    except Exception as e:
+        logger.error(e)
+        return e
+
+
 @app.get("/get_emails")
 # @db.jwt_check_decorator
 
@@ -775,7 +1040,7 @@ async def get_emails(info: Request):
     :param token: the token of the user
     """
     try:
-        emails = db.get_email_subscription_list()
+        emails = await db.get_email_subscription_list()
         return emails
 
     except Exception as e:
@@ -792,13 +1057,38 @@ async def set_email(info: Request):
     """
     try:
         req = await info.json()
-        response = db.add_email_subscription(req["email"])
+        response = await db.add_email_subscription(req["email"])
         return response
 
     except Exception as e:
         return e
 
 
+@app.post("/db_stats/")
+@db.jwt_check_decorator
+async def db_stats(info: Request):
+    """
+    :param token: the token of the admin
+    :return: runtime statistics of the data layer (thread pool queues, ...)
+    """
+    try:
+        return db.get_stats()
+
+    except Exception as e:
+        logger.error(e)
+        return e
+
+
+@app.get("/metrics")
+async def metrics(info: Request):
+    """
+    :return: the metrics of this process in the Prometheus text format
+    """
+    return Response(
+        generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
 # Testing the API Rate Limit Function
 @app.get("/rate_limit")
 async def rate_limit(info: Request):
@@ -807,7 +1097,7 @@ async def rate_limit(info: Request):
     """
     try:
         user_ip = info.client.host
-        response = db.ip_rate_limit(user_ip)
+        response = await db.ip_rate_limit(user_ip)
 
         if response.status_code == 200:
             return True
@@ -829,7 +1119,7 @@ async def create_upload_file(file: UploadFile = File(...), token: str = Form(...
         with open(f"./user_images/{file.filename}", "wb") as f:
             f.write(contents)
 
-        image_url = db.profile_image_upload(file.filename)
+        image_url = await db.profile_image_upload(file.filename)
 
         return {"filename": file.filename, "image_url": image_url, "token": token}
 
@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import inspect
+import logging
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from document_cache import argument_values
+
+logger = logging.getLogger(__name__)
+
+# "auto" trusts the filters once the change feed keeps them current with the
+# inserts of other workers, "on" also without a feed, for a single writer
+MEMBERSHIP_FILTERS = os.environ.get("MEMBERSHIP_FILTERS", "auto")
+
+# keys a filter is sized for, and the false positive rate it then has; past
+# its capacity a filter still works, with a growing false positive rate
+MEMBERSHIP_CAPACITY = int(os.environ.get("MEMBERSHIP_CAPACITY", 1000000))
+MEMBERSHIP_ERROR_RATE = float(os.environ.get("MEMBERSHIP_ERROR_RATE", 0.001))
+
+# keys read per batch while a filter is built
+MEMBERSHIP_BUILD_BATCH_SIZE = 10000
+
+
+def member_key(value):
+    """
+    :param value: a key as queried, e.g. a horseId or a publicAddress
+    :return: the bytes the filter knows it by, None for values it cannot
+    hold; numbers equal to MongoDB, like 1 and 1.0, have the same bytes
+    """
+    if isinstance(value, str):
+        return b"s:" + value.encode()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return b"n:" + repr(value).encode()
+
+    return None
+
+
+class BloomFilter:
+    """
+    A set of keys that may answer "present" for a key never added, at about
+    error_rate once capacity keys are in, but never "absent" for one added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: bytes):
+        # double hashing: the k positions out of a single digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: bytes):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+    def false_positive_rate(self) -> float:
+        """
+        :return: the expected false positive rate with the keys added so far
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class MembershipFilter:
+    """
+    The keys of the documents of one collection, held in a BloomFilter so a
+    key that is absent is known to be without a query. The filter is built
+    by reading every key and kept current by the inserts of this process and,
+    through the change feed, of the others; it answers only once built, and
+    stops answering when the feed missed changes, until built again.
+    Deleted documents stay in the filter, their keys are simply queried.
+    """
+
+    def __init__(
+        self,
+        collection: str,
+        key: str,
+        capacity: int = MEMBERSHIP_CAPACITY,
+        error_rate: float = MEMBERSHIP_ERROR_RATE,
+    ):
+        self.collection = collection
+        self.key = key
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.ready = False
+        self.builds = 0
+        self.build_time = 0.0
+        self.checks = 0
+        self.negatives = 0
+
+    def begin(self) -> BloomFilter:
+        """
+        :return: a new, empty filter, which the keys added from now on go to
+        """
+        with self.lock:
+            self.bloom = BloomFilter(self.capacity, self.error_rate)
+            self.ready = False
+
+            return self.bloom
+
+    def finish(self, bloom: BloomFilter, started_at: float):
+        with self.lock:
+            # a build begun later replaced it, that one will finish
+            if self.bloom is bloom:
+                self.ready = True
+                self.builds += 1
+                self.build_time = time.perf_counter() - started_at
+
+    def invalidate(self):
+        with self.lock:
+            self.ready = False
+
+    def add(self, value):
+        key = member_key(value)
+        if key is not None:
+            with self.lock:
+                if self.bloom is not None:
+                    self.bloom.add(key)
+
+    def excludes(self, value) -> bool:
+        """
+        :param value: a key as queried
+        :return: True if no document has that key, False if one may have it
+        """
+        key = member_key(value)
+        with self.lock:
+            if not self.ready or key is None:
+                return False
+
+            self.checks += 1
+            if key in self.bloom:
+                return False
+
+            self.negatives += 1
+            return True
+
+    def cursor(self, database):
+        return (
+            database[self.collection]
+            .find({}, {"_id": 0, self.key: 1})
+            .batch_size(MEMBERSHIP_BUILD_BATCH_SIZE)
+        )
+
+    async def build(self, database) -> int:
+        """
+        :param database: the database holding the collection
+        :return: the number of documents read
+        """
+        started_at = time.perf_counter()
+        bloom = self.begin()
+        documents = 0
+        async for document in self.cursor(database):
+            key = member_key(document.get(self.key))
+            if key is not None:
+                with self.lock:
+                    bloom.add(key)
+            documents += 1
+        self.finish(bloom, started_at)
+
+        return documents
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "capacity": self.capacity,
+                "error_rate": self.error_rate,
+                "members": self.bloom.count if self.bloom else 0,
+                "memory_bytes": len(self.bloom.bits) if self.bloom else 0,
+                "hashes": self.bloom.hashes if self.bloom else 0,
+                "false_positive_rate": self.bloom.false_positive_rate()
+                if self.bloom
+                else 0.0,
+                "checks": self.checks,
+                "negatives": self.negatives,
+                "builds": self.builds,
+                "build_time_ms": self.build_time * 1000,
+            }
+
+
+user_filter = MembershipFilter("users", "publicAddress")
+horse_filter = MembershipFilter("horses", "horseId")
+
+filters = {"users": user_filter, "horses": horse_filter}
+
+
+def filters_enabled() -> bool:
+    return MEMBERSHIP_FILTERS in ("auto", "on")
+
+
+def filters_ready() -> bool:
+    return all(f.ready for f in filters.values())
+
+
+async def build_filters(database) -> dict:
+    """
+    :param database: the database holding horses and users
+    :return: the number of documents read per collection
+    """
+    counts = {name: await f.build(database) for name, f in filters.items()}
+    logger.info("Membership filters built from %s.", counts)
+
+    return counts
+
+
+def invalidate_filters():
+    for f in filters.values():
+        f.invalidate()
+
+
+def adds_members(horses: tuple = (), users: tuple = ()):
+    """
+    Adds the keys of the horses and users a DbWrapper method inserts to the
+    filters once it returns, whether it succeeded or not: a key that was not
+    inserted only costs a query.
+
+    :param horses: the arguments holding the ids of the horses inserted, as
+    "name" or "name.key" for a key of a dict argument
+    :param users: the same for the public addresses of the users inserted
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def add(args, kwargs):
+            for f, paths in ((horse_filter, horses), (user_filter, users)):
+                for value in argument_values(signature, args, kwargs, paths):
+                    f.add(value)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                add(args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the false positive rate and size of a filter."
+    )
+    parser.add_argument("--members", type=int, default=MEMBERSHIP_CAPACITY)
+    parser.add_argument("--error-rate", type=float, default=MEMBERSHIP_ERROR_RATE)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    check = MembershipFilter("check", "key", args.members, args.error_rate)
+    bloom = check.begin()
+    for i in range(args.members):
+        bloom.add(member_key(f"0x{i:040x}"))
+    check.finish(bloom, time.perf_counter())
+
+    missed = sum(check.excludes(f"0x{i:040x}") for i in range(args.lookups))
+    started_at = time.perf_counter()
+    positives = sum(
+        not check.excludes(f"0x{i:040x}")
+        for i in range(args.members, args.members + args.lookups)
+    )
+    elapsed = time.perf_counter() - started_at
+
+    print(
+        {
+            "members_missed": missed,
+            "observed_false_positive_rate": positives / args.lookups,
+            "check_us": elapsed / args.lookups * 1e6,
+            "filter": check.as_dict(),
+        }
+    )
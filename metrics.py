@@ -0,0 +1,335 @@
+import asyncio
+import time
+from functools import wraps
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+)
+
+from document_cache import caches
+from membership import filters
+from mongo_client import pool_metrics
+from query_metrics import LATENCY_BUCKETS_MS, command_metrics
+from shared_store import shared_store
+from versioning import contention
+
+# how often the event loop lag is sampled, in seconds
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# route label of requests that matched no route, so unknown paths do not
+# create a new time series each
+UNMATCHED_ROUTE = "unmatched"
+
+# the metrics of this process; with several workers each one exports its own
+registry = CollectorRegistry()
+
+http_requests = Counter(
+    "http_requests_total",
+    "HTTP requests served, by route, method and status code.",
+    ["route", "method", "status"],
+    registry=registry,
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving HTTP requests, by route.",
+    ["route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=registry,
+)
+http_request_errors = Counter(
+    "http_request_errors_total",
+    "HTTP requests that failed with a server error or an exception, by route.",
+    ["route"],
+    registry=registry,
+)
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop wakes up a sleeping task.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    registry=registry,
+)
+rate_limit_decisions = Counter(
+    "rate_limit_decisions_total",
+    "Decisions of the IP rate limiter.",
+    ["decision"],
+    registry=registry,
+)
+upload_duration = Histogram(
+    "upload_duration_seconds",
+    "Time spent uploading images, by storage service.",
+    ["service"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    registry=registry,
+)
+upload_failures = Counter(
+    "upload_failures_total",
+    "Image uploads that failed, by storage service.",
+    ["service"],
+    registry=registry,
+)
+bids_placed = Counter(
+    "bids_placed_total", "Bids placed on auctions.", registry=registry
+)
+auctions_ended = Counter(
+    "auctions_ended_total", "Auctions ended with a winner.", registry=registry
+)
+purchases_settled = Counter(
+    "purchases_settled_total", "Share purchases settled.", registry=registry
+)
+compressed_responses = Counter(
+    "http_compressed_responses_total",
+    "Responses sent compressed, by content encoding.",
+    ["encoding"],
+    registry=registry,
+)
+compression_bytes = Counter(
+    "http_compression_bytes_total",
+    "Bytes of the compressed responses, before (identity) and after (encoded).",
+    ["encoding", "stage"],
+    registry=registry,
+)
+compression_variants = Counter(
+    "http_compression_variants_total",
+    "Lookups of compressed catalogue responses kept by ETag, by result.",
+    ["result"],
+    registry=registry,
+)
+in_flight_requests = Gauge(
+    "http_requests_in_flight", "HTTP requests being served.", registry=registry
+)
+
+
+def observe_request(
+    route: str, method: str, status: int, duration: float, failed: bool = False
+):
+    """
+    :param route: the route that served the request, None if none matched
+    :param status: the status code of the response, 500 if it raised
+    :param duration: the time spent serving it, in seconds
+    :param failed: True if the route answered a failure with another status
+    """
+    route = route or UNMATCHED_ROUTE
+    http_requests.labels(route, method, str(status)).inc()
+    http_request_duration.labels(route).observe(duration)
+    if status >= 500 or failed:
+        http_request_errors.labels(route).inc()
+
+
+async def monitor_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    """
+    Sleeps for interval over and over and records how much later than asked
+    the loop woke up; blocking calls on the loop show up as lag.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(loop.time() - started_at - interval, 0.0))
+
+
+def rate_limit_decision(response) -> str:
+    """
+    :param response: what ip_rate_limit returned
+    :return: "allowed", "limited" or "error"
+    """
+    status_code = getattr(response, "status_code", None)
+    if status_code == 200:
+        return "allowed"
+    if status_code == 429:
+        return "limited"
+
+    return "error"
+
+
+def counts_rate_limit(func):
+    """
+    Counts the decisions of an ip_rate_limit method.
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        response = await func(*args, **kwargs)
+        rate_limit_decisions.labels(rate_limit_decision(response)).inc()
+        return response
+
+    return wrapper
+
+
+def times_upload(service: str):
+    """
+    Times a blocking upload method; the upload methods report failures by
+    returning an exception rather than raising it.
+
+    :param service: the storage service the method uploads to
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            result = func(*args, **kwargs)
+            upload_duration.labels(service).observe(time.perf_counter() - started_at)
+            if isinstance(result, Exception):
+                upload_failures.labels(service).inc()
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class DataLayerCollector:
+    """
+    Exports the statistics the data layer already keeps (connection pool,
+    per-route MongoDB commands, write contention, document caches) when
+    scraped, so they cost nothing on the request path.
+    """
+
+    def collect(self):
+        pool = pool_metrics.as_dict()
+
+        checkouts = CounterMetricFamily(
+            "mongodb_pool_checkouts",
+            "Connections checked out of the MongoDB pool, by outcome.",
+            labels=["outcome"],
+        )
+        checkouts.add_metric(["success"], pool["checkouts"])
+        checkouts.add_metric(["failure"], pool["checkout_failures"])
+        checkouts.add_metric(["timeout"], pool["checkout_timeouts"])
+        yield checkouts
+
+        yield GaugeMetricFamily(
+            "mongodb_pool_checked_out",
+            "Connections currently checked out of the MongoDB pool.",
+            value=pool["checked_out"],
+        )
+        yield GaugeMetricFamily(
+            "mongodb_pool_connections",
+            "Open connections of the MongoDB pool.",
+            value=pool["connections"],
+        )
+        yield GaugeMetricFamily(
+            "mongodb_pool_wait_max_seconds",
+            "Longest wait for a MongoDB connection since start.",
+            value=pool["wait_time_max_ms"] / 1000,
+        )
+        yield CounterMetricFamily(
+            "mongodb_pool_cleared",
+            "Times the MongoDB pool was cleared.",
+            value=pool["pools_cleared"],
+        )
+
+        duration = HistogramMetricFamily(
+            "mongodb_command_duration_seconds",
+            "Duration of MongoDB commands, by the route that issued them.",
+            labels=["route"],
+        )
+        commands = CounterMetricFamily(
+            "mongodb_commands",
+            "MongoDB commands, by route, operation and collection.",
+            labels=["route", "operation"],
+        )
+        for route, stats in command_metrics.as_dict()["routes"].items():
+            buckets, count = [], 0
+            for bound, bucket in zip(
+                [str(bound / 1000) for bound in LATENCY_BUCKETS_MS] + ["+Inf"],
+                stats["histogram_ms"].values(),
+            ):
+                count += bucket
+                buckets.append((bound, count))
+            duration.add_metric(
+                [route],
+                buckets,
+                stats["duration_avg_ms"] * stats["commands"] / 1000,
+            )
+            for operation, operation_stats in stats["operations"].items():
+                commands.add_metric([route, operation], operation_stats["count"])
+        yield duration
+        yield commands
+
+        writes = CounterMetricFamily(
+            "versioned_writes",
+            "Versioned writes, by operation.",
+            labels=["operation"],
+        )
+        conflicts = CounterMetricFamily(
+            "versioned_write_conflicts",
+            "Version conflicts met by writes, by operation.",
+            labels=["operation"],
+        )
+        for operation, stats in contention.as_dict().items():
+            writes.add_metric([operation], stats["writes"])
+            conflicts.add_metric([operation], stats["conflicts"])
+        yield writes
+        yield conflicts
+
+        lookups = CounterMetricFamily(
+            "document_cache_lookups",
+            "Lookups of the horse and user caches, by result.",
+            labels=["cache", "result"],
+        )
+        size = GaugeMetricFamily(
+            "document_cache_size",
+            "Documents held by the horse and user caches.",
+            labels=["cache"],
+        )
+        invalidations = CounterMetricFamily(
+            "document_cache_invalidations",
+            "Cache entries dropped because the document was written.",
+            labels=["cache"],
+        )
+        for name, cache in caches.items():
+            stats = cache.as_dict()
+            lookups.add_metric([name, "hit"], stats["hits"])
+            lookups.add_metric([name, "miss"], stats["misses"])
+            if "size" in stats:
+                # the size of a shared cache is not known to the process
+                size.add_metric([name], stats["size"])
+            invalidations.add_metric([name], stats["invalidations"])
+        yield lookups
+        yield size
+        yield invalidations
+
+        checks = CounterMetricFamily(
+            "membership_filter_checks",
+            "Existence checks of the membership filters, by result.",
+            labels=["filter", "result"],
+        )
+        false_positives = GaugeMetricFamily(
+            "membership_filter_false_positive_rate",
+            "Expected false positive rate of the filters at their current fill.",
+            labels=["filter"],
+        )
+        memory = GaugeMetricFamily(
+            "membership_filter_bytes",
+            "Memory held by the bits of the filters.",
+            labels=["filter"],
+        )
+        for name, member_filter in filters.items():
+            stats = member_filter.as_dict()
+            checks.add_metric([name, "absent"], stats["negatives"])
+            checks.add_metric([name, "maybe"], stats["checks"] - stats["negatives"])
+            false_positives.add_metric([name], stats["false_positive_rate"])
+            memory.add_metric([name], stats["memory_bytes"])
+        yield checks
+        yield false_positives
+        yield memory
+
+        if shared_store is not None:
+            stats = shared_store.as_dict()
+            yield CounterMetricFamily(
+                "shared_store_round_trips",
+                "Round trips to the shared store.",
+                value=stats["round_trips"],
+            )
+            yield CounterMetricFamily(
+                "shared_store_errors",
+                "Round trips to the shared store that failed.",
+                value=stats["errors"],
+            )
+
+
+registry.register(DataLayerCollector())
@@ -0,0 +1,167 @@
+import importlib.util
+import logging
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+from query_metrics import command_metrics
+
+logger = logging.getLogger(__name__)
+
+# MongoClient options read from the environment, with the defaults used when
+# a variable is not set
+CLIENT_SETTINGS = {
+    "maxPoolSize": ("MONGODB_MAX_POOL_SIZE", int, 100),
+    "minPoolSize": ("MONGODB_MIN_POOL_SIZE", int, 0),
+    "maxIdleTimeMS": ("MONGODB_MAX_IDLE_TIME_MS", int, None),
+    "waitQueueTimeoutMS": ("MONGODB_WAIT_QUEUE_TIMEOUT_MS", int, 2000),
+    "serverSelectionTimeoutMS": ("MONGODB_SERVER_SELECTION_TIMEOUT_MS", int, 5000),
+    "connectTimeoutMS": ("MONGODB_CONNECT_TIMEOUT_MS", int, 5000),
+    "socketTimeoutMS": ("MONGODB_SOCKET_TIMEOUT_MS", int, 10000),
+    "retryReads": ("MONGODB_RETRY_READS", "bool", True),
+    "retryWrites": ("MONGODB_RETRY_WRITES", "bool", True),
+}
+
+# wire compressors in order of preference and the module each one needs
+COMPRESSORS = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+
+def available_compressors(requested: str) -> list:
+    """
+    :param requested: comma separated compressor names, e.g. "zstd,snappy,zlib"
+    :return: the requested compressors whose library is installed
+    """
+    compressors = []
+    for name in filter(None, (n.strip() for n in requested.split(","))):
+        if name not in COMPRESSORS:
+            logger.warning("Unknown MongoDB compressor %s is ignored.", name)
+        elif importlib.util.find_spec(COMPRESSORS[name]) is None:
+            logger.warning("MongoDB compressor %s is not installed.", name)
+        else:
+            compressors.append(name)
+
+    return compressors
+
+
+def client_settings() -> dict:
+    """
+    :return: the keyword arguments of MongoClient / AsyncIOMotorClient
+    """
+    settings = {}
+    for option, (variable, kind, default) in CLIENT_SETTINGS.items():
+        value = os.environ.get(variable)
+        if value is None:
+            value = default
+        elif kind == "bool":
+            value = value.lower() in ("1", "true", "yes")
+        else:
+            value = kind(value)
+
+        if value is not None:
+            settings[option] = value
+
+    compressors = available_compressors(
+        os.environ.get("MONGODB_COMPRESSORS", "zstd,zlib")
+    )
+    if compressors:
+        settings["compressors"] = compressors
+
+    settings["event_listeners"] = [pool_metrics, command_metrics]
+
+    return settings
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Measures how long operations wait to check a connection out of the pool,
+    so slow requests can be told apart from a slow server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # checkout start and end are published on the thread doing the checkout
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checkout_timeouts = 0
+            self.wait_time_total = 0.0
+            self.wait_time_max = 0.0
+            self.checked_out = 0
+            self.connections = 0
+            self.pools_cleared = 0
+
+    def waited(self) -> float:
+        started_at = getattr(self.local, "started_at", None)
+        self.local.started_at = None
+
+        return time.monotonic() - started_at if started_at is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self.local.started_at = time.monotonic()
+
+    def connection_checked_out(self, event):
+        wait_time = self.waited()
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def connection_check_out_failed(self, event):
+        wait_time = self.waited()
+        with self.lock:
+            self.checkout_failures += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                self.checkout_timeouts += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.connections -= 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pools_cleared += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            attempts = self.checkouts + self.checkout_failures
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checked_out": self.checked_out,
+                "connections": self.connections,
+                "pools_cleared": self.pools_cleared,
+                "wait_time_avg_ms": self.wait_time_total / attempts * 1000
+                if attempts
+                else 0.0,
+                "wait_time_max_ms": self.wait_time_max * 1000,
+            }
+
+
+pool_metrics = PoolMetrics()
@@ -0,0 +1,113 @@
+import base64
+import json
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(document: dict, sort_field: str = None) -> str:
+    """
+    :param document: the last document of a page
+    :param sort_field: the field the pages are sorted by before _id, if any
+    :return: an opaque cursor pointing right after the document
+    """
+    payload = {"id": str(document["_id"])}
+    if sort_field is not None:
+        payload["value"] = document.get(sort_field)
+    payload = json.dumps(payload).encode()
+
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_sorted_cursor(cursor: str) -> tuple:
+    """
+    :param cursor: a cursor returned by encode_cursor
+    :return: the _id and the sort value the next page starts after
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        return ObjectId(payload["id"]), payload.get("value")
+
+    except (ValueError, TypeError, KeyError, InvalidId):
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    """
+    :param cursor: a cursor returned by encode_cursor
+    :return: the _id the next page starts after
+    """
+    return decode_sorted_cursor(cursor)[0]
+
+
+def page_limit(limit: int = None) -> int:
+    """
+    :param limit: the requested page size
+    :return: the page size clamped to 1..MAX_PAGE_SIZE
+    """
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def page_filter(cursor: str = None, filters: dict = None) -> dict:
+    """
+    :param cursor: the cursor of the previous page, None for the first page
+    :param filters: extra equality filters, None values are ignored
+    :return: the find() filter of the page
+    """
+    query = {key: value for key, value in (filters or {}).items() if value is not None}
+
+    if cursor:
+        query["_id"] = {"$gt": decode_cursor(cursor)}
+
+    return query
+
+
+def sorted_page_filter(
+    cursor: str, filters: dict, sort_field: str, descending: bool = False
+) -> dict:
+    """
+    :param cursor: the cursor of the previous page, None for the first page
+    :param filters: extra equality filters, None values are ignored
+    :param sort_field: the numeric field the pages are sorted by, then by _id;
+    documents without a number there are left out
+    :param descending: True if both sort in descending order
+    :return: the find() filter of the page
+    """
+    query = page_filter(None, filters)
+    query[sort_field] = {"$type": "number"}
+
+    if cursor:
+        last_id, value = decode_sorted_cursor(cursor)
+        after = "$lt" if descending else "$gt"
+        query["$or"] = [
+            {sort_field: {after: value}},
+            {sort_field: value, "_id": {after: last_id}},
+        ]
+
+    return query
+
+
+def page_detail(documents: list, limit: int, sort_field: str = None) -> dict:
+    """
+    :param documents: up to limit + 1 documents sorted by _id, or by
+    sort_field then _id
+    :param limit: the page size
+    :return: the page and the cursor of the next one (None on the last page)
+    """
+    items = documents[:limit]
+    next_cursor = None
+    if len(documents) > limit:
+        next_cursor = encode_cursor(items[-1], sort_field)
+
+    return {"items": items, "nextCursor": next_cursor}
@@ -0,0 +1,227 @@
+from datetime import datetime
+
+from versioning import WriteRejected
+
+# The plans of the listing, auction, bid and offer writes and of the user
+# documents they touch. A plan takes the document update_versioned read and
+# returns its update (None when there is nothing to write), or raises
+# WriteRejected; a check only raises.
+
+
+def plan_listing(user: dict, horse_id: int, status: int) -> dict:
+    """
+    :param user: the owner putting the horse on sale or on auction
+    :param status: 3 for on sale, 4 for on auction
+    :return: the update of the owner's myHorses entry and nonce
+    """
+    for index, my_horse in enumerate(user["myHorses"]):
+        if my_horse["horseId"] == horse_id:
+            break
+    else:
+        raise WriteRejected(401, "User does not own horse")
+
+    if my_horse["status"] == 3:
+        raise WriteRejected(401, "Horse already on sale")
+    if my_horse["status"] == 4:
+        raise WriteRejected(401, "Horse already on auction")
+
+    return {
+        "$set": {
+            "nonce": user["nonce"] + 1,
+            "myHorses." + str(index) + ".status": status,
+        }
+    }
+
+
+def plan_sale(horse: dict, sale_info: dict) -> dict:
+    """
+    :param sale_info: the sale, numbered after the horse's previous sales
+    :return: the update adding the sale to the horse
+    """
+    sale_info["saleId"] = len(horse["saleInfo"])
+    return {"$push": {"saleInfo": dict(sale_info)}}
+
+
+def plan_auction(horse: dict, auction_info: dict) -> dict:
+    """
+    :return: the update starting the auction on the horse
+    """
+    return {"$push": {"auctionInfo": dict(auction_info)}}
+
+
+def plan_take_off_sale(horse: dict, public_address: str) -> dict:
+    # check if horse is owned by user
+    if horse["publicAddress"] != public_address:
+        raise WriteRejected(401, "User does not own horse")
+    # check if horse is already on sale
+    if horse["status"] != 3:
+        raise WriteRejected(401, "Horse not on sale")
+    return {"$set": {"saleInfo": {}, "status": 2}}
+
+
+def plan_take_off_auction(horse: dict, public_address: str) -> dict:
+    if horse["publicAddress"] != public_address:
+        raise WriteRejected(401, "User does not own horse")
+    # check if horse not already on auction
+    if horse["status"] != 4:
+        raise WriteRejected(401, "Horse not on auction")
+    return {
+        "$set": {
+            "status": 2,
+            "auctionInfo." + str(len(horse["auctionInfo"]) - 1) + ".status": "Ended",
+        }
+    }
+
+
+def check_bid_cancellable(horse: dict, bid: dict, public_address: str):
+    """
+    :param bid: the bidder's myBids entry for the horse
+    """
+    if bid["isClaimed"]:
+        raise WriteRejected(401, "Bid has already been claimed")
+    if horse["publicAddress"] == public_address:
+        raise WriteRejected(401, "User is the owner of horse")
+    if horse["auctionInfo"][bid["auctionId"]]["highestBidder"] == public_address:
+        raise WriteRejected(
+            401, "User is the highest bidder, you cannot claim your bid!"
+        )
+
+
+def plan_pull_bid(horse: dict, public_address: str, auction_id: int) -> dict:
+    """
+    :return: the update removing the bidder's bid from the auction
+    """
+    if horse["auctionInfo"][auction_id]["highestBidder"] == public_address:
+        raise WriteRejected(
+            401, "User is the highest bidder, you cannot claim your bid!"
+        )
+    return {
+        "$pull": {
+            "auctionInfo."
+            + str(auction_id)
+            + ".bidHistory": {"bidderAddress": public_address}
+        }
+    }
+
+
+def cancelled_bid_status(deadline: int, now: int) -> str:
+    """
+    :return: Rejected if the auction is over, Cancelled otherwise
+    """
+    return "Rejected" if now > deadline else "Cancelled"
+
+
+def plan_claim_bid(user: dict, horse_id: int, status: str) -> dict:
+    """
+    :param status: the status the claimed bid ends in
+    :return: the update claiming the bidder's bid on the horse
+    """
+    for index, info in enumerate(user["myBids"]):
+        if info["horseId"] == horse_id:
+            if info["isClaimed"]:
+                raise WriteRejected(401, "Bid has already been claimed")
+            return {
+                "$set": {
+                    "myBids." + str(index) + ".isClaimed": True,
+                    "myBids." + str(index) + ".status": status,
+                }
+            }
+
+
+def check_auction_ending(
+    horse: dict, caller: str, seller_public_address: str, now: int
+):
+    """
+    :param caller: the address the request is authenticated as
+    :param now: the current timestamp
+    """
+    auction = horse["auctionInfo"][-1]
+
+    if caller != seller_public_address and (
+        caller != auction["highestBidder"] and (auction["deadline"] + (4 * 60)) > now
+    ):
+        raise WriteRejected(401, "User is not authorized to end auction")
+    if horse["publicAddress"] != seller_public_address:
+        raise WriteRejected(401, "That is not the owner of horse")
+    if horse["status"] != 4:
+        raise WriteRejected(401, "The horse is not on auction")
+    # check if auction is over
+    if auction["deadline"] > now:
+        raise WriteRejected(401, "The auction is not over yet")
+    # check if auction has a winner
+    if auction["highestBidder"] == "":
+        raise WriteRejected(401, "The auction has no winner")
+    # check if auction is already ended
+    if auction["status"] == "Ended":
+        raise WriteRejected(401, "The auction has already ended")
+
+
+def plan_offer(horse: dict, public_address: str, place_info: dict) -> dict:
+    """
+    :param place_info: the offer, dated
+    :return: the update adding the offer to the horse
+    """
+    if horse["publicAddress"] == public_address:
+        raise WriteRejected(401, "User is the owner of horse")
+    # offers are only made on horses neither on sale nor on auction
+    if horse["status"] != 2:
+        raise WriteRejected(401, "The horse is not eligible for an offer")
+    return {"$push": {"offerHistory": dict(place_info)}}
+
+
+def plan_add_my_horse(user: dict, horse_id: int) -> dict:
+    """
+    :return: the update adding the horse to the user's myHorses, None if it
+    is in already
+    """
+    if horse_id in user.get("myHorses", []):
+        return None
+    return {"$push": {"myHorses": horse_id}}
+
+
+def plan_remove_my_horse(user: dict, horse_id: int) -> dict:
+    """
+    :return: the update taking the horse out of the user's myHorses, None if
+    it is not in
+    """
+    if horse_id not in user.get("myHorses", []):
+        return None
+    return {"$pull": {"myHorses": horse_id}}
+
+
+def plan_remove_my_bid(user: dict, horse_id: int) -> dict:
+    """
+    :return: the update taking the horse out of the user's myBids, None if it
+    is not in
+    """
+    if horse_id not in user.get("myBids", []):
+        return None
+    return {"$pull": {"myBids": horse_id}}
+
+
+def plan_pass_horse(
+    horse: dict, public_address: str, buyer_address: str, bid_amount: int
+) -> dict:
+    """
+    :return: the update handing the horse on auction to the buyer
+    """
+    if horse["publicAddress"] != public_address:
+        raise WriteRejected(401, "User is not the owner of horse")
+    # check if horse not already on auction
+    if horse["status"] != 4:
+        raise WriteRejected(401, "Horse not on auction")
+    return {
+        "$set": {
+            "status": 2,
+            "publicAddress": buyer_address,
+            "auctionInfo." + str(len(horse["auctionInfo"]) - 1) + ".status": "passive",
+        },
+        "$push": {
+            "saleHistory": {
+                "seller": public_address,
+                "buyer": buyer_address,
+                "price": bid_amount,
+                "date": datetime.now().strftime("%d/%m/%Y"),
+            }
+        },
+    }
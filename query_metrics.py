@@ -0,0 +1,221 @@
+import logging
+import os
+import threading
+from collections import deque
+
+from pymongo import monitoring
+
+from request_context import current_route
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the command latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# commands slower than this are logged with the shape of their filter
+SLOW_QUERY_MS = float(os.environ.get("MONGODB_SLOW_QUERY_MS", 100))
+
+# number of slow commands kept for get_stats
+SLOW_QUERY_LOG_SIZE = 100
+
+# commands that are not issued on behalf of a route
+UNROUTED = "-"
+
+
+def filter_shape(value):
+    """
+    :param value: a filter, update or pipeline as sent to the server
+    :return: the same structure with every value replaced by "?", so queries
+    differing only in their values share a shape
+    """
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [filter_shape(value[0])] if value else []
+
+    return "?"
+
+
+def command_shape(command_name: str, command: dict):
+    """
+    :param command_name: the name of the command, e.g. "find"
+    :param command: the command document
+    :return: the shape of the command's filter or pipeline, None if it has none
+    """
+    if command_name == "find":
+        return filter_shape(command.get("filter", {}))
+    if command_name == "delete":
+        return filter_shape([d.get("q") for d in command.get("deletes", [])])
+    if command_name == "update":
+        return filter_shape([u.get("q") for u in command.get("updates", [])])
+    if command_name in ("findAndModify", "count", "distinct"):
+        return filter_shape(command.get("query", {}))
+    if command_name == "aggregate":
+        return filter_shape(command.get("pipeline", []))
+
+    return None
+
+
+def command_collection(command_name: str, command: dict):
+    """
+    :return: the collection the command runs on, None for database commands
+    """
+    if command_name == "getMore":
+        return command.get("collection")
+
+    collection = command.get(command_name)
+
+    return collection if isinstance(collection, str) else None
+
+
+class RouteCommands:
+    """
+    Commands issued while serving one route.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.commands = 0
+        self.failures = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        # one count per bucket of LATENCY_BUCKETS_MS, the last one unbounded
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.operations = {}
+
+    def record(self, operation: str, duration: float, failed: bool):
+        self.commands += 1
+        self.failures += 1 if failed else 0
+        self.duration_total += duration
+        self.duration_max = max(self.duration_max, duration)
+
+        bucket = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS_MS) if duration <= bound),
+            len(LATENCY_BUCKETS_MS),
+        )
+        self.buckets[bucket] += 1
+
+        stats = self.operations.setdefault(
+            operation, {"count": 0, "duration_total": 0.0, "duration_max": 0.0}
+        )
+        stats["count"] += 1
+        stats["duration_total"] += duration
+        stats["duration_max"] = max(stats["duration_max"], duration)
+
+    def as_dict(self) -> dict:
+        bounds = [str(bound) for bound in LATENCY_BUCKETS_MS] + ["+Inf"]
+        return {
+            "requests": self.requests,
+            "commands": self.commands,
+            "failures": self.failures,
+            "round_trips_per_request": self.commands / self.requests
+            if self.requests
+            else None,
+            "duration_avg_ms": self.duration_total / self.commands
+            if self.commands
+            else 0.0,
+            "duration_max_ms": self.duration_max,
+            "histogram_ms": dict(zip(bounds, self.buckets)),
+            "operations": {
+                operation: {
+                    "count": stats["count"],
+                    "duration_avg_ms": stats["duration_total"] / stats["count"],
+                    "duration_max_ms": stats["duration_max"],
+                }
+                for operation, stats in self.operations.items()
+            },
+        }
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Times every command sent to MongoDB and attributes it to the FastAPI route
+    that caused it, so a slow endpoint can be traced to the query behind it.
+    """
+
+    def __init__(self, slow_query_ms: float = SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # started commands by (connection, request id), until they finish
+            self.pending = {}
+            self.routes = {}
+            self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def get_route(self, route: str) -> RouteCommands:
+        if route not in self.routes:
+            self.routes[route] = RouteCommands()
+
+        return self.routes[route]
+
+    def record_request(self, route: str):
+        """
+        :param route: a route that finished serving a request
+        """
+        with self.lock:
+            self.get_route(route).requests += 1
+
+    def started(self, event):
+        # runs in the context of the caller, where the route is bound
+        command = {
+            "route": current_route.get() or UNROUTED,
+            "collection": command_collection(event.command_name, event.command),
+            "shape": command_shape(event.command_name, event.command),
+        }
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = command
+
+    def succeeded(self, event):
+        self.finished(event, failed=False)
+
+    def failed(self, event):
+        self.finished(event, failed=True)
+
+    def finished(self, event, failed: bool):
+        duration = event.duration_micros / 1000
+        with self.lock:
+            command = self.pending.pop((event.connection_id, event.request_id), None)
+            if command is None:
+                return
+
+            operation = event.command_name
+            if command["collection"]:
+                operation += " " + command["collection"]
+            self.get_route(command["route"]).record(operation, duration, failed)
+
+            if duration < self.slow_query_ms:
+                return
+
+            self.slow_queries.append(
+                {
+                    "route": command["route"],
+                    "operation": operation,
+                    "shape": command["shape"],
+                    "duration_ms": duration,
+                    "failed": failed,
+                }
+            )
+
+        logger.warning(
+            "Slow MongoDB command %s from %s took %.1f ms, filter %s",
+            operation,
+            command["route"],
+            duration,
+            command["shape"],
+        )
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "slow_query_ms": self.slow_query_ms,
+                "routes": {
+                    route: stats.as_dict() for route, stats in self.routes.items()
+                },
+                "slow_queries": list(self.slow_queries),
+            }
+
+
+command_metrics = CommandMetrics()
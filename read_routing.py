@@ -0,0 +1,150 @@
+import os
+import threading
+from collections import OrderedDict
+
+import bson
+from pymongo.read_preferences import (
+    Primary,
+    make_read_preference,
+    read_pref_mode_from_name,
+)
+
+from shared_store import shared_store
+
+# MongoDB refuses a maxStalenessSeconds below 90
+MIN_MAX_STALENESS_SECONDS = 90
+
+# how long a shared causal clock remembers a user's last write, well beyond
+# how far behind a secondary may be
+CAUSAL_CLOCK_TTL_SECONDS = int(os.environ.get("CAUSAL_CLOCK_TTL_SECONDS", 600))
+
+
+def catalogue_read_preference():
+    """
+    Read preference of the catalogue browsing reads (horses, users, sellers
+    listings and lookups). MONGODB_CATALOGUE_READ_PREFERENCE (default
+    secondaryPreferred) and MONGODB_MAX_STALENESS_SECONDS (default 90) tune it.
+
+    :return: a pymongo read preference
+    """
+    name = os.environ.get("MONGODB_CATALOGUE_READ_PREFERENCE", "secondaryPreferred")
+    mode = read_pref_mode_from_name(name)
+    if mode == Primary.mode:
+        return Primary()
+
+    max_staleness = max(
+        int(os.environ.get("MONGODB_MAX_STALENESS_SECONDS", MIN_MAX_STALENESS_SECONDS)),
+        MIN_MAX_STALENESS_SECONDS,
+    )
+
+    return make_read_preference(mode, None, max_staleness)
+
+
+class CausalClock:
+    """
+    Remembers, per user, the cluster and operation time of their last write.
+    Reads made for that user in a causally consistent session advanced to
+    these times wait until the secondary has replicated the write.
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self.times = OrderedDict()
+        self.lock = threading.Lock()
+
+    def advance(self, session, key: str):
+        """
+        :param session: a causally consistent session about to read for key
+        :param key: the user the read is made for
+        """
+        with self.lock:
+            cluster_time, operation_time = self.times.get(key, (None, None))
+
+        if cluster_time is not None:
+            session.advance_cluster_time(cluster_time)
+        if operation_time is not None:
+            session.advance_operation_time(operation_time)
+
+    def record(self, session, key: str):
+        """
+        :param session: a session the user just wrote with
+        :param key: the user who wrote
+        """
+        if session.operation_time is None:
+            # standalone servers report no operation time, nothing to wait for
+            return
+
+        with self.lock:
+            self.times[key] = (session.cluster_time, session.operation_time)
+            self.times.move_to_end(key)
+            while len(self.times) > self.max_users:
+                self.times.popitem(last=False)
+
+    # the process' memory is at hand, the async methods need not wait for it
+
+    async def advance_async(self, session, key: str):
+        self.advance(session, key)
+
+    async def record_async(self, session, key: str):
+        self.record(session, key)
+
+
+class SharedCausalClock:
+    """
+    A CausalClock kept in the shared store, so a user's next request reads
+    their own writes whichever worker or instance serves it.
+    """
+
+    def __init__(self, store, ttl: int = CAUSAL_CLOCK_TTL_SECONDS):
+        """
+        :param store: the SharedStore
+        :param ttl: how long the time of a write is remembered, in seconds
+        """
+        self.store = store
+        self.ttl = ttl
+
+    def key(self, key: str) -> str:
+        return f"causal:{key}"
+
+    def advance_to(self, session, times: bytes):
+        if times is not None:
+            times = bson.decode(times)
+            session.advance_cluster_time(times["clusterTime"])
+            session.advance_operation_time(times["operationTime"])
+
+    def times(self, session) -> bytes:
+        return bson.encode(
+            {
+                "clusterTime": session.cluster_time,
+                "operationTime": session.operation_time,
+            }
+        )
+
+    def advance(self, session, key: str):
+        """
+        :param session: a causally consistent session about to read for key
+        :param key: the user the read is made for
+        """
+        self.advance_to(session, self.store.get(self.key(key)))
+
+    async def advance_async(self, session, key: str):
+        self.advance_to(session, await self.store.get_async(self.key(key)))
+
+    def record(self, session, key: str):
+        """
+        :param session: a session the user just wrote with
+        :param key: the user who wrote
+        """
+        if session.operation_time is not None:
+            self.store.set(self.key(key), self.times(session), self.ttl * 1000)
+
+    async def record_async(self, session, key: str):
+        if session.operation_time is not None:
+            await self.store.set_async(
+                self.key(key), self.times(session), self.ttl * 1000
+            )
+
+
+causal_clock = (
+    SharedCausalClock(shared_store) if shared_store is not None else CausalClock()
+)
@@ -0,0 +1,139 @@
+class Repository:
+    """
+    Loads the documents of one collection by their key and keeps them for the
+    lifetime of the repository. DbWrapper creates one set of repositories per
+    call, so a request never fetches the same user or horse twice. Given a
+    DocumentCache, documents are also shared between calls until they expire
+    or are written.
+    """
+
+    key = None
+
+    def __init__(self, collection, session=None, cache=None):
+        self.collection = collection
+        self.session = session
+        self.cache = cache
+        self.documents = {}
+        self.round_trips = 0
+
+    def cacheable(self) -> bool:
+        """
+        :return: False if the read must see the session's causal history,
+        which the shared cache does not know about
+        """
+        return self.cache is not None and (
+            self.session is None or self.session.operation_time is None
+        )
+
+    async def cached(self, value):
+        """
+        :param value: the key of the document
+        :return: the cached document, None if not cached
+        """
+        return await self.cache.get_async(value) if self.cacheable() else None
+
+    async def remember(self, value, document: dict, ticket):
+        """
+        :param ticket: the cache ticket taken before the document was read
+        """
+        if document is not None and ticket is not None:
+            await self.cache.put_async(value, document, ticket)
+
+    def ticket(self):
+        return self.cache.ticket() if self.cacheable() else None
+
+    async def get(self, value):
+        """
+        :param value: the key of the document
+        :return: the document, None if it does not exist
+        """
+        if value not in self.documents:
+            document = await self.cached(value)
+            if document is None:
+                ticket = self.ticket()
+                self.round_trips += 1
+                document = await self.collection.find_one(
+                    {self.key: value}, session=self.session
+                )
+                await self.remember(value, document, ticket)
+            self.documents[value] = document
+
+        return self.documents[value]
+
+    async def exists(self, value) -> bool:
+        """
+        :param value: the key of the document
+        :return: True if the document exists, without loading it
+        """
+        if value in self.documents:
+            return self.documents[value] is not None
+        if self.cacheable() and await self.cache.get_async(value, False) is not None:
+            return True
+
+        self.round_trips += 1
+        found = await self.collection.find_one(
+            {self.key: value}, {"_id": 1}, session=self.session
+        )
+        if found is None:
+            self.documents[value] = None
+
+        return found is not None
+
+    async def version(self, value):
+        """
+        :param value: the key of the document
+        :return: the version of the document, None if it does not exist; only
+        the version is read unless the document is already at hand
+        """
+        if value not in self.documents and self.cacheable():
+            document = await self.cache.get_async(value, copied=False)
+        else:
+            document = self.documents.get(value)
+
+        if document is None and value not in self.documents:
+            self.round_trips += 1
+            document = await self.collection.find_one(
+                {self.key: value}, {"_id": 0, "version": 1}, session=self.session
+            )
+            if document is None:
+                self.documents[value] = None
+
+        return None if document is None else document.get("version", 0)
+
+    def forget(self, value):
+        """
+        :param value: the key of a document that was modified
+        """
+        self.documents.pop(value, None)
+
+
+class UserRepository(Repository):
+    key = "publicAddress"
+
+
+class HorseRepository(Repository):
+    key = "horseId"
+
+
+class SellerRepository(Repository):
+    key = "public_address"
+
+
+class Repositories:
+    """
+    The users, horses and sellers repositories of a single DbWrapper call.
+    """
+
+    def __init__(self, users: Repository, horses: Repository, sellers: Repository):
+        self.users = users
+        self.horses = horses
+        self.sellers = sellers
+
+    @property
+    def round_trips(self) -> int:
+        """
+        :return: the number of reads issued so far
+        """
+        return (
+            self.users.round_trips + self.horses.round_trips + self.sellers.round_trips
+        )
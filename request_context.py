@@ -0,0 +1,20 @@
+from contextvars import ContextVar
+
+# Path template of the FastAPI route currently being served, set by the
+# middleware in main.py ("unmatched" for paths no route serves). Code running
+# on behalf of a request (including DbWrapper calls on worker threads) reads it
+# to attribute work to the route that caused it.
+current_route = ContextVar("current_route", default=None)
+
+# Id of the request currently being served, taken from the X-Request-ID header
+# or generated by the middleware in main.py, and attached to log records.
+current_request_id = ContextVar("current_request_id", default=None)
+
+# Principal the request was authenticated as, set by authenticate in auth.py;
+# TokenVerifier.authenticated returns it instead of decoding the token again.
+current_principal = ContextVar("current_principal", default=None)
+
+# Media type the current request asked for in its Accept header, set by
+# DocumentRoute in json_responses.py; DocumentResponse writes results in it and
+# the ETags of documents name it.
+current_media_type = ContextVar("current_media_type", default="application/json")
@@ -0,0 +1,374 @@
+import argparse
+import logging
+import threading
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from metrics import purchases_settled
+from sync_driver import ReadyClient, ReadyDatabase, pause, run
+from versioning import backoff, bump, contention
+
+# attempts at settling a purchase whose sale or shares changed while planning
+SETTLEMENT_RETRIES = 5
+
+
+class SettlementError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class SettlementConflict(Exception):
+    pass
+
+
+class Settlement:
+    """
+    The writes that settle one purchase: a single update of the horse and the
+    updates of the buyer and seller documents. A purchase won at auction also
+    ends the auction and accepts the winner's bid in the same writes.
+    """
+
+    def __init__(self, horse_update: UpdateOne, user_updates: list):
+        self.horse_update = horse_update
+        self.user_updates = user_updates
+
+
+def transactions_supported(hello: dict) -> bool:
+    """
+    :param hello: the reply of the "hello" command
+    :return: True if the deployment is a replica set or a sharded cluster
+    """
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+def plan_settlement(
+    horse: dict,
+    buyer: dict,
+    seller: dict,
+    price: str,
+    ps: int,
+    sale_id: int,
+    date: str = None,
+    auction_id: int = None,
+) -> Settlement:
+    """
+    :param horse: the horse being sold
+    :param buyer: the buyer's user document
+    :param seller: the seller's user document
+    :param price: the price paid
+    :param ps: the number of shares bought
+    :param sale_id: the sale the shares are bought from, None for shares won
+    at auction
+    :param date: the date of the sale, today if None
+    :param auction_id: the auction the shares are won at, None for shares
+    bought from a sale
+    :return: the writes that move the shares from the seller to the buyer
+    """
+    if horse is None:
+        raise SettlementError(404, "Horse does not exist")
+    if buyer is None:
+        raise SettlementError(404, "User does not exist")
+    if seller is None:
+        raise SettlementError(404, "Seller does not exist")
+
+    horse_id = horse["horseId"]
+    buyer_address = buyer["publicAddress"]
+    seller_address = seller["publicAddress"]
+
+    if buyer_address == seller_address:
+        raise SettlementError(400, "Buyer and seller are the same user")
+    if ps <= 0:
+        raise SettlementError(400, "At least one share must be bought")
+
+    if sale_id is not None:
+        sale = next((s for s in horse["saleInfo"] if s["saleId"] == sale_id), None)
+        if sale is None:
+            raise SettlementError(404, "Such sale does not exist")
+        if sale["onMarket"] < ps:
+            raise SettlementError(409, "Not enough shares on sale")
+    if auction_id is not None and horse["auctionInfo"][auction_id]["status"] == "Ended":
+        raise SettlementError(401, "The auction has already ended")
+
+    seller_share = next(
+        (s for s in horse["shareHolders"] if s["publicAddress"] == seller_address),
+        None,
+    )
+    if seller_share is None or seller_share["percentage"] < ps:
+        raise SettlementError(409, "Seller does not hold enough shares")
+
+    sold_out = seller_share["percentage"] == ps
+
+    share_holders = []
+    for holder in horse["shareHolders"]:
+        holder = dict(holder)
+        if holder["publicAddress"] == seller_address:
+            holder["percentage"] -= ps
+            if sold_out:
+                continue
+        elif holder["publicAddress"] == buyer_address:
+            holder["percentage"] += ps
+        share_holders.append(holder)
+
+    if not any(h["publicAddress"] == buyer_address for h in horse["shareHolders"]):
+        share_holders.append({"publicAddress": buyer_address, "percentage": ps})
+
+    sale_info = []
+    for info in horse["saleInfo"]:
+        if info["saleId"] == sale_id:
+            if info["onMarket"] == ps:
+                continue
+            info = dict(info, onMarket=info["onMarket"] - ps)
+        sale_info.append(info)
+
+    # matches only while the sale and the seller's share are as planned
+    guard = {
+        "horseId": horse_id,
+        "shareHolders": {
+            "$elemMatch": {
+                "publicAddress": seller_address,
+                "percentage": seller_share["percentage"],
+            }
+        },
+    }
+    if sale_id is not None:
+        guard["saleInfo"] = {
+            "$elemMatch": {"saleId": sale_id, "onMarket": sale["onMarket"]}
+        }
+
+    horse_set = {"shareHolders": share_holders, "saleInfo": sale_info}
+    if auction_id is not None:
+        # the auction is ended once, by the settlement that sees it running
+        guard[f"auctionInfo.{auction_id}.status"] = {"$ne": "Ended"}
+        horse_set[f"auctionInfo.{auction_id}.status"] = "Ended"
+
+    horse_update = UpdateOne(
+        guard,
+        bump(
+            {
+                "$set": horse_set,
+                "$push": {
+                    "saleHistory": {
+                        "seller": seller_address,
+                        "buyer": buyer_address,
+                        "price": price,
+                        "amountBought": ps,
+                        "date": date or datetime.now().strftime("%d/%m/%Y"),
+                    }
+                },
+            }
+        ),
+    )
+
+    user_updates = []
+    if not any(h["horseId"] == horse_id for h in buyer["myHorses"]):
+        user_updates.append(
+            UpdateOne(
+                {"publicAddress": buyer_address, "myHorses.horseId": {"$ne": horse_id}},
+                bump({"$push": {"myHorses": {"horseId": horse_id, "status": 2}}}),
+            )
+        )
+    if sold_out:
+        # the seller's horse is listed as on sale, or on auction
+        status = 3 if sale_id is not None else 4
+        user_updates.append(
+            UpdateOne(
+                {"publicAddress": seller_address},
+                bump(
+                    {
+                        "$pull": {"myHorses": {"horseId": horse_id, "status": status}},
+                        "$push": {"soldHorses": {"horseId": horse_id}},
+                    }
+                ),
+            )
+        )
+
+    if auction_id is not None:
+        user_updates.append(
+            UpdateOne(
+                {
+                    "publicAddress": buyer_address,
+                    "myBids": {
+                        "$elemMatch": {"horseId": horse_id, "auctionId": auction_id}
+                    },
+                },
+                bump(
+                    {
+                        "$set": {
+                            "myBids.$.isClaimed": True,
+                            "myBids.$.status": "Accepted",
+                        }
+                    }
+                ),
+            )
+        )
+
+    return Settlement(horse_update, user_updates)
+
+
+async def settle(
+    client,
+    database,
+    horse_id: int,
+    buyer_address: str,
+    seller_address: str,
+    price: str,
+    ps: int,
+    sale_id: int,
+    transactions: bool = True,
+    auction_id: int = None,
+) -> Settlement:
+    """
+    Reads the horse and both users, plans the purchase and applies it. With
+    transactions the reads and writes run in one multi-document transaction
+    that the driver retries on transient errors; without them the guarded
+    horse update still refuses to apply a plan made from a stale read.
+
+    :param client: the Motor client, or a ready pymongo one
+    :param database: the database holding horses and users
+    :param transactions: False on a standalone server
+    :param auction_id: the auction the shares are won at, ended by the
+    settlement
+    :return: the applied settlement
+    """
+
+    async def attempt(session=None):
+        horse = await database["horses"].find_one(
+            {"horseId": horse_id}, session=session
+        )
+        users = {
+            user["publicAddress"]: user
+            for user in await database["users"]
+            .find(
+                {"publicAddress": {"$in": [buyer_address, seller_address]}},
+                session=session,
+            )
+            .to_list(length=None)
+        }
+
+        settlement = plan_settlement(
+            horse,
+            users.get(buyer_address),
+            users.get(seller_address),
+            price,
+            ps,
+            sale_id,
+            auction_id=auction_id,
+        )
+
+        result = await database["horses"].bulk_write(
+            [settlement.horse_update], session=session
+        )
+        if result.matched_count == 0:
+            raise SettlementConflict()
+
+        if settlement.user_updates:
+            await database["users"].bulk_write(
+                settlement.user_updates, ordered=False, session=session
+            )
+
+        return settlement
+
+    for retry in range(SETTLEMENT_RETRIES):
+        try:
+            if not transactions:
+                settlement = await attempt()
+            else:
+                async with await client.start_session() as session:
+                    settlement = await session.with_transaction(attempt)
+
+            contention.record("buy_horse", retry)
+            purchases_settled.inc()
+            return settlement
+
+        except SettlementConflict:
+            await pause(backoff(retry))
+
+    contention.record("buy_horse", SETTLEMENT_RETRIES, exhausted=True)
+    raise SettlementError(409, "The sale changed, please try again")
+
+
+def benchmark(db, buyers: int, purchases: int) -> dict:
+    """
+    Lets `buyers` threads buy one share each of the same horse until
+    `purchases` shares are sold, then checks no share was lost or duplicated.
+
+    :param db: a DbWrapper, its "settlement_benchmark" database is overwritten
+    :return: purchases per second and the final share count
+    """
+    database = db.get_database("settlement_benchmark")
+    database["horses"].drop()
+    database["users"].drop()
+
+    seller = "0xseller"
+    addresses = [f"0xbuyer{i}" for i in range(buyers)]
+    database["users"].insert_many(
+        [
+            {"publicAddress": address, "myHorses": [], "soldHorses": []}
+            for address in [seller] + addresses
+        ]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 0,
+            "shareHolders": [{"publicAddress": seller, "percentage": purchases}],
+            "saleInfo": [{"saleId": 0, "onMarket": purchases, "price": "1"}],
+            "saleHistory": [],
+        }
+    )
+
+    transactions = db.supports_transactions()
+    client, ready = ReadyClient(db.client), ReadyDatabase(database)
+    remaining = [purchases]
+    failures = [0]
+    lock = threading.Lock()
+
+    def buy(address):
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            try:
+                run(settle(client, ready, 0, address, seller, "1", 1, 0, transactions))
+            except SettlementError:
+                with lock:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=buy, args=(a,)) for a in addresses]
+    started_at = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started_at
+
+    horse = database["horses"].find_one({"horseId": 0})
+
+    return {
+        "transactions": transactions,
+        "buyers": buyers,
+        "purchases": purchases - failures[0],
+        "failures": failures[0],
+        "purchases_per_second": (purchases - failures[0]) / elapsed,
+        "shares_total": sum(h["percentage"] for h in horse["shareHolders"]),
+        "sale_history": len(horse["saleHistory"]),
+    }
+
+
+if __name__ == "__main__":
+    from db_wrapper import DbWrapper
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark concurrent purchases of the same horse."
+    )
+    parser.add_argument("--buyers", type=int, default=16)
+    parser.add_argument("--purchases", type=int, default=500)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print(benchmark(DbWrapper(), args.buyers, args.purchases))
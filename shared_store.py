@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import redis
+import redis.asyncio
+
+from sync_driver import Ready, ReadyIterator, run, synchronous
+
+logger = logging.getLogger(__name__)
+
+# the Redis server shared by every worker and instance; without it caches and
+# causal sessions stay in process and rate limiting stays in MongoDB
+REDIS_URL = os.environ.get("REDIS_URL")
+
+# connections per process; a command waits up to the pool timeout for one
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT_SECONDS = float(os.environ.get("REDIS_POOL_TIMEOUT_SECONDS", 1))
+
+# a lookup slower than this is abandoned and treated as a miss
+REDIS_SOCKET_TIMEOUT_SECONDS = float(
+    os.environ.get("REDIS_SOCKET_TIMEOUT_SECONDS", 0.25)
+)
+
+# prefixed to every key, so several deployments can share a server
+REDIS_KEY_PREFIX = os.environ.get("REDIS_KEY_PREFIX", "horse-around:")
+
+
+class ReadyRedis(Ready):
+    """
+    The Redis client behind the interface of its asyncio counterpart, for the
+    DbWrapper methods driven synchronously.
+    """
+
+    coroutines = frozenset({"delete", "get", "incr", "set"})
+
+    def pipeline(self, *args, **kwargs):
+        return ReadyPipeline(self.delegate.pipeline(*args, **kwargs))
+
+    def scan_iter(self, *args, **kwargs):
+        return ReadyIterator(self.delegate.scan_iter(*args, **kwargs))
+
+
+class ReadyPipeline(Ready):
+    coroutines = frozenset({"execute"})
+
+
+class SharedStore:
+    """
+    A key-value store shared across processes, spoken to over the Redis
+    protocol through a pool of connections per process, and a pool per event
+    loop for AsyncDbWrapper. The calls needing several commands send them in
+    one pipelined round trip. A store that cannot be reached behaves as an
+    empty one: reads miss, writes are dropped and the errors are counted.
+    """
+
+    def __init__(self, url: str, prefix: str = REDIS_KEY_PREFIX):
+        self.url = url
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.client_pid = None
+        self.async_clients = {}
+        self.round_trips = 0
+        self.errors = 0
+        self.duration = 0.0
+
+    def pool_settings(self) -> dict:
+        return {
+            "max_connections": REDIS_MAX_CONNECTIONS,
+            "timeout": REDIS_POOL_TIMEOUT_SECONDS,
+            "socket_timeout": REDIS_SOCKET_TIMEOUT_SECONDS,
+            "socket_connect_timeout": REDIS_SOCKET_TIMEOUT_SECONDS,
+        }
+
+    def check_process(self):
+        # the pools are created again after a fork, like the MongoDB client
+        if self.client_pid != os.getpid():
+            with self.lock:
+                if self.client_pid != os.getpid():
+                    self.sync_client = redis.Redis(
+                        connection_pool=redis.BlockingConnectionPool.from_url(
+                            self.url, **self.pool_settings()
+                        )
+                    )
+                    self.async_clients = {}
+                    self.client_pid = os.getpid()
+
+    @property
+    def client(self) -> redis.Redis:
+        self.check_process()
+        return self.sync_client
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        self.check_process()
+        # asyncio connections belong to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_clients:
+            self.async_clients[loop] = redis.asyncio.Redis(
+                connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+                    self.url, **self.pool_settings()
+                )
+            )
+
+        return self.async_clients[loop]
+
+    def key(self, key: str) -> str:
+        return self.prefix + key
+
+    def record(self, started_at: float, error: Exception = None):
+        with self.lock:
+            self.round_trips += 1
+            self.duration += time.perf_counter() - started_at
+            if error is not None:
+                self.errors += 1
+
+        if error is not None:
+            logger.error("Shared store unavailable: %s", error)
+
+    def call(self, command, default=None):
+        """
+        :param command: takes the client, sends one round trip
+        :param default: the result if the store cannot be reached
+        """
+        started_at = time.perf_counter()
+        try:
+            result = command(self.client)
+        except redis.RedisError as e:
+            self.record(started_at, e)
+            return default
+
+        self.record(started_at)
+        return result
+
+    async def call_async(self, command, default=None):
+        """
+        Asyncio counterpart of call.
+        """
+        if synchronous():
+            return self.call(lambda client: run(command(ReadyRedis(client))), default)
+
+        started_at = time.perf_counter()
+        try:
+            result = await command(self.async_client)
+        except redis.RedisError as e:
+            self.record(started_at, e)
+            return default
+
+        self.record(started_at)
+        return result
+
+    def get(self, key: str):
+        """
+        :return: the value of key, None if missing
+        """
+        return self.call(lambda client: client.get(self.key(key)))
+
+    async def get_async(self, key: str):
+        return await self.call_async(lambda client: client.get(self.key(key)))
+
+    def set(self, key: str, value: bytes, ttl_ms: int, missing_only: bool = False):
+        """
+        :param ttl_ms: how long the value is kept
+        :param missing_only: True to keep the current value if there is one
+        :return: True if the value was set
+        """
+        return bool(
+            self.call(
+                lambda client: client.set(
+                    self.key(key), value, px=ttl_ms, nx=missing_only
+                )
+            )
+        )
+
+    async def set_async(
+        self, key: str, value: bytes, ttl_ms: int, missing_only: bool = False
+    ):
+        return bool(
+            await self.call_async(
+                lambda client: client.set(
+                    self.key(key), value, px=ttl_ms, nx=missing_only
+                )
+            )
+        )
+
+    def set_many(self, values: list, ttl_ms: int, missing_only: bool = False):
+        """
+        :param values: (key, value) pairs, set in one round trip
+        :return: whether each value was set
+        """
+
+        def command(client):
+            pipeline = client.pipeline(transaction=False)
+            for key, value in values:
+                pipeline.set(self.key(key), value, px=ttl_ms, nx=missing_only)
+            return pipeline.execute()
+
+        return [bool(r) for r in self.call(command, [None] * len(values))]
+
+    async def set_many_async(
+        self, values: list, ttl_ms: int, missing_only: bool = False
+    ):
+        async def command(client):
+            pipeline = client.pipeline(transaction=False)
+            for key, value in values:
+                pipeline.set(self.key(key), value, px=ttl_ms, nx=missing_only)
+            return await pipeline.execute()
+
+        results = await self.call_async(command, [None] * len(values))
+        return [bool(r) for r in results]
+
+    def hit(self, key: str, window_ms: int) -> int:
+        """
+        Counts a hit in the fixed window key stands for, started by its first
+        hit and lasting window_ms.
+
+        :return: the hits in the window so far, 0 if the store is unreachable
+        """
+
+        def command(client):
+            pipeline = client.pipeline(transaction=False)
+            pipeline.set(self.key(key), 0, px=window_ms, nx=True)
+            pipeline.incr(self.key(key))
+            return pipeline.execute()[-1]
+
+        return self.call(command, 0)
+
+    async def hit_async(self, key: str, window_ms: int) -> int:
+        async def command(client):
+            pipeline = client.pipeline(transaction=False)
+            pipeline.set(self.key(key), 0, px=window_ms, nx=True)
+            pipeline.incr(self.key(key))
+            return (await pipeline.execute())[-1]
+
+        return await self.call_async(command, 0)
+
+    def delete_matching(self, pattern: str) -> int:
+        """
+        :param pattern: a glob over the keys, without the prefix
+        :return: the number of keys deleted
+        """
+
+        def command(client):
+            keys = list(client.scan_iter(match=self.key(pattern), count=1000))
+            return client.delete(*keys) if keys else 0
+
+        return self.call(command, 0)
+
+    async def delete_matching_async(self, pattern: str) -> int:
+        async def command(client):
+            keys = [k async for k in client.scan_iter(self.key(pattern), 1000)]
+            return await client.delete(*keys) if keys else 0
+
+        return await self.call_async(command, 0)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "url": redis.connection.parse_url(self.url).get("host"),
+                "max_connections": REDIS_MAX_CONNECTIONS,
+                "round_trips": self.round_trips,
+                "errors": self.errors,
+                "duration_avg_ms": self.duration / self.round_trips * 1000
+                if self.round_trips
+                else 0.0,
+            }
+
+
+shared_store = SharedStore(REDIS_URL) if REDIS_URL else None
+
+
+def store_check(store: SharedStore, lookups: int, collection=None) -> dict:
+    """
+    Exercises the store and times single lookups against pipelined ones, and
+    against reads of the same documents from MongoDB, which the store saves.
+
+    :param store: the store to check, its "check:" keys are overwritten
+    :param lookups: the number of keys looked up
+    :param collection: a pymongo collection to time the reads from, dropped
+    :return: the timings, in milliseconds per lookup
+    """
+    values = [(f"check:{i}", b"x" * 512) for i in range(lookups)]
+    consistent = (
+        all(store.set_many(values, 60000))
+        and not store.set("check:0", b"y", 60000, missing_only=True)
+        and store.get("check:0") == b"x" * 512
+        and [store.hit("check:hits", 60000) for _ in range(3)] == [1, 2, 3]
+    )
+
+    started_at = time.perf_counter()
+    for key, _ in values:
+        store.get(key)
+    single = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    pipeline = store.client.pipeline(transaction=False)
+    for key, _ in values:
+        pipeline.get(store.key(key))
+    pipeline.execute()
+    pipelined = time.perf_counter() - started_at
+
+    deleted = store.delete_matching("check:*")
+
+    result = {
+        "consistent": consistent,
+        "lookups": lookups,
+        "single_ms": single / lookups * 1000,
+        "pipelined_ms": pipelined / lookups * 1000,
+        "deleted": deleted,
+        "store": store.as_dict(),
+    }
+
+    if collection is not None:
+        collection.drop()
+        collection.insert_many([{"_id": key, "value": value} for key, value in values])
+
+        started_at = time.perf_counter()
+        for key, _ in values:
+            collection.find_one({"_id": key})
+        result["mongo_ms"] = (time.perf_counter() - started_at) / lookups * 1000
+
+        collection.drop()
+
+    return result
+
+
+if __name__ == "__main__":
+    from db_wrapper import DbWrapper
+
+    parser = argparse.ArgumentParser(
+        description="Check the shared store and time it against MongoDB reads."
+    )
+    parser.add_argument("--url", default=REDIS_URL)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    if not args.url:
+        parser.error("a Redis server is needed, set REDIS_URL or pass --url")
+
+    logging.basicConfig(level=logging.INFO)
+
+    collection = DbWrapper().get_database("store_check")["documents"]
+    print(store_check(SharedStore(args.url), args.lookups, collection))
@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from eth_account import Account
+from eth_account.messages import encode_defunct
+
+from sync_driver import synchronous
+
+logger = logging.getLogger(__name__)
+
+# processes recovering signatures; with 0, the default, they are recovered
+# inline, which login_benchmark found faster on a single core host. Only
+# spare cores let a pool keep the recovery off the event loop's CPU.
+SIGNATURE_WORKERS = int(os.environ.get("SIGNATURE_WORKERS", 0))
+
+# recoveries queued or running at once; past it a login is refused with 503
+SIGNATURE_QUEUE_SIZE = int(os.environ.get("SIGNATURE_QUEUE_SIZE", 256))
+
+# recovered addresses kept by (message, signature) for replayed requests
+SIGNATURE_MEMO_SIZE = int(os.environ.get("SIGNATURE_MEMO_SIZE", 10000))
+
+# the workers are spawned rather than forked from a threaded server
+SIGNATURE_START_METHOD = os.environ.get("SIGNATURE_START_METHOD", "spawn")
+
+# signatures handed to a worker at once by the batch APIs
+BATCH_CHUNK_SIZE = 32
+
+# signatures a single batch verification may hold
+MAX_SIGNATURE_BATCH = int(os.environ.get("MAX_SIGNATURE_BATCH", 1000))
+
+
+class SignatureQueueFull(Exception):
+    pass
+
+
+def recover_address(message: str, signature: str):
+    """
+    :param message: the text that was signed, as by personal_sign
+    :param signature: the hex signature
+    :return: the checksummed address that signed message, None if signature
+    is not a valid signature
+    """
+    try:
+        return Account.recover_message(
+            encode_defunct(text=message), signature=signature
+        )
+    except Exception:
+        # malformed signatures raise all sorts of errors
+        return None
+
+
+def recover_addresses(pairs: list) -> list:
+    """
+    :param pairs: (message, signature) pairs
+    :return: the address recovered from each pair, see recover_address
+    """
+    return [recover_address(message, signature) for message, signature in pairs]
+
+
+class SignatureRecovery:
+    """
+    Recovers the address that signed a message, inline or, given workers, on
+    a pool of worker processes, so the ECDSA recovery neither holds the GIL
+    nor blocks the event loop. At most queue_size recoveries wait or run at
+    once, more are refused with SignatureQueueFull. Recovered addresses are
+    memoised by (message, signature).
+    """
+
+    def __init__(
+        self,
+        workers: int = SIGNATURE_WORKERS,
+        queue_size: int = SIGNATURE_QUEUE_SIZE,
+        memo_size: int = SIGNATURE_MEMO_SIZE,
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.memo = OrderedDict()
+        self.pending = 0
+        self.recoveries = 0
+        self.memo_hits = 0
+        self.rejected = 0
+        self.recovery_time = 0.0
+
+    @property
+    def pooled(self) -> bool:
+        return self.workers > 0
+
+    def executor(self) -> ProcessPoolExecutor:
+        # a pool inherited through a fork is not ours to use
+        if self.pool_pid != os.getpid():
+            with self.lock:
+                if self.pool_pid != os.getpid():
+                    self.pool = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context(SIGNATURE_START_METHOD),
+                    )
+                    self.pool_pid = os.getpid()
+
+        return self.pool
+
+    def memoised(self, message: str, signature: str):
+        with self.lock:
+            address = self.memo.get((message, signature))
+            if address is not None:
+                self.memo_hits += 1
+                self.memo.move_to_end((message, signature))
+
+            return address
+
+    def remember(self, pairs: list, addresses: list, started_at: float):
+        with self.lock:
+            self.recoveries += len(pairs)
+            self.recovery_time += time.perf_counter() - started_at
+            for pair, address in zip(pairs, addresses):
+                if address is not None:
+                    self.memo[pair] = address
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise SignatureQueueFull("Too many signatures waiting to be verified")
+
+        with self.lock:
+            self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def recover(self, message: str, signature: str):
+        """
+        :return: the address that signed message, None if the signature is
+        not valid
+        :raise SignatureQueueFull: if too many recoveries are under way
+        """
+        return self.recover_many([(message, signature)])[0]
+
+    async def recover_async(self, message: str, signature: str):
+        """
+        Asyncio counterpart of recover.
+        """
+        return (await self.recover_many_async([(message, signature)]))[0]
+
+    def pending_pairs(self, pairs: list):
+        # the pairs not memoised, and the results with the memoised ones in
+        addresses = [self.memoised(*pair) for pair in pairs]
+        missing = [p for p, a in zip(pairs, addresses) if a is None]
+
+        return addresses, missing
+
+    def merged(self, addresses: list, recovered: list) -> list:
+        recovered = iter(recovered)
+        return [a if a is not None else next(recovered) for a in addresses]
+
+    def recover_many(self, pairs: list) -> list:
+        """
+        :param pairs: (message, signature) pairs, recovered in chunks across
+        the workers; the batch takes a single place in the queue
+        :return: the address recovered from each pair, None where invalid
+        """
+        addresses, missing = self.pending_pairs(pairs)
+        if not missing:
+            return addresses
+
+        self.acquire()
+        started_at = time.perf_counter()
+        try:
+            if not self.pooled:
+                recovered = recover_addresses(missing)
+            else:
+                chunks = [
+                    missing[i : i + BATCH_CHUNK_SIZE]
+                    for i in range(0, len(missing), BATCH_CHUNK_SIZE)
+                ]
+                recovered = [
+                    address
+                    for chunk in self.executor().map(recover_addresses, chunks)
+                    for address in chunk
+                ]
+        finally:
+            self.release()
+
+        self.remember(missing, recovered, started_at)
+        return self.merged(addresses, recovered)
+
+    async def recover_many_async(self, pairs: list) -> list:
+        """
+        Asyncio counterpart of recover_many.
+        """
+        addresses, missing = self.pending_pairs(pairs)
+        if not missing:
+            return addresses
+
+        # a driven DbWrapper method waits on its own thread
+        if not self.pooled or synchronous():
+            return self.recover_many(pairs)
+
+        self.acquire()
+        started_at = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            chunks = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self.executor(),
+                        recover_addresses,
+                        missing[i : i + BATCH_CHUNK_SIZE],
+                    )
+                    for i in range(0, len(missing), BATCH_CHUNK_SIZE)
+                )
+            )
+        finally:
+            self.release()
+
+        recovered = [address for chunk in chunks for address in chunk]
+        self.remember(missing, recovered, started_at)
+        return self.merged(addresses, recovered)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "pooled": self.pooled,
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "pending": self.pending,
+                "recoveries": self.recoveries,
+                "memo_size": len(self.memo),
+                "memo_hits": self.memo_hits,
+                "rejected": self.rejected,
+                "recovery_time_total_ms": self.recovery_time * 1000,
+            }
+
+
+signature_recovery = SignatureRecovery()
+
+
+def signs(address: str, recovered) -> bool:
+    """
+    :param address: the address claimed, in any case
+    :param recovered: the address recovered from the signature, or None
+    """
+    return recovered is not None and recovered.lower() == address.lower()
+
+
+def login_benchmark(logins: int, workers: int) -> dict:
+    """
+    Times logins' signature recoveries done inline, as before, and on the
+    pool, with the event loop lag each causes.
+
+    :param logins: signed login messages to recover
+    :param workers: processes of the pool
+    :return: logins per second per core, and the worst event loop lag
+    """
+    account = Account.create()
+    pairs = []
+    for nonce in range(logins):
+        message = (
+            f"Horse Around Authentication for {account.address} with nonce : {nonce}"
+        )
+        signed = Account.sign_message(encode_defunct(text=message), account.key)
+        pairs.append((message, signed.signature.hex()))
+
+    async def lag_while(work) -> tuple:
+        lags = []
+
+        async def probe():
+            while True:
+                started_at = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - started_at - 0.001)
+
+        prober = asyncio.create_task(probe())
+        await asyncio.sleep(0.01)
+        started_at = time.perf_counter()
+        await work()
+        elapsed = time.perf_counter() - started_at
+        prober.cancel()
+
+        return elapsed, max(lags) * 1000
+
+    async def inline():
+        for message, signature in pairs:
+            recover_address(message, signature)
+            # a request coroutine yields between logins, never during one
+            await asyncio.sleep(0)
+
+    recovery = SignatureRecovery(workers, queue_size=logins, memo_size=0)
+
+    async def pooled():
+        await asyncio.gather(*(recovery.recover_async(*pair) for pair in pairs))
+
+    async def run() -> dict:
+        # start the workers before timing them
+        await recovery.recover_async(*pairs[0])
+
+        inline_time, inline_lag = await lag_while(inline)
+        pool_time, pool_lag = await lag_while(pooled)
+
+        return {
+            "logins": logins,
+            "workers": workers,
+            "inline_logins_per_second_per_core": logins / inline_time,
+            "pool_logins_per_second_per_core": logins / pool_time / workers,
+            "inline_loop_lag_max_ms": inline_lag,
+            "pool_loop_lag_max_ms": pool_lag,
+        }
+
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark login signature recovery, inline against the pool."
+    )
+    parser.add_argument("--logins", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print(login_benchmark(args.logins, args.workers))
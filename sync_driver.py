@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import itertools
+import time
+from functools import wraps
+
+# True while a coroutine is being driven to completion by run
+running = contextvars.ContextVar("sync_driver_running", default=False)
+
+
+def run(coroutine):
+    """
+    Drives a coroutine that only awaits ready results, i.e. whose awaits
+    never suspend, to completion on the calling thread, without an event
+    loop. The DbWrapper methods are written once, as coroutines: Motor makes
+    them wait on the event loop, the Ready objects below make them run
+    synchronously over pymongo.
+
+    :return: whatever the coroutine returns
+    :raise RuntimeError: if the coroutine suspended
+    """
+    token = running.set(True)
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        running.reset(token)
+
+    coroutine.close()
+    raise RuntimeError("A synchronously driven coroutine awaited the event loop")
+
+
+def synchronous() -> bool:
+    """
+    :return: True when called from a coroutine being driven by run
+    """
+    return running.get()
+
+
+async def pause(seconds: float):
+    """
+    Sleeps the coroutine, or the thread when it is driven by run.
+    """
+    if synchronous():
+        time.sleep(seconds)
+    else:
+        await asyncio.sleep(seconds)
+
+
+def driven(method):
+    """
+    Calls a coroutine method synchronously unless its wrapper is asynchronous
+    or the call is made from a coroutine being driven already, where it is
+    awaited.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        coroutine = method(self, *args, **kwargs)
+        if self.asynchronous or synchronous():
+            return coroutine
+
+        return run(coroutine)
+
+    return wrapper
+
+
+def drives(cls):
+    """
+    Makes every coroutine method defined by cls a driven one.
+    """
+    for name, attr in list(vars(cls).items()):
+        if asyncio.iscoroutinefunction(attr):
+            setattr(cls, name, driven(attr))
+
+    return cls
+
+
+def unwrapped(value):
+    return value.delegate if isinstance(value, Ready) else value
+
+
+def called(method, result=None):
+    """
+    :param method: a method of a pymongo object
+    :param result: wraps what the method returns
+    :return: the method, taking Ready arguments in place of the pymongo ones
+    """
+
+    @wraps(method)
+    def call(*args, **kwargs):
+        value = method(
+            *(unwrapped(a) for a in args),
+            **{key: unwrapped(v) for key, v in kwargs.items()},
+        )
+        return value if result is None else result(value)
+
+    return call
+
+
+def awaitable(method, result=None):
+    """
+    :return: a coroutine function calling the pymongo method, for the methods
+    Motor makes coroutines of
+    """
+    call = called(method, result)
+
+    @wraps(method)
+    async def coroutine(*args, **kwargs):
+        return call(*args, **kwargs)
+
+    return coroutine
+
+
+class Ready:
+    """
+    A pymongo object behind the interface of its Motor counterpart, with
+    every coroutine ready as soon as it is awaited.
+    """
+
+    # the methods Motor makes coroutines of
+    coroutines = frozenset()
+
+    def __init__(self, delegate):
+        self.delegate = delegate
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.delegate, name)
+        if name in self.coroutines:
+            return awaitable(attr)
+        if callable(attr):
+            return called(attr)
+
+        return attr
+
+
+class ReadyClient(Ready):
+    coroutines = frozenset(
+        {"drop_database", "list_database_names", "list_databases", "server_info"}
+    )
+
+    def __getitem__(self, name: str):
+        return ReadyDatabase(self.delegate[name])
+
+    def get_database(self, *args, **kwargs):
+        return ReadyDatabase(called(self.delegate.get_database)(*args, **kwargs))
+
+    @property
+    def admin(self):
+        return ReadyDatabase(self.delegate.admin)
+
+    async def start_session(self, *args, **kwargs):
+        return ReadySession(self.delegate.start_session(*args, **kwargs))
+
+
+class ReadyDatabase(Ready):
+    coroutines = frozenset(
+        {
+            "command",
+            "create_collection",
+            "drop_collection",
+            "list_collection_names",
+            "list_collections",
+            "validate_collection",
+        }
+    )
+
+    def __getitem__(self, name: str):
+        return ReadyCollection(self.delegate[name])
+
+    def get_collection(self, *args, **kwargs):
+        return ReadyCollection(called(self.delegate.get_collection)(*args, **kwargs))
+
+    def with_options(self, *args, **kwargs):
+        return ReadyDatabase(called(self.delegate.with_options)(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        return ReadyCursor(called(self.delegate.aggregate)(*args, **kwargs))
+
+
+class ReadyCollection(Ready):
+    """
+    Every method of a Motor collection is a coroutine but those returning a
+    cursor or another collection.
+    """
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.delegate, name)
+        if callable(attr):
+            return awaitable(attr)
+
+        return attr
+
+    def __getitem__(self, name: str):
+        return ReadyCollection(self.delegate[name])
+
+    def with_options(self, *args, **kwargs):
+        return ReadyCollection(called(self.delegate.with_options)(*args, **kwargs))
+
+    def find(self, *args, **kwargs):
+        return ReadyCursor(called(self.delegate.find)(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        return ReadyCursor(called(self.delegate.aggregate)(*args, **kwargs))
+
+    def list_indexes(self, *args, **kwargs):
+        return ReadyCursor(called(self.delegate.list_indexes)(*args, **kwargs))
+
+
+class ReadyIterator(Ready):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.delegate)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class ReadyCursor(ReadyIterator):
+    def __getattr__(self, name: str):
+        attr = getattr(self.delegate, name)
+        if not callable(attr):
+            return attr
+
+        # sort, limit, skip... return the cursor itself, chained
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self.delegate else result
+
+        return chained
+
+    async def to_list(self, length: int = None):
+        if length is None:
+            return list(self.delegate)
+
+        return list(itertools.islice(self.delegate, length))
+
+    async def explain(self):
+        return self.delegate.explain()
+
+    async def next(self):
+        return next(self.delegate)
+
+    async def close(self):
+        self.delegate.close()
+
+
+class ReadySession(Ready):
+    coroutines = frozenset({"abort_transaction", "commit_transaction", "end_session"})
+
+    async def __aenter__(self):
+        self.delegate.__enter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return self.delegate.__exit__(*exc_info)
+
+    async def with_transaction(self, callback, *args, **kwargs):
+        """
+        :param callback: takes the session, returns the coroutine of the
+        transaction, driven again by pymongo on every retry
+        """
+        return self.delegate.with_transaction(
+            lambda session: run(callback(self)), *args, **kwargs
+        )
@@ -0,0 +1,142 @@
+import asyncio
+import inspect
+import os
+import sys
+from contextlib import asynccontextmanager
+from functools import wraps
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# read when the modules are imported, so set before any test imports them
+ADMIN_ADDRESS = "0x00000000000000000000000000000000000000ad"
+os.environ.setdefault("SECRET", "test-secret")
+os.environ.setdefault("ADMIN_SECRET", "test-admin-secret")
+os.environ["ADMIN_ADDRESSES"] = ADMIN_ADDRESS
+os.environ["DB_EXECUTION_MODE"] = "threadpool"
+os.environ["MEMBERSHIP_FILTERS"] = "off"
+os.environ["MONGODB_CATALOGUE_READ_PREFERENCE"] = "primary"
+
+
+@asynccontextmanager
+async def no_session(self, *args):
+    # mongomock has no sessions
+    yield None
+
+
+async def standalone(self) -> bool:
+    # nor transactions
+    return False
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    """
+    :return: the mongomock client every DbWrapper uses during the test
+    """
+    mongomock = pytest.importorskip("mongomock")
+    import db_wrapper
+    from db_wrapper import DbWrapper
+    from document_cache import caches
+    from sync_driver import driven
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(DbWrapper, "create_client", lambda self: client)
+    monkeypatch.setattr(DbWrapper, "causal_session", no_session)
+    monkeypatch.setattr(DbWrapper, "catalogue_session", no_session)
+    monkeypatch.setattr(DbWrapper, "supports_transactions", driven(standalone))
+    # mongomock refuses read preferences in with_options
+    monkeypatch.setattr(db_wrapper, "catalogue_read_preference", lambda: None)
+    for cache in caches.values():
+        cache.reset()
+
+    return client
+
+
+class Completed:
+    """
+    Runs the coroutines of an AsyncDbWrapper to completion, so the tests call
+    it as they call a DbWrapper. Its databases are the DbWrapper's, to set up
+    and check documents synchronously.
+    """
+
+    def __init__(self, wrapper, synchronous):
+        self.wrapper = wrapper
+        self.synchronous = synchronous
+        self.loop = asyncio.new_event_loop()
+
+    def get_database(self, db_name: str):
+        return self.synchronous.get_database(db_name)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.wrapper, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def method(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return self.loop.run_until_complete(result)
+            return result
+
+        return method
+
+
+@pytest.fixture(params=["pymongo", "motor"])
+def db(request, mongo_client, monkeypatch):
+    """
+    :return: a DbWrapper on an empty mongomock database, then an
+    AsyncDbWrapper on the same database through mongomock_motor
+    """
+    from db_wrapper import DbWrapper
+
+    if request.param == "pymongo":
+        yield DbWrapper()
+        return
+
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    from async_db_wrapper import AsyncDbWrapper
+
+    monkeypatch.setattr(
+        AsyncDbWrapper,
+        "create_client",
+        lambda self: mongomock_motor.AsyncMongoMockClient(
+            mock_mongo_client=mongo_client
+        ),
+    )
+    completed = Completed(AsyncDbWrapper(), DbWrapper())
+    yield completed
+    completed.loop.close()
+
+
+@pytest.fixture(params=["threadpool", "motor"])
+def app_client(request, mongo_client, monkeypatch):
+    """
+    :return: a TestClient of the app over the mongomock database, running
+    the synchronous DbWrapper on its thread pool, then AsyncDbWrapper
+    """
+    from fastapi.testclient import TestClient
+
+    import main
+
+    # the client of an earlier test is replaced on next use
+    main.db.wrapper.client_pid = None
+
+    if request.param == "motor":
+        mongomock_motor = pytest.importorskip("mongomock_motor")
+        from async_db_wrapper import AsyncDbWrapper
+
+        monkeypatch.setattr(
+            AsyncDbWrapper,
+            "create_client",
+            lambda self: mongomock_motor.AsyncMongoMockClient(
+                mock_mongo_client=mongo_client
+            ),
+        )
+        # the route decorators stay bound to the thread pool wrapper
+        monkeypatch.setattr(main, "db", AsyncDbWrapper())
+
+    return TestClient(main.app)
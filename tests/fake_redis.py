@@ -0,0 +1,221 @@
+import fnmatch
+import socketserver
+import threading
+import time
+
+
+class FakeRedisState:
+    """
+    The keys of a FakeRedisServer, with their expiry in monotonic seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.expiries = {}
+
+    def live(self, key: bytes) -> bool:
+        # the caller holds the lock; expired keys are dropped when touched
+        expiry = self.expiries.get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self.values.pop(key, None)
+            self.expiries.pop(key, None)
+
+        return key in self.values
+
+    def get(self, key: bytes):
+        return self.values[key] if self.live(key) else None
+
+    def put(self, key: bytes, value: bytes, ttl_ms: int = None):
+        self.values[key] = value
+        if ttl_ms is None:
+            self.expiries.pop(key, None)
+        else:
+            self.expiries[key] = time.monotonic() + ttl_ms / 1000
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the RESP2 commands the shared store uses, one connection per
+    thread. Pipelined commands are simply read and answered in order.
+    """
+
+    # each reply is written on its own: without this, the second reply of a
+    # pipeline waits for the client's delayed acknowledgement of the first
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            try:
+                command = self.read_command()
+            except ConnectionError:
+                return
+            if command is None:
+                return
+
+            name = command[0].upper().decode()
+            handler = getattr(self, f"command_{name.lower()}", None)
+            with self.server.state.lock:
+                if handler is None:
+                    reply = Exception(f"ERR unknown command '{name}'")
+                else:
+                    try:
+                        reply = handler(*command[1:])
+                    except (TypeError, ValueError):
+                        reply = Exception(f"ERR syntax error in '{name}'")
+            self.wfile.write(encode_reply(reply))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # inline command, e.g. from telnet
+            return line.split()
+
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+
+        return arguments
+
+    @property
+    def state(self) -> FakeRedisState:
+        return self.server.state
+
+    def command_ping(self, message: bytes = b"PONG"):
+        return SimpleString(message)
+
+    def command_select(self, db: bytes):
+        return SimpleString(b"OK")
+
+    def command_client(self, *arguments):
+        return SimpleString(b"OK")
+
+    def command_get(self, key: bytes):
+        return self.state.get(key)
+
+    def command_mget(self, *keys):
+        return [self.state.get(key) for key in keys]
+
+    def command_set(self, key: bytes, value: bytes, *options):
+        options = [option.upper() for option in options]
+        ttl_ms = None
+        if b"PX" in options:
+            ttl_ms = int(options[options.index(b"PX") + 1])
+        elif b"EX" in options:
+            ttl_ms = int(options[options.index(b"EX") + 1]) * 1000
+
+        exists = self.state.live(key)
+        if (b"NX" in options and exists) or (b"XX" in options and not exists):
+            return None
+
+        self.state.put(key, value, ttl_ms)
+        return SimpleString(b"OK")
+
+    def command_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self.state.live(key):
+                del self.state.values[key]
+                self.state.expiries.pop(key, None)
+                deleted += 1
+
+        return deleted
+
+    def command_incrby(self, key: bytes, amount: bytes):
+        # the expiry of the key, if any, is kept
+        value = int(self.state.get(key) or 0) + int(amount)
+        self.state.values[key] = str(value).encode()
+
+        return value
+
+    def command_incr(self, key: bytes):
+        return self.command_incrby(key, b"1")
+
+    def command_pexpire(self, key: bytes, ttl_ms: bytes):
+        if not self.state.live(key):
+            return 0
+
+        self.state.expiries[key] = time.monotonic() + int(ttl_ms) / 1000
+        return 1
+
+    def command_pttl(self, key: bytes):
+        if not self.state.live(key):
+            return -2
+        if key not in self.state.expiries:
+            return -1
+
+        return int((self.state.expiries[key] - time.monotonic()) * 1000)
+
+    def command_scan(self, cursor: bytes, *options):
+        upper = [option.upper() for option in options]
+        pattern = options[upper.index(b"MATCH") + 1] if b"MATCH" in upper else b"*"
+
+        keys = [
+            key
+            for key in list(self.state.values)
+            if self.state.live(key) and fnmatch.fnmatchcase(key, pattern)
+        ]
+        # the whole keyspace is returned in one step
+        return [b"0", keys]
+
+    def command_dbsize(self):
+        return sum(1 for key in list(self.state.values) if self.state.live(key))
+
+    def command_flushdb(self, *options):
+        self.state.values.clear()
+        self.state.expiries.clear()
+
+        return SimpleString(b"OK")
+
+
+class SimpleString(bytes):
+    pass
+
+
+def encode_reply(reply) -> bytes:
+    if isinstance(reply, SimpleString):
+        return b"+" + reply + b"\r\n"
+    if isinstance(reply, Exception):
+        return f"-{reply}\r\n".encode()
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+    return b"*%d\r\n" % len(reply) + b"".join(encode_reply(r) for r in reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """
+    An in-process stand-in for a Redis server, speaking enough of the protocol
+    for the shared store: strings with expiry, INCRBY, DEL, MGET and SCAN.
+    Use it as a context manager; url is what REDIS_URL would be.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), FakeRedisHandler)
+        self.state = FakeRedisState()
+        self.thread = threading.Thread(
+            target=self.serve_forever, name="fake-redis", daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
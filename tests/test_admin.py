@@ -0,0 +1,56 @@
+import time
+
+import pytest
+from conftest import ADMIN_ADDRESS
+
+pytest.importorskip("mongomock")
+
+from auth import admin_token_verifier  # noqa: E402
+
+
+def admin_token(address: str) -> str:
+    return admin_token_verifier.issue(
+        {"publicAddress": address, "exp": time.time() + 3600}
+    )
+
+
+def test_admin_token_reaches_admin_route(app_client):
+    # checksummed in the token, lower case in ADMIN_ADDRESSES
+    token = admin_token(ADMIN_ADDRESS.upper().replace("0X", "0x"))
+
+    response = app_client.post(
+        "/verify_signatures", json={"token": token, "items": []}
+    ).json()
+
+    assert response["status_code"] == 200
+    assert response["detail"] == {"results": []}
+
+
+def test_other_admin_token_is_refused(app_client):
+    token = admin_token("0x00000000000000000000000000000000000000ff")
+
+    response = app_client.post(
+        "/verify_signatures", json={"token": token, "items": []}
+    ).json()
+
+    assert response["status_code"] == 401
+
+
+def test_invalid_token_is_refused(app_client):
+    response = app_client.post(
+        "/verify_signatures", json={"token": "not-a-token", "items": []}
+    ).json()
+
+    assert response["status_code"] == 401
+
+
+def test_db_stats_requires_an_admin(app_client):
+    token = admin_token(ADMIN_ADDRESS)
+
+    stats = app_client.post("/db_stats/", json={"token": token}).json()
+    refused = app_client.post("/db_stats/", json={"token": "not-a-token"}).json()
+
+    assert "caches" in stats
+    assert refused["status_code"] == 401
+    assert "caches" not in refused
+    assert app_client.get("/db_stats/").status_code == 405
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+pytest.importorskip("mongomock")
+
+from auth import token_verifier  # noqa: E402
+
+SELLER = "0xseller"
+BIDDER = "0xbidder"
+
+
+def token(address: str) -> str:
+    return token_verifier.issue({"publicAddress": address, "exp": time.time() + 3600})
+
+
+@pytest.fixture
+def auctioned(db):
+    """
+    :return: horse 1, on auction by the seller, whose deadline has passed
+    with the bidder's bid the highest
+    """
+    database = db.get_database("horses")
+    database["users"].insert_many(
+        [
+            {
+                "publicAddress": SELLER,
+                "nonce": 0,
+                "myHorses": [{"horseId": 1, "status": 4}],
+                "soldHorses": [],
+                "myBids": [],
+            },
+            {
+                "publicAddress": BIDDER,
+                "nonce": 0,
+                "myHorses": [],
+                "soldHorses": [],
+                "myBids": [
+                    {
+                        "horseId": 1,
+                        "auctionId": 0,
+                        "bid": "50",
+                        "isClaimed": False,
+                        "status": "Active",
+                    }
+                ],
+            },
+        ]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 1,
+            "publicAddress": SELLER,
+            "status": 4,
+            "totalAmount": 100,
+            "shareHolders": [{"publicAddress": SELLER, "percentage": 100}],
+            "saleInfo": [],
+            "saleHistory": [],
+            "auctionInfo": [
+                {
+                    "status": "active",
+                    "highestBid": "50",
+                    "highestBidder": BIDDER,
+                    "ps": "100",
+                    "deadline": int(time.time()) - 60,
+                    "bidHistory": [],
+                }
+            ],
+        }
+    )
+    return database
+
+
+def test_end_auction_settles_the_winning_bid(db, auctioned):
+    response = db.end_auction(1, BIDDER, SELLER, token(SELLER))
+
+    assert response.status_code == 200
+    horse = auctioned["horses"].find_one({"horseId": 1})
+    assert horse["shareHolders"] == [{"publicAddress": BIDDER, "percentage": 100}]
+    assert horse["auctionInfo"][0]["status"] == "Ended"
+    assert horse["saleHistory"][0]["buyer"] == BIDDER
+
+    bidder = auctioned["users"].find_one({"publicAddress": BIDDER})
+    assert bidder["myHorses"] == [{"horseId": 1, "status": 2}]
+    assert bidder["myBids"][0]["status"] == "Accepted"
+    seller = auctioned["users"].find_one({"publicAddress": SELLER})
+    assert seller["myHorses"] == []
+
+
+def test_end_auction_is_refused_while_running(db, auctioned):
+    auctioned["horses"].update_one(
+        {"horseId": 1},
+        {"$set": {"auctionInfo.0.deadline": int(time.time()) + 3600}},
+    )
+
+    response = db.end_auction(1, BIDDER, SELLER, token(SELLER))
+
+    assert response.status_code == 401
+    horse = auctioned["horses"].find_one({"horseId": 1})
+    assert horse["shareHolders"] == [{"publicAddress": SELLER, "percentage": 100}]
+
+
+def test_accept_a_bid_closes_the_last_auction(db, auctioned):
+    response = db.accept_a_bid(1, SELLER, BIDDER, 50)
+
+    assert response.status_code == 200
+    horse = auctioned["horses"].find_one({"horseId": 1})
+    assert horse["publicAddress"] == BIDDER
+    assert horse["auctionInfo"][0]["status"] == "passive"
+    assert "auctionInfo.-1status" not in horse
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import jwt
+import pytest
+
+import auth
+from auth import TokenRevoked, TokenVerifier, authenticate, token_verifier
+
+
+@pytest.fixture
+def verifier(monkeypatch):
+    # revocations stay with this worker
+    monkeypatch.setattr(auth, "shared_store", None)
+    return TokenVerifier("users", "test-secret", max_size=2)
+
+
+def issue(verifier: TokenVerifier, address: str, expires_in: float = 3600) -> str:
+    return verifier.issue({"publicAddress": address, "exp": time.time() + expires_in})
+
+
+def test_claims_are_decoded_once(verifier, monkeypatch):
+    token = issue(verifier, "0xa")
+    decoded = []
+    decode = jwt.decode
+
+    def counted(*args, **kwargs):
+        decoded.append(args[0])
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(jwt, "decode", counted)
+
+    first, again = verifier.verify(token), verifier.verify(token)
+
+    assert decoded == [token]
+    assert again.claims is first.claims
+    assert again.public_address == "0xa"
+    assert verifier.as_dict()["hits"] == 1
+    assert verifier.as_dict()["misses"] == 1
+
+
+def test_claims_are_kept_until_the_token_expires(verifier, monkeypatch):
+    token = issue(verifier, "0xa", expires_in=60)
+    verifier.verify(token)
+
+    # past its expiry the claims are dropped, and the token decoded again
+    later = time.time() + 61
+    monkeypatch.setattr(auth, "time", SimpleNamespace(time=lambda: later))
+    assert verifier.cached(auth.token_key(token)) is None
+    assert verifier.as_dict()["size"] == 0
+
+
+def test_expired_token_is_refused(verifier):
+    token = issue(verifier, "0xa", expires_in=-1)
+
+    with pytest.raises(jwt.ExpiredSignatureError):
+        verifier.verify(token)
+    assert verifier.as_dict()["failures"] == 1
+    assert verifier.as_dict()["size"] == 0
+
+
+def test_least_recently_used_claims_are_dropped(verifier):
+    first, second, third = (issue(verifier, a) for a in ("0xa", "0xb", "0xc"))
+    verifier.verify(first)
+    verifier.verify(second)
+    verifier.verify(first)
+
+    verifier.verify(third)
+
+    assert list(verifier.claims) == [auth.token_key(first), auth.token_key(third)]
+    verifier.verify(second)
+    assert verifier.as_dict()["misses"] == 4
+
+
+def test_revoked_token_is_refused_though_cached(verifier):
+    token = issue(verifier, "0xa")
+    verifier.verify(token)
+
+    verifier.revoke(token)
+
+    with pytest.raises(TokenRevoked):
+        verifier.verify(token)
+    with pytest.raises(TokenRevoked):
+        asyncio.run(verifier.verify_async(token))
+    assert verifier.as_dict()["revoked"] == 1
+    # other tokens of the same address are still accepted
+    assert verifier.verify(issue(verifier, "0xa", 7200)).public_address == "0xa"
+
+
+def test_revocation_without_a_shared_store_is_per_worker(verifier):
+    other = TokenVerifier("users", "test-secret")
+    token = issue(verifier, "0xa")
+
+    verifier.revoke(token)
+
+    assert other.verify(token).public_address == "0xa"
+
+
+def test_authenticated_reuses_the_principal_of_the_request(verifier):
+    token, other_token = issue(verifier, "0xa"), issue(verifier, "0xb")
+    admins = TokenVerifier("admins", "test-secret")
+
+    async def request():
+        request = SimpleNamespace(state=SimpleNamespace())
+        principal = await authenticate(request, token, verifier)
+        lookups = verifier.as_dict()["hits"] + verifier.as_dict()["misses"]
+
+        assert request.state.principal is principal
+        assert verifier.authenticated(token) is principal
+        assert verifier.as_dict()["hits"] + verifier.as_dict()["misses"] == lookups
+        # another token, or a token of another verifier, is verified
+        assert verifier.authenticated(other_token).public_address == "0xb"
+        assert admins.authenticated(token) is not principal
+
+    asyncio.run(request())
+    assert auth.current_principal.get() is None
+
+
+def test_invalid_token_is_not_authenticated(verifier):
+    request = SimpleNamespace(state=SimpleNamespace())
+
+    assert asyncio.run(authenticate(request, "not-a-token", verifier)) is None
+    assert not hasattr(request.state, "principal")
+
+
+def test_logout_says_whether_the_revocation_is_shared(app_client):
+    token = token_verifier.issue(
+        {"publicAddress": "0xlogout", "exp": time.time() + 3600}
+    )
+
+    response = app_client.post("/logout", json={"token": token}).json()
+
+    assert response["status_code"] == 200
+    assert response["detail"]["shared"] is False
+    with pytest.raises(TokenRevoked):
+        token_verifier.verify(token)
@@ -0,0 +1,228 @@
+import asyncio
+import random
+import threading
+
+import pytest
+from pymongo.errors import PyMongoError
+
+from bidding import BidError, place_bid, plan_bid
+from sync_driver import ReadyCollection, ReadyDatabase, run
+
+mongomock = pytest.importorskip("mongomock")
+
+OWNER = "0xowner"
+
+
+def auction(database, bidders: list):
+    database["users"].insert_many(
+        [{"publicAddress": address, "myBids": []} for address in bidders]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 0,
+            "publicAddress": OWNER,
+            "status": 4,
+            "auctionInfo": [{"highestBid": "0", "highestBidder": "", "bidHistory": []}],
+        }
+    )
+
+
+class FailingUsers:
+    """
+    A users collection whose myBids writes fail.
+    """
+
+    def bulk_write(self, *args, **kwargs):
+        raise PyMongoError("users unavailable")
+
+
+def test_concurrent_bids_are_all_recorded():
+    # mongomock applies no array filters, so every bidder bids once
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient()["bidding_test"]
+    bidders = [f"0xbidder{i}" for i in range(50)]
+    sent = {address: random.randint(1, 1000) for address in bidders}
+
+    async def bid(address: str):
+        horse = await database["horses"].find_one({"horseId": 0})
+        # let the other bidders plan from the same read
+        await asyncio.sleep(0)
+        await place_bid(
+            database["horses"], database["users"], horse, address, sent[address]
+        )
+
+    async def run():
+        await database["users"].insert_many(
+            [{"publicAddress": address, "myBids": []} for address in bidders]
+        )
+        await database["horses"].insert_one(
+            {
+                "horseId": 0,
+                "publicAddress": OWNER,
+                "status": 4,
+                "auctionInfo": [
+                    {"highestBid": "0", "highestBidder": "", "bidHistory": []}
+                ],
+            }
+        )
+        await asyncio.gather(*(bid(address) for address in bidders))
+
+        horse = await database["horses"].find_one({"horseId": 0})
+        users = await database["users"].find().to_list(length=None)
+        return horse["auctionInfo"][-1], users
+
+    last_auction, users = asyncio.run(run())
+
+    totals = {
+        b["bidderAddress"]: int(b["bidAmount"]) for b in last_auction["bidHistory"]
+    }
+    assert totals == sent
+    assert int(last_auction["highestBid"]) == max(sent.values())
+    for user in users:
+        (my_bid,) = user["myBids"]
+        assert int(my_bid["bidInfo"]["bidAmount"]) == sent[user["publicAddress"]]
+
+
+class Server(ReadyCollection):
+    """
+    A ready mongomock collection applying one operation at a time, as the
+    server applies each write atomically, and resolving the array filters
+    mongomock ignores.
+    """
+
+    lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        method = getattr(self.delegate, name)
+
+        async def call(*args, array_filters=None, **kwargs):
+            with self.lock:
+                if array_filters:
+                    document = self.delegate.find_one(args[0])
+                    if document is None:
+                        return None
+                    args = (args[0], filtered(document, args[1], array_filters))
+                return method(*args, **kwargs)
+
+        return call
+
+
+def filtered(document: dict, update: dict, array_filters: list) -> dict:
+    """
+    :return: the update with every $[identifier] replaced by the index of the
+    first element matching its filter
+    """
+    conditions = {}
+    for array_filter in array_filters:
+        for path, value in array_filter.items():
+            identifier, field = path.split(".", 1)
+            conditions.setdefault(identifier, {})[field] = value
+
+    resolved = {}
+    for operator, fields in update.items():
+        resolved[operator] = {}
+        for path, value in fields.items():
+            for identifier, condition in conditions.items():
+                head, marker, tail = path.partition(f".$[{identifier}]")
+                if not marker:
+                    continue
+                array = document
+                for key in head.split("."):
+                    array = array[int(key)] if isinstance(array, list) else array[key]
+                index = next(
+                    i
+                    for i, element in enumerate(array)
+                    if all(element.get(k) == v for k, v in condition.items())
+                )
+                path = f"{head}.{index}{tail}"
+            resolved[operator][path] = value
+
+    return resolved
+
+
+def test_threaded_repeat_bids_keep_the_true_maximum():
+    database = mongomock.MongoClient()["bidding_test"]
+    bidders = [f"0xbidder{i}" for i in range(8)]
+    auction(database, bidders)
+    horses, users = Server(database["horses"]), Server(database["users"])
+    sent = {address: 0 for address in bidders}
+    failures = []
+    # every round, the bidders plan from the same read
+    rounds = threading.Barrier(len(bidders))
+
+    def bid(address: str):
+        for _ in range(5):
+            amount = random.randint(1, 100)
+            try:
+                horse = run(horses.find_one({"horseId": 0}))
+                rounds.wait()
+                run(place_bid(horses, users, horse, address, amount))
+                sent[address] += amount
+            except BidError as e:
+                failures.append(e)
+
+    threads = [threading.Thread(target=bid, args=(a,)) for a in bidders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    last_auction = database["horses"].find_one({"horseId": 0})["auctionInfo"][-1]
+    totals = {
+        b["bidderAddress"]: int(b["bidAmount"]) for b in last_auction["bidHistory"]
+    }
+    assert totals == sent
+    assert len(last_auction["bidHistory"]) == len(bidders)
+    assert int(last_auction["highestBid"]) == max(sent.values())
+    assert sent[last_auction["highestBidder"]] == max(sent.values())
+    for user in database["users"].find():
+        (my_bid,) = user["myBids"]
+        assert int(my_bid["bidInfo"]["bidAmount"]) == sent[user["publicAddress"]]
+
+
+def test_failed_my_bids_write_undoes_the_bid():
+    database = mongomock.MongoClient()["bidding_test"]
+    ready = ReadyDatabase(database)
+    auction(database, ["0xfirst", "0xsecond"])
+    run(
+        place_bid(
+            ready["horses"],
+            ready["users"],
+            database["horses"].find_one({"horseId": 0}),
+            "0xfirst",
+            10,
+        )
+    )
+
+    horse = database["horses"].find_one({"horseId": 0})
+
+    with pytest.raises(PyMongoError):
+        run(place_bid(ready["horses"], FailingUsers(), horse, "0xsecond", 20))
+
+    last_auction = database["horses"].find_one({"horseId": 0})["auctionInfo"][-1]
+    assert last_auction["highestBid"] == "10"
+    assert last_auction["highestBidder"] == "0xfirst"
+    # mongomock ignores $pull on an indexed path, so the bidHistory entry
+    # is only checked as planned
+    assert plan_bid(horse, "0xsecond", 20, "today").undo[-1]._doc["$pull"] == {
+        "auctionInfo.0.bidHistory": {"bidderAddress": "0xsecond", "bidAmount": "20"}
+    }
+
+
+def test_bid_must_be_positive():
+    database = mongomock.MongoClient()["bidding_test"]
+    auction(database, ["0xfirst"])
+
+    ready = ReadyDatabase(database)
+
+    with pytest.raises(BidError):
+        run(
+            place_bid(
+                ready["horses"],
+                ready["users"],
+                database["horses"].find_one({"horseId": 0}),
+                "0xfirst",
+                0,
+            )
+        )
@@ -0,0 +1,182 @@
+import asyncio
+
+import pytest
+from pymongo.errors import OperationFailure, PyMongoError
+
+from change_feed import HISTORY_LOST_CODES, ChangeFeed
+from document_cache import caches, horse_cache, user_cache
+
+
+def change(token: str, operation: str = "update", coll: str = "horses", _id=None):
+    return {
+        "_id": token,
+        "operationType": operation,
+        "ns": {"db": "horses", "coll": coll},
+        "documentKey": {"_id": _id},
+    }
+
+
+class Stream:
+    """
+    A change stream returning its changes, then failing with error if one is
+    given, else ending after an empty batch resumable from resume_token.
+    """
+
+    def __init__(self, changes: list, error: Exception = None, resume_token=None):
+        self.changes = list(changes)
+        self.error = error
+        self.resume_token = None
+        self.batch_token = resume_token
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def try_next(self):
+        if self.changes:
+            return self.changes.pop(0)
+        if self.error is not None:
+            raise self.error
+
+        self.alive = False
+        self.resume_token = self.batch_token
+        return None
+
+
+class Database:
+    """
+    Opens the given streams in turn, recording where each was resumed from,
+    then stops the feed.
+    """
+
+    def __init__(self, feed: ChangeFeed, streams: list):
+        self.feed = feed
+        self.streams = list(streams)
+        self.resumed = []
+
+    def watch(self, pipeline: list, resume_after=None, **kwargs):
+        self.resumed.append(resume_after)
+        if not self.streams:
+            self.feed.stopped.set()
+            return Stream([])
+
+        return self.streams.pop(0)
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    monkeypatch.setattr("change_feed.CHANGE_STREAM_RETRY_SECONDS", 0)
+    for cache in caches.values():
+        cache.reset()
+
+    return ChangeFeed()
+
+
+def cache_horse(horse_id: int, _id: str):
+    horse_cache.put(horse_id, {"_id": _id, "horseId": horse_id}, horse_cache.ticket())
+
+
+def test_update_evicts_the_document_by_id(feed):
+    cache_horse(1, "h1")
+    cache_horse(2, "h2")
+
+    feed.apply(change("t1", _id="h1"))
+
+    assert horse_cache.get(1) is None
+    assert horse_cache.get(2) is not None
+    assert feed.resume_token == "t1"
+
+
+def test_drop_clears_the_collection(feed):
+    cache_horse(1, "h1")
+    user_cache.put("0xa", {"_id": "u1"}, user_cache.ticket())
+
+    feed.apply(change("t1", operation="drop"))
+
+    assert horse_cache.get(1) is None
+    assert user_cache.get("0xa") is not None
+    assert feed.as_dict()["flushes"] == 0
+
+
+def test_invalidate_flushes_and_cannot_be_resumed(feed):
+    cache_horse(1, "h1")
+    user_cache.put("0xa", {"_id": "u1"}, user_cache.ticket())
+    feed.apply(change("t1", _id="h9"))
+
+    feed.apply(change("t2", operation="invalidate"))
+
+    assert horse_cache.get(1) is None
+    assert user_cache.get("0xa") is None
+    assert feed.resume_token is None
+    assert feed.as_dict()["flushes"] == 1
+
+
+def test_apply_async_evicts_as_apply(feed):
+    cache_horse(1, "h1")
+
+    asyncio.run(feed.apply_async(change("t1", _id="h1")))
+
+    assert horse_cache.get(1) is None
+    assert feed.resume_token == "t1"
+
+
+def test_failed_stream_resumes_after_the_last_token(feed):
+    cache_horse(3, "h3")
+    database = Database(
+        feed,
+        [
+            Stream(
+                [change("t1", _id="h1"), change("t2", _id="h2")],
+                error=PyMongoError("connection reset"),
+            ),
+            Stream([change("t3", _id="h3")], resume_token="t4"),
+        ],
+    )
+
+    feed.watch(database)
+
+    assert database.resumed == [None, "t2", "t4"]
+    assert horse_cache.get(3) is None
+    assert feed.as_dict()["changes"] == 3
+    assert feed.as_dict()["reopened"] == 1
+    assert feed.as_dict()["flushes"] == 0
+
+
+@pytest.mark.parametrize("code", HISTORY_LOST_CODES)
+def test_lost_history_flushes_the_caches(feed, code):
+    cache_horse(2, "h2")
+    database = Database(
+        feed,
+        [
+            Stream([change("t1", _id="h1")], error=OperationFailure("lost", code=code)),
+        ],
+    )
+
+    feed.watch(database)
+
+    # started again from now, having flushed what may have been missed
+    assert database.resumed == [None, None]
+    assert horse_cache.get(2) is None
+    assert feed.as_dict()["flushes"] == 1
+
+
+def test_other_operation_failure_resumes(feed):
+    cache_horse(2, "h2")
+    database = Database(
+        feed,
+        [
+            Stream(
+                [change("t1", _id="h1")],
+                error=OperationFailure("interrupted", code=11601),
+            ),
+        ],
+    )
+
+    feed.watch(database)
+
+    assert database.resumed == [None, "t1"]
+    assert horse_cache.get(2) is not None
+    assert feed.as_dict()["flushes"] == 0
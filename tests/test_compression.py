@@ -0,0 +1,169 @@
+import gzip
+import json
+
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import compression
+from compression import (
+    COMPRESSION_MIN_BYTES,
+    CompressionMiddleware,
+    VariantCache,
+    negotiate,
+)
+
+BODY = json.dumps([{"horseId": i, "name": f"Horse {i}"} for i in range(200)]).encode()
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, encoding",
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("GZIP;q=0.5", "gzip"),
+        # ties go to the order of RESPONSE_ENCODINGS
+        ("gzip, br, zstd", "zstd"),
+        ("gzip, br", "br"),
+        ("gzip;q=1.0, br;q=0.9", "gzip"),
+        ("zstd;q=0, br;q=0, gzip;q=0", None),
+        ("br;q=0, gzip", "gzip"),
+        ("*", "zstd"),
+        ("*;q=0.5, zstd;q=0, br;q=0.1", "gzip"),
+        ("*;q=0", None),
+        ("gzip;q=oops, br", "br"),
+    ],
+)
+def test_negotiation(accept_encoding, encoding, monkeypatch):
+    monkeypatch.setattr(compression, "encodings", ["zstd", "br", "gzip"])
+
+    assert negotiate(accept_encoding) == encoding
+
+
+def test_uninstalled_encodings_are_never_chosen(monkeypatch):
+    monkeypatch.setattr(compression, "encodings", ["gzip"])
+
+    assert negotiate("zstd, br") is None
+    assert negotiate("zstd, br, *;q=0.1") == "gzip"
+
+
+def catalogue(request):
+    size = int(request.query_params.get("size", len(BODY)))
+    headers = {"ETag": request.query_params.get("etag", '"horses-1"')}
+    return Response(BODY[:size], media_type="application/json", headers=headers)
+
+
+def export(request):
+    async def chunks():
+        yield BODY
+        yield BODY
+
+    return StreamingResponse(chunks(), media_type="application/json")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(compression, "variant_cache", VariantCache())
+    app = Starlette(
+        routes=[Route("/catalogue", catalogue), Route("/export", export)],
+        middleware=[Middleware(CompressionMiddleware)],
+    )
+    return TestClient(app)
+
+
+@pytest.fixture
+def compressions(monkeypatch):
+    """
+    :return: the encodings of every body compressed
+    """
+    compressed = []
+    compress = compression.compress
+
+    def counted(body: bytes, encoding: str) -> bytes:
+        compressed.append(encoding)
+        return compress(body, encoding)
+
+    monkeypatch.setattr(compression, "compress", counted)
+    return compressed
+
+
+def get(client, path: str, encoding: str = "gzip", **params):
+    return client.get(path, params=params, headers={"Accept-Encoding": encoding})
+
+
+def test_body_is_compressed_and_its_etag_weakened(client):
+    response = get(client, "/catalogue")
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == 'W/"horses-1"'
+    # the test client decodes the body
+    assert int(response.headers["Content-Length"]) == len(
+        gzip.compress(BODY, compresslevel=compression.GZIP_LEVEL, mtime=0)
+    )
+    assert response.content == BODY
+
+
+def test_weak_etag_is_kept(client):
+    response = get(client, "/catalogue", etag='W/"horses-2"')
+
+    assert response.headers["ETag"] == 'W/"horses-2"'
+
+
+def test_identity_response_keeps_its_strong_etag(client):
+    response = get(client, "/catalogue", encoding="identity")
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == '"horses-1"'
+    assert response.content == BODY
+
+
+def test_bodies_below_the_threshold_are_sent_as_they_are(client):
+    small = get(client, "/catalogue", size=COMPRESSION_MIN_BYTES - 1)
+    large = get(client, "/catalogue", size=COMPRESSION_MIN_BYTES)
+
+    assert "Content-Encoding" not in small.headers
+    assert "Vary" not in small.headers
+    assert large.headers["Content-Encoding"] == "gzip"
+
+
+def test_streamed_responses_are_sent_as_they_are(client):
+    response = get(client, "/export")
+
+    assert "Content-Encoding" not in response.headers
+    assert response.content == BODY + BODY
+
+
+def test_variants_are_reused_by_etag(client, compressions):
+    first = get(client, "/catalogue").content
+    again = get(client, "/catalogue").content
+    assert compressions == ["gzip"]
+    assert again == first
+
+    # another encoding, or another ETag, is another variant
+    get(client, "/catalogue", encoding="br")
+    get(client, "/catalogue", etag='"horses-2"')
+    assert compressions == ["gzip", "br", "gzip"]
+
+
+def test_variant_cache_drops_the_least_recently_used():
+    cache = VariantCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+
+    cache.put("c", b"1234")
+    # larger than the whole cache, never kept
+    cache.put("d", b"x" * 11)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") == b"1234"
+    assert cache.get("d") is None
+    assert cache.size == 8
@@ -0,0 +1,46 @@
+from document_cache import DocumentCache
+
+
+def test_write_of_another_document_does_not_stop_caching():
+    cache = DocumentCache()
+    ticket = cache.ticket()
+
+    cache.forget(2)
+    cache.put(1, {"horseId": 1}, ticket)
+
+    assert cache.get(1) == {"horseId": 1}
+
+
+def test_read_started_before_its_write_is_not_cached():
+    cache = DocumentCache()
+    ticket = cache.ticket()
+
+    cache.forget(1)
+    cache.put(1, {"horseId": 1}, ticket)
+
+    assert cache.get(1) is None
+    cache.put(1, {"horseId": 1}, cache.ticket())
+    assert cache.get(1) == {"horseId": 1}
+
+
+def test_write_by_unknown_id_stops_every_read_in_flight():
+    cache = DocumentCache()
+    ticket = cache.ticket()
+
+    cache.forget_id("unknown")
+    cache.put(1, {"horseId": 1}, ticket)
+
+    assert cache.get(1) is None
+
+
+def test_forgotten_keys_are_bounded():
+    cache = DocumentCache(max_size=2)
+    ticket = cache.ticket()
+
+    for key in (1, 2, 3):
+        cache.forget(key)
+    cache.put(1, {"horseId": 1}, ticket)
+
+    # 1 is no longer tracked on its own, the floor still refuses it
+    assert len(cache.forgotten) == 2
+    assert cache.get(1) is None
@@ -0,0 +1,81 @@
+import msgpack
+import pytest
+from fastapi.exceptions import HTTPException
+
+from etags import collection_etag, counts_changes, etag_matches
+from json_responses import MSGPACK_MEDIA_TYPE
+from sync_driver import run
+
+
+class Wrapper:
+    def __init__(self):
+        self.changes = 0
+
+    async def count_change(self, counter: str):
+        self.changes += 1
+
+    @counts_changes("horses")
+    async def write(self, result):
+        if isinstance(result, KeyError):
+            raise result
+        return result
+
+
+@pytest.mark.parametrize(
+    "result, counted",
+    [
+        (HTTPException(200, {"message": "Bid placed", "status": "success"}), True),
+        (HTTPException(200, {"message": "Horse bought", "response": True}), True),
+        (HTTPException(200, {"message": "Horse does not exist"}), False),
+        (HTTPException(401, {"message": "Invalid token", "response": False}), False),
+        (KeyError("horseId"), False),
+    ],
+)
+def test_only_successful_writes_change_the_etag(result, counted):
+    wrapper = Wrapper()
+
+    try:
+        run(wrapper.write(result))
+    except KeyError:
+        pass
+
+    assert wrapper.changes == (1 if counted else 0)
+
+
+def test_collection_etag_is_weak():
+    etag = collection_etag("horses", 3)
+
+    assert etag == 'W/"horses-3"'
+    assert etag_matches(etag, etag)
+    assert etag_matches('"horses-3"', etag)
+    assert not etag_matches('W/"horses-2"', etag)
+
+
+def test_get_horse_etag_names_the_format(app_client, mongo_client):
+    mongo_client["horses"]["horses"].insert_one({"horseId": 1, "version": 2})
+    packed = {"Content-Type": MSGPACK_MEDIA_TYPE, "Accept": MSGPACK_MEDIA_TYPE}
+    body = msgpack.packb({"horseId": 1})
+
+    as_msgpack = app_client.post("/get_horse/", data=body, headers=packed)
+    as_json = app_client.post("/get_horse/", json={"horseId": 1})
+
+    assert msgpack.unpackb(as_msgpack.content)["detail"]["horse"]["horseId"] == 1
+    assert as_msgpack.headers["ETag"] == '"horse-1-v2-msgpack"'
+    assert as_json.headers["ETag"] == '"horse-1-v2"'
+
+    revalidated = app_client.post(
+        "/get_horse/",
+        data=body,
+        headers=dict(packed, **{"If-None-Match": as_msgpack.headers["ETag"]}),
+    )
+    assert revalidated.status_code == 304
+    assert revalidated.headers["Vary"] == "Accept"
+
+    # the JSON body held is not the MessagePack one asked for
+    switched = app_client.post(
+        "/get_horse/",
+        data=body,
+        headers=dict(packed, **{"If-None-Match": as_json.headers["ETag"]}),
+    )
+    assert switched.status_code == 200
+    assert switched.headers["ETag"] == '"horse-1-v2-msgpack"'
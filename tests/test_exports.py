@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from bson import Decimal128, ObjectId
+
+from exports import ndjson_chunks
+from json_responses import dumps
+
+
+class Cursor(list):
+    def close(self):
+        pass
+
+
+def test_export_lines_match_the_json_responses():
+    document = {
+        "_id": ObjectId(),
+        "price": Decimal128("0.100000000000000000000000001"),
+        "createdAt": datetime(2022, 11, 5, 12, 30),
+        "totalAmount": 100,
+    }
+
+    chunks = list(ndjson_chunks(Cursor([document, document]), batch_size=1))
+
+    assert chunks == [dumps(document) + b"\n"] * 2
+    assert b'"price":"0.100000000000000000000000001"' in chunks[0]
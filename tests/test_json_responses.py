@@ -0,0 +1,83 @@
+import msgpack
+import pytest
+from fastapi.exceptions import HTTPException
+from fastapi.responses import Response
+
+from json_responses import (
+    JSON_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE,
+    DocumentResponse,
+    negotiate_media_type,
+    quality,
+    respond,
+)
+from request_context import current_media_type
+
+
+@pytest.mark.parametrize(
+    "accept, media_type",
+    [
+        (None, JSON_MEDIA_TYPE),
+        ("*/*", JSON_MEDIA_TYPE),
+        ("application/msgpack", MSGPACK_MEDIA_TYPE),
+        ("application/x-msgpack", MSGPACK_MEDIA_TYPE),
+        ("application/json, application/msgpack;q=0.5", JSON_MEDIA_TYPE),
+        ("application/msgpack;q=0.9, application/json;q=0.8", MSGPACK_MEDIA_TYPE),
+        ("application/msgpack;q=0", JSON_MEDIA_TYPE),
+        ("application/msgpack;q=0.2, application/*;q=0.9", JSON_MEDIA_TYPE),
+        ("application/msgpack, application/*;q=0.1", MSGPACK_MEDIA_TYPE),
+        # a tie goes to MessagePack, named by the client
+        ("application/*, application/msgpack", MSGPACK_MEDIA_TYPE),
+        ("application/msgpack;q=oops, application/json", JSON_MEDIA_TYPE),
+    ],
+)
+def test_accept_negotiation(accept, media_type):
+    assert negotiate_media_type(accept) == media_type
+
+
+def test_quality_of_the_most_specific_range():
+    accept = "*/*;q=0.1, application/*;q=0.5, application/json;q=0.3"
+
+    assert quality(accept, (JSON_MEDIA_TYPE,)) == 0.3
+    assert quality(accept, (MSGPACK_MEDIA_TYPE,)) == 0.5
+    assert quality("text/html", (JSON_MEDIA_TYPE,)) == 0.0
+
+
+def test_integers_beyond_64_bits_fall_back_to_json():
+    content = {"supply": 2**70}
+
+    document = DocumentResponse(content, media_type=MSGPACK_MEDIA_TYPE)
+
+    assert document.media_type == JSON_MEDIA_TYPE
+    assert document.headers["Content-Type"] == JSON_MEDIA_TYPE
+    assert document.body == b'{"supply":1180591620717411303424}'
+
+
+def test_fallback_drops_the_etag_of_the_other_format():
+    response = Response()
+    response.headers["ETag"] = '"horse-1-v2-msgpack"'
+    token = current_media_type.set(MSGPACK_MEDIA_TYPE)
+    try:
+        too_big = respond({"supply": 2**70}, response)
+        packed = respond({"supply": 2**60}, response)
+    finally:
+        current_media_type.reset(token)
+
+    assert "ETag" not in too_big.headers
+    assert packed.headers["ETag"] == '"horse-1-v2-msgpack"'
+    assert msgpack.unpackb(packed.body) == {"supply": 2**60}
+    assert packed.headers["Vary"] == "Accept"
+
+
+def test_exceptions_are_written_as_their_attributes():
+    token = current_media_type.set(MSGPACK_MEDIA_TYPE)
+    try:
+        document = respond(HTTPException(200, {"message": "Horse exists", 0: 1}))
+    finally:
+        current_media_type.reset(token)
+
+    assert msgpack.unpackb(document.body) == {
+        "status_code": 200,
+        "detail": {"message": "Horse exists", "0": 1},
+        "headers": None,
+    }
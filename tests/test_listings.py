@@ -0,0 +1,174 @@
+import pytest
+from pymongo.errors import BulkWriteError
+
+from listings import listing_summary, listing_write, relist_horse, stale_listings
+from sync_driver import ReadyDatabase, run
+
+mongomock = pytest.importorskip("mongomock")
+
+
+def horse(horse_id: int, status: int = 3, version: int = 1, **fields) -> dict:
+    return {
+        "horseId": horse_id,
+        "horseName": f"Horse {horse_id}",
+        "status": status,
+        "publicAddress": "0xowner",
+        "totalAmount": 100,
+        "saleInfo": [],
+        "auctionInfo": [],
+        "version": version,
+        **fields,
+    }
+
+
+@pytest.fixture
+def database():
+    database = mongomock.MongoClient()["horses"]
+    database["listings"].create_index("horseId", unique=True)
+    return database
+
+
+def test_summary_of_a_horse_on_sale():
+    listing = listing_summary(
+        horse(
+            1,
+            saleInfo=[
+                {"saleId": 0, "onMarket": 10, "price": "7.5"},
+                {"saleId": 1, "onMarket": 5, "price": "3"},
+                {"saleId": 2, "onMarket": 0, "price": "1"},
+            ],
+            auctionInfo=[{"highestBid": "9", "deadline": 100}],
+        )
+    )
+
+    # sold out sales do not count, nor does an auction of a horse on sale
+    assert listing["price"] == 3.0
+    assert listing["sharesOnMarket"] == 15
+    assert listing["highestBid"] is None
+    assert listing["deadline"] is None
+    assert listing["ownerAddress"] == "0xowner"
+
+
+def test_summary_of_a_horse_on_auction():
+    listing = listing_summary(
+        horse(
+            1,
+            status=4,
+            auctionInfo=[
+                {"highestBid": "1", "deadline": 50},
+                {"highestBid": "12", "openingBid": "not a number", "deadline": 100},
+            ],
+        )
+    )
+
+    assert listing["highestBid"] == 12.0
+    assert listing["openingBid"] is None
+    assert listing["deadline"] == 100
+    assert listing["price"] is None
+
+
+@pytest.mark.parametrize("listed", [None, horse(1, status=2)])
+def test_no_summary_off_the_marketplace(listed):
+    assert listing_summary(listed) is None
+
+
+def test_older_version_does_not_replace_a_newer_listing(database):
+    database["listings"].bulk_write([listing_write(1, horse(1, version=5))])
+
+    # read before the version 5 write landed
+    database["horses"].insert_one(horse(1, version=4, horseName="Stale"))
+    run(relist_horse(ReadyDatabase(database), 1))
+
+    listing = database["listings"].find_one({"horseId": 1})
+    assert listing["version"] == 5
+    assert listing["horseName"] == "Horse 1"
+
+
+def test_older_version_does_not_delete_a_newer_listing(database):
+    database["listings"].bulk_write([listing_write(1, horse(1, version=5))])
+
+    database["listings"].bulk_write([listing_write(1, horse(1, status=2, version=4))])
+    assert database["listings"].count_documents({"horseId": 1}) == 1
+
+    database["listings"].bulk_write([listing_write(1, horse(1, status=2, version=6))])
+    assert database["listings"].count_documents({"horseId": 1}) == 0
+
+
+def test_stale_listings_are_those_lagging_their_horse(database):
+    database["horses"].insert_many(
+        [
+            horse(1, version=2),
+            horse(2, version=3),
+            horse(3, version=1),
+            horse(4, status=2, version=7),
+        ]
+    )
+    database["listings"].bulk_write(
+        [
+            listing_write(1, horse(1, version=2)),
+            listing_write(2, horse(2, version=2)),
+            listing_write(4, horse(4, version=6)),
+        ]
+    )
+
+    stale = run(stale_listings(ReadyDatabase(database)))
+
+    # 2 lags, 3 was never listed, 4 is no longer on the marketplace
+    assert sorted(stale) == [2, 3, 4]
+
+
+def test_reconcile_relists_what_a_failed_relist_left(db, monkeypatch):
+    database = db.get_database("horses")
+    database["horses"].insert_many([horse(1), horse(2)])
+    assert db.ensure_listings() == 2
+
+    async def unavailable(database, horse_id):
+        raise BulkWriteError({"writeErrors": [{"code": 91}]})
+
+    # the write path fails to relist horse 2 after selling out its shares
+    database["horses"].update_one(
+        {"horseId": 2}, {"$set": {"status": 2}, "$inc": {"version": 1}}
+    )
+    monkeypatch.setattr("db_wrapper.relist_horse", unavailable)
+    db.refresh_listing(2)
+    assert database["listings"].count_documents({"horseId": 2}) == 1
+
+    assert db.reconcile_listings() == 1
+    assert db.reconcile_listings() == 0
+    assert [listing["horseId"] for listing in database["listings"].find()] == [1]
+
+
+def test_sorted_listing_pages(db):
+    database = db.get_database("horses")
+    prices = [5, 1, 3, 3, 9, 2]
+    database["horses"].insert_many(
+        [
+            horse(i, saleInfo=[{"saleId": 0, "onMarket": 1, "price": str(p)}])
+            for i, p in enumerate(prices)
+        ]
+    )
+    db.ensure_listings()
+
+    def pages(sort: str) -> list:
+        seen, cursor = [], None
+        while True:
+            detail = db.get_listings(3, sort, 4, cursor).detail
+            seen.append([(item["price"], item["horseId"]) for item in detail["items"]])
+            cursor = detail["nextCursor"]
+            if cursor is None:
+                return seen
+
+    ascending = pages("price")
+    descending = pages("-price")
+
+    assert [len(page) for page in ascending] == [4, 2]
+    assert [p for page in ascending for p, _ in page] == sorted(prices)
+    assert [p for page in descending for p, _ in page] == sorted(prices, reverse=True)
+    # the tied horses are each listed once
+    assert sorted(h for page in ascending for _, h in page) == list(range(6))
+
+
+def test_unknown_sort_is_refused(db):
+    response = db.get_listings(None, "name")
+
+    assert response.status_code == 400
@@ -0,0 +1,211 @@
+import pytest
+
+import db_wrapper
+import membership
+from change_feed import ChangeFeed
+from membership import (
+    BloomFilter,
+    MembershipFilter,
+    filters,
+    horse_filter,
+    member_key,
+    user_filter,
+)
+from sync_driver import ReadyDatabase, run
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture(autouse=True)
+def unbuilt(monkeypatch):
+    # the filters are shared by the whole process, each test starts unbuilt
+    for f in filters.values():
+        monkeypatch.setattr(f, "bloom", None)
+        monkeypatch.setattr(f, "ready", False)
+        monkeypatch.setattr(f, "checks", 0)
+        monkeypatch.setattr(f, "negatives", 0)
+
+
+def built(f: MembershipFilter, *values) -> MembershipFilter:
+    bloom = f.begin()
+    for value in values:
+        bloom.add(member_key(value))
+    f.finish(bloom, 0.0)
+
+    return f
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    # past its capacity it only answers "present" more often
+    keys = [member_key(f"0x{i:040x}") for i in range(5000)] + [
+        member_key(i) for i in range(5000)
+    ]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    assert bloom.count == len(keys)
+
+
+def test_bloom_filter_keeps_its_error_rate_at_capacity():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add(member_key(i))
+
+    positives = sum(member_key(i) in bloom for i in range(10000, 30000))
+
+    assert positives / 20000 < 0.02
+    assert bloom.false_positive_rate() == pytest.approx(0.01, rel=0.2)
+
+
+def test_member_keys_are_equal_where_mongodb_values_are():
+    assert member_key(1) == member_key(1.0)
+    assert member_key(1) != member_key("1")
+    assert member_key(1.5) != member_key(1)
+    # values the filter cannot hold
+    assert member_key(True) is None
+    assert member_key(None) is None
+    assert member_key({"a": 1}) is None
+
+
+def test_filter_answers_only_once_built():
+    f = MembershipFilter("horses", "horseId", capacity=100, error_rate=0.01)
+    assert not f.excludes(1)
+
+    built(f, 1, 2)
+    assert f.excludes(3)
+    assert not f.excludes(1)
+    # values it cannot hold are always queried
+    assert not f.excludes(None)
+
+    f.invalidate()
+    assert not f.excludes(3)
+    assert f.as_dict()["checks"] == 2
+    assert f.as_dict()["negatives"] == 1
+
+
+def test_set_user_and_create_horse_add_their_keys(db):
+    built(user_filter)
+    built(horse_filter)
+    assert db.user_exists("0xowner") is False
+    assert horse_filter.excludes(7)
+
+    db.set_user({"publicAddress": "0xowner", "myHorses": []})
+    db.create_horse({"horseId": 7, "publicAddress": "0xowner", "totalAmount": 100})
+
+    assert not user_filter.excludes("0xowner")
+    assert not horse_filter.excludes(7)
+    assert db.user_exists("0xowner") is True
+    assert db.horse_exists(7) is True
+
+
+def test_failed_insert_still_adds_its_key(db, monkeypatch):
+    built(user_filter)
+
+    async def unavailable(self, user_public_address):
+        raise RuntimeError("not primary")
+
+    monkeypatch.setattr(db_wrapper.DbWrapper, "user_exists", unavailable)
+    # the AsyncDbWrapper behind the motor runs has its own
+    monkeypatch.setattr(type(getattr(db, "wrapper", db)), "user_exists", unavailable)
+    assert isinstance(db.set_user({"publicAddress": "0xlost"}), RuntimeError)
+
+    # a key that may have been inserted must not be excluded
+    assert not user_filter.excludes("0xlost")
+
+
+class Stream:
+    """
+    A change stream returning its changes once, then stopping the feed.
+    """
+
+    def __init__(self, feed: ChangeFeed, changes: list):
+        self.feed = feed
+        self.changes = list(changes)
+        self.resume_token = None
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def try_next(self):
+        if self.changes:
+            return self.changes.pop(0)
+
+        self.alive = False
+        self.feed.stopped.set()
+        return None
+
+
+class Database:
+    """
+    The mongomock database, with a change stream of the given changes.
+    """
+
+    def __init__(self, feed: ChangeFeed, delegate, changes: list):
+        self.feed = feed
+        self.delegate = delegate
+        self.changes = changes
+
+    def __getitem__(self, name: str):
+        return self.delegate[name]
+
+    def watch(self, pipeline: list, **kwargs):
+        return Stream(self.feed, self.changes)
+
+
+def test_auto_filters_stay_unused_until_the_feed_builds_them(db, monkeypatch):
+    monkeypatch.setattr(membership, "MEMBERSHIP_FILTERS", "auto")
+    monkeypatch.setattr(db_wrapper, "MEMBERSHIP_FILTERS", "auto")
+    database = db.get_database("horses")
+    database["users"].insert_one({"publicAddress": "0xa"})
+    database["horses"].insert_one({"horseId": 1})
+
+    # without a feed, the inserts of other workers would be missed
+    assert db.ensure_membership() is None
+    assert db.user_exists("0xb") is False
+    assert not any(f.ready for f in filters.values())
+    assert user_filter.as_dict()["checks"] == 0
+
+    feed = ChangeFeed()
+    inserted = {
+        "_id": "t1",
+        "operationType": "insert",
+        "ns": {"db": "horses", "coll": "users"},
+        "documentKey": {"_id": "u2"},
+        "fullDocument": {"publicAddress": "0xc"},
+    }
+    feed.watch(Database(feed, database, [inserted]))
+
+    assert all(f.ready for f in filters.values())
+    assert user_filter.excludes("0xb")
+    assert not user_filter.excludes("0xa")
+    assert not horse_filter.excludes(1)
+    # inserted by another worker once the stream was open
+    assert not user_filter.excludes("0xc")
+
+
+def test_filters_are_built_on_startup_when_on(db, monkeypatch):
+    monkeypatch.setattr(db_wrapper, "MEMBERSHIP_FILTERS", "on")
+    database = db.get_database("horses")
+    database["users"].insert_many([{"publicAddress": "0xa"}, {"name": "no key"}])
+    database["horses"].insert_one({"horseId": 1.0})
+
+    assert db.ensure_membership() == {"users": 2, "horses": 1}
+    assert not horse_filter.excludes(1)
+    assert horse_filter.excludes(2)
+    assert user_filter.as_dict()["members"] == 1
+
+
+def test_filters_are_built_from_a_ready_database():
+    database = mongomock.MongoClient()["horses"]
+    database["horses"].insert_many([{"horseId": i} for i in range(5)])
+    f = MembershipFilter("horses", "horseId", capacity=100, error_rate=0.01)
+
+    assert run(f.build(ReadyDatabase(database))) == 5
+    assert f.ready
+    assert not any(f.excludes(i) for i in range(5))
@@ -0,0 +1,172 @@
+import pytest
+from bson.objectid import ObjectId
+
+from pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    InvalidCursor,
+    decode_cursor,
+    decode_sorted_cursor,
+    encode_cursor,
+    page_detail,
+    page_filter,
+    page_limit,
+    sorted_page_filter,
+)
+
+pytest.importorskip("mongomock")
+
+
+def test_cursor_round_trip():
+    _id = ObjectId()
+
+    assert decode_cursor(encode_cursor({"_id": _id})) == _id
+    assert decode_sorted_cursor(encode_cursor({"_id": _id, "price": 2.5}, "price")) == (
+        _id,
+        2.5,
+    )
+    # missing sort values are kept as such
+    assert decode_sorted_cursor(encode_cursor({"_id": _id}, "price")) == (_id, None)
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        "bm90IGpzb24",  # "not json"
+        "eyJ2YWx1ZSI6IDF9",  # no id
+        "eyJpZCI6ICJ4In0",  # an id that is no ObjectId
+        "WzFd",  # a list
+    ],
+)
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+    with pytest.raises(InvalidCursor):
+        page_filter(cursor)
+
+
+@pytest.mark.parametrize(
+    "limit, clamped",
+    [
+        (None, DEFAULT_PAGE_SIZE),
+        (0, 1),
+        (-5, 1),
+        (1, 1),
+        (50, 50),
+        (MAX_PAGE_SIZE, MAX_PAGE_SIZE),
+        (MAX_PAGE_SIZE + 1, MAX_PAGE_SIZE),
+        ("7", 7),
+    ],
+)
+def test_page_limit_is_clamped(limit, clamped):
+    assert page_limit(limit) == clamped
+
+
+def test_page_filter_ignores_unset_filters():
+    _id = ObjectId()
+
+    assert page_filter(None, {"status": None, "userType": "buyer"}) == {
+        "userType": "buyer"
+    }
+    assert page_filter(encode_cursor({"_id": _id}), {"status": 3}) == {
+        "status": 3,
+        "_id": {"$gt": _id},
+    }
+
+
+def test_sorted_page_filter_starts_after_the_cursor():
+    _id = ObjectId()
+    cursor = encode_cursor({"_id": _id, "price": 4}, "price")
+
+    assert sorted_page_filter(cursor, {}, "price", descending=True) == {
+        "price": {"$type": "number"},
+        "$or": [{"price": {"$lt": 4}}, {"price": 4, "_id": {"$lt": _id}}],
+    }
+
+
+def test_last_page_has_no_cursor():
+    documents = [{"_id": ObjectId()} for _ in range(3)]
+
+    assert page_detail(documents, 3)["nextCursor"] is None
+    page = page_detail(documents, 2)
+    assert page["items"] == documents[:2]
+    assert decode_cursor(page["nextCursor"]) == documents[1]["_id"]
+
+
+def pages(app_client, path: str, **params) -> list:
+    """
+    :return: the pages of a route, followed from cursor to cursor
+    """
+    seen, cursor = [], None
+    while True:
+        query = {**params, **({"cursor": cursor} if cursor else {})}
+        detail = app_client.get(path, params=query).json()["detail"]
+        seen.append(detail["items"])
+        cursor = detail["nextCursor"]
+        if cursor is None:
+            return seen
+
+
+def test_horse_pages_filter_on_status(app_client, mongo_client):
+    mongo_client["horses"]["horses"].insert_many(
+        [{"horseId": i, "status": 3 if i % 2 else 2} for i in range(7)]
+    )
+
+    on_sale = pages(app_client, "/get_horses/", limit=2, status=3)
+    every = pages(app_client, "/get_horses/", limit=3)
+
+    assert [[h["horseId"] for h in page] for page in on_sale] == [[1, 3], [5]]
+    assert [len(page) for page in every] == [3, 3, 1]
+    assert sorted(h["horseId"] for page in every for h in page) == list(range(7))
+
+
+def test_user_pages_filter_on_user_type(app_client, mongo_client):
+    mongo_client["horses"]["users"].insert_many(
+        [
+            {"publicAddress": f"0x{i}", "userType": "seller" if i < 3 else "buyer"}
+            for i in range(5)
+        ]
+    )
+
+    sellers = pages(app_client, "/get_users/", userType="seller", limit=2)
+    # a filter alone asks for the first page too
+    buyers = app_client.get("/get_users/", params={"userType": "buyer"}).json()
+
+    assert [[u["publicAddress"] for u in page] for page in sellers] == [
+        ["0x0", "0x1"],
+        ["0x2"],
+    ]
+    assert [u["publicAddress"] for u in buyers["detail"]["items"]] == ["0x3", "0x4"]
+
+
+def test_seller_pages_list_every_seller_once(app_client, mongo_client):
+    mongo_client["horses"]["sellers"].insert_many(
+        [{"publicAddress": f"0x{i}"} for i in range(5)]
+    )
+
+    seen = pages(app_client, "/get_sellers/", limit=2)
+
+    assert [len(page) for page in seen] == [2, 2, 1]
+    assert [s["publicAddress"] for page in seen for s in page] == [
+        f"0x{i}" for i in range(5)
+    ]
+
+
+@pytest.mark.parametrize("path", ["/get_horses/", "/get_users/", "/get_sellers/"])
+def test_invalid_cursor_is_refused(app_client, path):
+    response = app_client.get(path, params={"cursor": "not-a-cursor"}).json()
+
+    assert response["status_code"] == 400
+    assert "Invalid cursor" in response["detail"]["message"]
+
+
+def test_oversized_page_is_clamped(app_client, mongo_client):
+    mongo_client["horses"]["sellers"].insert_many(
+        [{"publicAddress": f"0x{i}"} for i in range(MAX_PAGE_SIZE + 1)]
+    )
+
+    detail = app_client.get("/get_sellers/", params={"limit": 1000}).json()["detail"]
+
+    assert len(detail["items"]) == MAX_PAGE_SIZE
+    assert detail["nextCursor"] is not None
@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+pytest.importorskip("mongomock")
+
+from auth import token_verifier  # noqa: E402
+from db_wrapper import DbWrapper  # noqa: E402
+
+OWNER = "0xowner"
+BIDDER = "0xbidder"
+
+
+@pytest.fixture
+def round_trips(db, monkeypatch):
+    """
+    :return: the repositories of each call, to read their round trips
+    """
+    created = []
+    repositories = DbWrapper.repositories
+
+    def recorded(self, *args, **kwargs):
+        created.append(repositories(self, *args, **kwargs))
+        return created[-1]
+
+    # AsyncDbWrapper creates its repositories with DbWrapper's method too
+    monkeypatch.setattr(DbWrapper, "repositories", recorded)
+
+    def count() -> int:
+        total = sum(r.round_trips for r in created)
+        created.clear()
+        return total
+
+    return count
+
+
+@pytest.fixture
+def database(db):
+    database = db.get_database("horses")
+    database["users"].insert_many(
+        [
+            {
+                "publicAddress": OWNER,
+                "nonce": 0,
+                "myHorses": [{"horseId": 1, "status": 2}],
+                "myBids": [],
+            },
+            {"publicAddress": BIDDER, "nonce": 0, "myHorses": [], "myBids": []},
+        ]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 1,
+            "publicAddress": OWNER,
+            "status": 4,
+            "saleInfo": [],
+            "auctionInfo": [
+                {
+                    "status": "active",
+                    "highestBid": "0",
+                    "highestBidder": "",
+                    "deadline": int(time.time()) + 3600,
+                    "bidHistory": [],
+                }
+            ],
+        }
+    )
+    return database
+
+
+def token(address: str) -> str:
+    return token_verifier.issue({"publicAddress": address, "exp": time.time() + 3600})
+
+
+def test_get_user_reads_once_then_from_cache(db, database, round_trips):
+    assert db.get_user({"publicAddress": OWNER}).status_code == 200
+    assert round_trips() == 1
+
+    assert db.get_user({"publicAddress": OWNER}).status_code == 200
+    assert round_trips() == 0
+
+
+def test_get_horse_reads_only_the_version_when_unchanged(db, database, round_trips):
+    etag = db.get_horse(1).headers["ETag"]
+    assert round_trips() == 1
+
+    assert db.get_horse(1, if_none_match=etag).status_code == 304
+    assert round_trips() == 0
+
+
+def test_put_on_sale_reads_user_and_horse_once(db, database, round_trips):
+    response = db.put_on_sale(1, OWNER, {"onMarket": 10}, token(OWNER))
+
+    assert response.status_code == 200
+    assert round_trips() == 2
+
+
+def test_place_a_bid_checks_the_bidder_and_reads_the_horse(db, database, round_trips):
+    response = db.place_a_bid(1, BIDDER, {"bidAmount": "10"})
+
+    assert response.status_code == 200
+    assert round_trips() == 2
+
+
+def test_user_check_reads_once(db, database, round_trips):
+    assert db.user_check(OWNER, cached=False).status_code == 200
+    assert round_trips() == 1
@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip("mongomock")
+
+
+def test_route_template_of_known_and_unknown_paths():
+    from main import route_template
+    from metrics import UNMATCHED_ROUTE
+
+    def scope(path: str, method: str = "GET") -> dict:
+        return {"type": "http", "path": path, "method": method}
+
+    assert route_template(scope("/get_horses/")) == "/get_horses/"
+    # a known path with the wrong method still belongs to its route
+    assert route_template(scope("/get_horses/", "DELETE")) == "/get_horses/"
+    assert route_template(scope("/wp-login.php")) == UNMATCHED_ROUTE
+
+
+def test_unknown_paths_share_one_metrics_bucket(app_client):
+    from metrics import UNMATCHED_ROUTE
+    from query_metrics import command_metrics
+
+    for path in ("/scan/1", "/scan/2", "/scan/3"):
+        assert app_client.get(path).status_code == 404
+
+    routes = command_metrics.as_dict()["routes"]
+    assert not any(route.startswith("/scan/") for route in routes)
+    assert routes[UNMATCHED_ROUTE]["requests"] >= 3
+
+
+def test_failures_answered_with_a_200_are_counted(app_client):
+    from metrics import registry
+
+    def errors() -> float:
+        labels = {"route": "/get_horse/"}
+        return registry.get_sample_value("http_request_errors_total", labels) or 0
+
+    before = errors()
+
+    # no horseId: the route catches the KeyError and returns it
+    failed = app_client.post("/get_horse/", json={})
+    missing = app_client.post("/get_horse/", json={"horseId": 1})
+
+    assert failed.status_code == 200
+    assert missing.json()["status_code"] == 404
+    assert errors() == before + 1
+
+
+def test_failed_results():
+    from fastapi.exceptions import HTTPException
+
+    from json_responses import failed
+
+    assert failed(KeyError("horseId"))
+    assert failed(HTTPException(status_code=503, detail="unavailable"))
+    assert not failed(HTTPException(status_code=404, detail="missing"))
+    assert not failed({"horse": 1})
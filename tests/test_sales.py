@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+pytest.importorskip("mongomock")
+
+from auth import token_verifier  # noqa: E402
+
+OWNER = "0xowner"
+
+
+def token(address: str) -> str:
+    return token_verifier.issue({"publicAddress": address, "exp": time.time() + 3600})
+
+
+@pytest.fixture
+def database(db):
+    database = db.get_database("horses")
+    database["users"].insert_one(
+        {"publicAddress": OWNER, "nonce": 0, "myHorses": [{"horseId": 1, "status": 2}]}
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 1,
+            "publicAddress": OWNER,
+            "status": 2,
+            "saleInfo": [],
+            "auctionInfo": [],
+        }
+    )
+    return database
+
+
+def set_listing(database, status: int):
+    database["users"].update_one(
+        {"publicAddress": OWNER}, {"$set": {"myHorses.0.status": status}}
+    )
+
+
+def test_put_on_sale_lists_the_horse(db, database):
+    response = db.put_on_sale(1, OWNER, {"onMarket": 10}, token(OWNER))
+
+    assert response.status_code == 200
+    user = database["users"].find_one({"publicAddress": OWNER})
+    assert user["myHorses"][0]["status"] == 3
+    assert user["nonce"] == 1
+    horse = database["horses"].find_one({"horseId": 1})
+    assert horse["saleInfo"] == [{"onMarket": 10, "saleId": 0}]
+
+
+@pytest.mark.parametrize(
+    "status, message", [(3, "Horse already on sale"), (4, "Horse already on auction")]
+)
+def test_put_on_sale_is_refused_before_writing(db, database, status, message):
+    set_listing(database, status)
+
+    response = db.put_on_sale(1, OWNER, {"onMarket": 10}, token(OWNER))
+
+    assert response.status_code == 401
+    assert response.detail["message"] == message
+    assert database["users"].find_one({"publicAddress": OWNER})["nonce"] == 0
+    assert database["horses"].find_one({"horseId": 1})["saleInfo"] == []
+
+
+def test_put_on_auction_is_versioned(db, database):
+    response = db.put_on_auction(1, OWNER, {"status": "active"})
+
+    assert response.status_code == 200
+    horse = database["horses"].find_one({"horseId": 1})
+    assert horse["auctionInfo"] == [{"status": "active"}]
+    assert horse["version"] == 1
+
+
+@pytest.mark.parametrize(
+    "status, message", [(3, "Horse already on sale"), (4, "Horse already on auction")]
+)
+def test_put_on_auction_is_refused_before_writing(db, database, status, message):
+    set_listing(database, status)
+
+    response = db.put_on_auction(1, OWNER, {"status": "active"})
+
+    assert response.status_code == 401
+    assert response.detail["message"] == message
+    assert database["horses"].find_one({"horseId": 1})["auctionInfo"] == []
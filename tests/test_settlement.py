@@ -0,0 +1,170 @@
+import pytest
+
+from settlement import SettlementError, benchmark, settle
+from sync_driver import ReadyCollection, ReadyDatabase, run
+
+mongomock = pytest.importorskip("mongomock")
+
+SELLER = "0xseller"
+BIDDER = "0xbidder"
+
+
+class Session:
+    """
+    A Motor session running each transaction's callback once.
+    """
+
+    def __init__(self):
+        self.transactions = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def with_transaction(self, callback):
+        self.transactions += 1
+        return await callback(self)
+
+
+class Client:
+    def __init__(self):
+        self.sessions = []
+
+    async def start_session(self):
+        session = Session()
+        self.sessions.append(session)
+        return session
+
+
+class RecordedCollection(ReadyCollection):
+    """
+    Records the session of every call, which mongomock refuses.
+    """
+
+    def __init__(self, delegate, calls: list):
+        super().__init__(delegate)
+        self.calls = calls
+
+    def __getattr__(self, name: str):
+        method = super().__getattr__(name)
+
+        async def call(*args, session=None, **kwargs):
+            self.calls.append((name, session))
+            return await method(*args, **kwargs)
+
+        return call
+
+    def find(self, *args, session=None, **kwargs):
+        self.calls.append(("find", session))
+        return super().find(*args, **kwargs)
+
+
+class RecordedDatabase(ReadyDatabase):
+    def __init__(self, delegate):
+        super().__init__(delegate)
+        self.calls = []
+
+    def __getitem__(self, name: str):
+        return RecordedCollection(self.delegate[name], self.calls)
+
+
+@pytest.fixture
+def auctioned():
+    database = mongomock.MongoClient()["settlement_test"]
+    database["users"].insert_many(
+        [
+            {
+                "publicAddress": SELLER,
+                "myHorses": [{"horseId": 1, "status": 4}],
+                "soldHorses": [],
+                "myBids": [],
+            },
+            {
+                "publicAddress": BIDDER,
+                "myHorses": [],
+                "soldHorses": [],
+                "myBids": [
+                    {
+                        "horseId": 1,
+                        "auctionId": 0,
+                        "isClaimed": False,
+                        "status": "Active",
+                    }
+                ],
+            },
+        ]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 1,
+            "shareHolders": [{"publicAddress": SELLER, "percentage": 100}],
+            "saleInfo": [],
+            "saleHistory": [],
+            "auctionInfo": [{"status": "active", "highestBidder": BIDDER}],
+        }
+    )
+    return database
+
+
+def test_auction_settles_in_one_transaction(auctioned):
+    client, database = Client(), RecordedDatabase(auctioned)
+
+    run(settle(client, database, 1, BIDDER, SELLER, "50", 100, None, auction_id=0))
+
+    [session] = client.sessions
+    assert session.transactions == 1
+    assert database.calls == [
+        ("find_one", session),
+        ("find", session),
+        ("bulk_write", session),
+        ("bulk_write", session),
+    ]
+    horse = auctioned["horses"].find_one({"horseId": 1})
+    assert horse["shareHolders"] == [{"publicAddress": BIDDER, "percentage": 100}]
+    assert horse["auctionInfo"][0]["status"] == "Ended"
+    bidder = auctioned["users"].find_one({"publicAddress": BIDDER})
+    assert bidder["myHorses"] == [{"horseId": 1, "status": 2}]
+    assert bidder["myBids"][0]["isClaimed"] is True
+    assert bidder["myBids"][0]["status"] == "Accepted"
+    seller = auctioned["users"].find_one({"publicAddress": SELLER})
+    assert seller["myHorses"] == []
+    assert seller["soldHorses"] == [{"horseId": 1}]
+
+
+def test_ended_auction_is_not_settled_again(auctioned):
+    client, database = Client(), RecordedDatabase(auctioned)
+    auctioned["horses"].update_one(
+        {"horseId": 1}, {"$set": {"auctionInfo.0.status": "Ended"}}
+    )
+
+    with pytest.raises(SettlementError) as error:
+        run(settle(client, database, 1, BIDDER, SELLER, "50", 100, None, auction_id=0))
+
+    assert error.value.status_code == 401
+    assert [name for name, _ in database.calls] == ["find_one", "find"]
+
+
+class Standalone:
+    """
+    Stands in for the DbWrapper the benchmark is given.
+    """
+
+    def __init__(self):
+        self.client = mongomock.MongoClient()
+
+    def get_database(self, db_name: str):
+        return self.client[db_name]
+
+    def supports_transactions(self) -> bool:
+        return False
+
+
+def test_benchmark_neither_loses_nor_duplicates_shares():
+    result = benchmark(Standalone(), buyers=4, purchases=40)
+
+    assert result["purchases"] + result["failures"] == 40
+    assert result["shares_total"] == 40
+    assert result["sale_history"] == result["purchases"]
+    assert result["purchases_per_second"] > 0
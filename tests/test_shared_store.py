@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("redis")
+
+import auth  # noqa: E402
+import db_wrapper  # noqa: E402
+from auth import TokenRevoked, TokenVerifier  # noqa: E402
+from document_cache import TOMBSTONE, SharedDocumentCache  # noqa: E402
+from fake_redis import FakeRedisServer  # noqa: E402
+from shared_store import SharedStore, store_check  # noqa: E402
+from sync_driver import run  # noqa: E402
+
+
+@pytest.fixture
+def store():
+    with FakeRedisServer() as server:
+        yield SharedStore(server.url, prefix="test:")
+
+
+def test_values_expire_and_are_set_where_missing(store):
+    assert store.set("a", b"1", 60000)
+    assert not store.set("a", b"2", 60000, missing_only=True)
+    assert store.get("a") == b"1"
+    assert store.set_many([("a", b"3"), ("b", b"4")], 60000, missing_only=True) == [
+        False,
+        True,
+    ]
+    assert store.get("b") == b"4"
+
+    store.set("short", b"5", 1)
+    time.sleep(0.01)
+    assert store.get("short") is None
+
+
+def test_hits_are_counted_per_window(store):
+    assert [store.hit("ip", 50) for _ in range(3)] == [1, 2, 3]
+    time.sleep(0.06)
+    assert store.hit("ip", 50) == 1
+
+
+def test_delete_matching_keeps_other_keys(store):
+    store.set_many([("cache:1", b"x"), ("cache:2", b"y"), ("other", b"z")], 60000)
+
+    assert store.delete_matching("cache:*") == 2
+    assert store.get("cache:1") is None
+    assert store.get("other") == b"z"
+
+
+def test_async_calls_run_on_the_loop_or_driven(store):
+    async def calls():
+        await store.set_async("a", b"1", 60000)
+        await store.set_many_async([("b", b"2")], 60000)
+        return (
+            await store.get_async("a"),
+            await store.get_async("b"),
+            await store.hit_async("ip", 60000),
+            await store.delete_matching_async("*"),
+        )
+
+    assert asyncio.run(calls()) == (b"1", b"2", 1, 3)
+    # driven synchronously, the calls go through the sync pool
+    assert run(calls()) == (b"1", b"2", 1, 3)
+
+
+def test_unreachable_store_behaves_as_empty():
+    with FakeRedisServer() as server:
+        url = server.url
+    store = SharedStore(url)
+
+    assert store.get("a") is None
+    assert not store.set("a", b"1", 60000)
+    assert store.set_many([("a", b"1")], 60000) == [False]
+    assert store.hit("ip", 60000) == 0
+    assert store.as_dict()["errors"] == 4
+
+
+def test_tombstone_keeps_a_stale_read_out(store):
+    cache = SharedDocumentCache("horses", store)
+    cache.put(1, {"_id": "h1", "horseId": 1, "name": "old"}, cache.ticket())
+    assert cache.get(1)["name"] == "old"
+
+    cache.forget(1)
+    assert store.get(cache.key(1)) == TOMBSTONE
+    assert cache.get(1) is None
+    # a read made before the write cannot cache what it read
+    cache.put(1, {"_id": "h1", "horseId": 1, "name": "old"}, cache.ticket())
+    assert cache.get(1) is None
+
+    store.delete_matching(cache.key(1))
+    cache.put(1, {"_id": "h1", "horseId": 1, "name": "new"}, cache.ticket())
+    assert cache.get(1)["name"] == "new"
+
+
+def test_forget_id_and_clear(store):
+    cache = SharedDocumentCache("horses", store)
+    cache.put(1, {"_id": "h1", "horseId": 1}, cache.ticket())
+    cache.put(2, {"_id": "h2", "horseId": 2}, cache.ticket())
+
+    cache.forget_id("h1")
+    assert cache.get(1) is None
+    assert cache.get(2) is not None
+
+    cache.clear()
+    assert cache.get(2) is None
+    assert cache.as_dict()["invalidations"] == 2
+
+
+def test_revocation_is_shared_by_every_worker(store, monkeypatch):
+    monkeypatch.setattr(auth, "shared_store", store)
+    revoking, other = TokenVerifier("users", "s"), TokenVerifier("users", "s")
+    token = revoking.issue({"publicAddress": "0xa", "exp": time.time() + 3600})
+    other.verify(token)
+
+    revoking.revoke(token)
+
+    with pytest.raises(TokenRevoked):
+        other.verify(token)
+    # remembered, so refused without the store
+    monkeypatch.setattr(auth, "shared_store", None)
+    with pytest.raises(TokenRevoked):
+        other.verify(token)
+
+
+def test_rate_limit_is_counted_in_the_store(db, store, monkeypatch):
+    monkeypatch.setattr(db_wrapper, "shared_store", store)
+    limit = 3
+    # the AsyncDbWrapper behind the motor runs
+    getattr(db, "wrapper", db).ip_rate_limit_count = limit
+
+    statuses = [db.ip_rate_limit("10.0.0.1").status_code for _ in range(limit + 1)]
+
+    assert statuses == [200] * limit + [429]
+    assert db.ip_rate_limit("10.0.0.2").status_code == 200
+    assert store.get("ip:10.0.0.1") == str(limit + 1).encode()
+
+
+def test_store_check_times_the_store_against_mongodb(store):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient()["store_check"]["documents"]
+
+    result = store_check(store, 50, collection)
+
+    assert result["consistent"]
+    assert result["deleted"] == 51
+    assert result["mongo_ms"] > 0
+    assert collection.count_documents({}) == 0
@@ -0,0 +1,177 @@
+import time
+
+import pytest
+
+pytest.importorskip("mongomock")
+
+import db_wrapper  # noqa: E402
+import versioning  # noqa: E402
+from auth import token_verifier  # noqa: E402
+from sync_driver import ReadyDatabase, run  # noqa: E402
+from versioning import VERSION_RETRIES, VersionConflict, update_versioned  # noqa: E402
+
+OWNER = "0xowner"
+BUYER = "0xbuyer"
+
+
+def token(address: str) -> str:
+    return token_verifier.issue({"publicAddress": address, "exp": time.time() + 3600})
+
+
+@pytest.fixture
+def pauses(monkeypatch):
+    """
+    :return: the backoffs update_versioned waited, in seconds
+    """
+    waited = []
+
+    async def pause(seconds: float):
+        waited.append(seconds)
+
+    monkeypatch.setattr(versioning, "pause", pause)
+    versioning.contention.operations.clear()
+
+    return waited
+
+
+def concurrent_write(database, collection: str, query: dict, times: int = 1):
+    """
+    :return: a plan wrapper writing the document as another request would,
+    between the read and the write of the first `times` attempts
+    """
+
+    def interleaved(plan):
+        calls = [0]
+
+        def wrapper(*args, **kwargs):
+            calls[0] += 1
+            if calls[0] <= times:
+                database[collection].update_one(query, {"$inc": {"version": 1}})
+            return plan(*args, **kwargs)
+
+        return wrapper
+
+    return interleaved
+
+
+@pytest.fixture
+def database(db):
+    database = db.get_database("horses")
+    database["users"].insert_many(
+        [
+            {"publicAddress": OWNER, "nonce": 0, "myHorses": [1], "myBids": []},
+            {"publicAddress": BUYER, "nonce": 0, "myHorses": [], "myBids": []},
+        ]
+    )
+    database["horses"].insert_one(
+        {
+            "horseId": 1,
+            "publicAddress": OWNER,
+            "status": 4,
+            "saleInfo": [],
+            "saleHistory": [],
+            "offerHistory": [],
+            "auctionInfo": [{"status": "Active"}],
+        }
+    )
+    return database
+
+
+def test_conflict_is_retried_after_a_backoff(pauses):
+    mongomock = pytest.importorskip("mongomock")
+    database = mongomock.MongoClient()["versioning_test"]
+    database["users"].insert_one({"publicAddress": OWNER, "myHorses": [], "version": 3})
+    interleaved = concurrent_write(database, "users", {"publicAddress": OWNER})
+
+    run(
+        update_versioned(
+            ReadyDatabase(database)["users"],
+            {"publicAddress": OWNER},
+            interleaved(lambda user: {"$push": {"myHorses": 1}}),
+            "test",
+        )
+    )
+
+    user = database["users"].find_one({"publicAddress": OWNER})
+    assert user["myHorses"] == [1]
+    # bumped by the other writer, then by the retried write
+    assert user["version"] == 5
+    assert len(pauses) == 1
+    assert versioning.contention.as_dict()["test"]["conflicts"] == 1
+
+
+def test_conflicts_past_the_retries_are_refused(pauses):
+    mongomock = pytest.importorskip("mongomock")
+    database = mongomock.MongoClient()["versioning_test"]
+    database["users"].insert_one({"publicAddress": OWNER, "myHorses": []})
+    interleaved = concurrent_write(
+        database, "users", {"publicAddress": OWNER}, VERSION_RETRIES
+    )
+
+    with pytest.raises(VersionConflict):
+        run(
+            update_versioned(
+                ReadyDatabase(database)["users"],
+                {"publicAddress": OWNER},
+                interleaved(lambda user: {"$push": {"myHorses": 1}}),
+                "test",
+            )
+        )
+
+    assert database["users"].find_one({"publicAddress": OWNER})["myHorses"] == []
+    assert len(pauses) == VERSION_RETRIES
+    assert versioning.contention.as_dict()["test"]["exhausted"] == 1
+
+
+def test_accept_a_bid_retries_the_buyer_write(db, database, pauses, monkeypatch):
+    interleaved = concurrent_write(database, "users", {"publicAddress": BUYER})
+    monkeypatch.setattr(
+        db_wrapper, "plan_add_my_horse", interleaved(db_wrapper.plan_add_my_horse)
+    )
+
+    response = db.accept_a_bid(1, OWNER, BUYER, 100)
+
+    assert response.status_code == 200
+    assert database["users"].find_one({"publicAddress": OWNER})["myHorses"] == []
+    assert database["users"].find_one({"publicAddress": BUYER})["myHorses"] == [1]
+    assert len(pauses) == 1
+
+
+def test_allow_horse_refuses_a_user_that_keeps_changing(
+    db, database, pauses, monkeypatch
+):
+    interleaved = concurrent_write(
+        database, "users", {"publicAddress": BUYER}, VERSION_RETRIES
+    )
+    monkeypatch.setattr(
+        db_wrapper, "plan_add_my_horse", interleaved(db_wrapper.plan_add_my_horse)
+    )
+
+    response = db.allow_horse({"publicAddress": BUYER, "horseId": 1})
+
+    assert response.status_code == 409
+    assert database["users"].find_one({"publicAddress": BUYER})["myHorses"] == []
+    assert len(pauses) == VERSION_RETRIES
+
+
+def test_make_offer_checks_the_status_it_writes(db, database, pauses, monkeypatch):
+    database["horses"].update_one({"horseId": 1}, {"$set": {"status": 2}})
+    plan_offer = db_wrapper.plan_offer
+    calls = [0]
+
+    def put_on_sale_meanwhile(horse, *args):
+        calls[0] += 1
+        if calls[0] == 1:
+            database["horses"].update_one(
+                {"horseId": 1}, {"$set": {"status": 3}, "$inc": {"version": 1}}
+            )
+        return plan_offer(horse, *args)
+
+    monkeypatch.setattr(db_wrapper, "plan_offer", put_on_sale_meanwhile)
+
+    response = db.make_offer(1, BUYER, {"amount": 10})
+
+    assert response.status_code == 401
+    assert response.detail["message"] == "The horse is not eligible for an offer"
+    assert database["horses"].find_one({"horseId": 1})["offerHistory"] == []
+    assert len(pauses) == 1
@@ -0,0 +1,241 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from db_wrapper import DbWrapper
+from request_context import current_route
+
+logger = logging.getLogger(__name__)
+
+
+class RouteStats:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.queued = 0
+        self.running = 0
+        self.calls = 0
+        self.errors = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.run_time_total = 0.0
+
+    def as_dict(self):
+        return {
+            "limit": self.limit,
+            "queued": self.queued,
+            "running": self.running,
+            "calls": self.calls,
+            "errors": self.errors,
+            "wait_time_avg_ms": self.wait_time_total / self.calls * 1000
+            if self.calls
+            else 0.0,
+            "wait_time_max_ms": self.wait_time_max * 1000,
+            "run_time_avg_ms": self.run_time_total / self.calls * 1000
+            if self.calls
+            else 0.0,
+        }
+
+
+class DbExecutor:
+    """
+    Runs blocking DbWrapper calls on a dedicated thread pool. Every route gets
+    its own concurrency cap so a burst on one endpoint cannot take all the
+    threads (and MongoClient connections) away from the others.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 32,
+        route_limits: dict = None,
+        default_route_limit: int = None,
+    ):
+        self.max_workers = max_workers
+        self.route_limits = route_limits or {}
+        self.default_route_limit = default_route_limit or max_workers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self.semaphores = {}
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        DB_THREADPOOL_SIZE: number of worker threads (keep it at or below the
+        MongoClient maxPoolSize)
+        DB_ROUTE_CONCURRENCY: per-route caps keyed by route path template, e.g.
+        "/get_horses/=4,/place_a_bid=16"
+        DB_ROUTE_CONCURRENCY_DEFAULT: cap for routes not listed above
+        """
+        max_workers = int(os.environ.get("DB_THREADPOOL_SIZE", 32))
+
+        route_limits = {}
+        for item in os.environ.get("DB_ROUTE_CONCURRENCY", "").split(","):
+            if "=" in item:
+                route, limit = item.rsplit("=", 1)
+                route_limits[route.strip()] = int(limit)
+
+        default_route_limit = os.environ.get("DB_ROUTE_CONCURRENCY_DEFAULT")
+
+        return cls(
+            max_workers=max_workers,
+            route_limits=route_limits,
+            default_route_limit=int(default_route_limit)
+            if default_route_limit
+            else None,
+        )
+
+    def get_route(self, route: str):
+        if route not in self.routes:
+            limit = min(
+                self.route_limits.get(route, self.default_route_limit),
+                self.max_workers,
+            )
+            self.semaphores[route] = asyncio.Semaphore(limit)
+            self.routes[route] = RouteStats(limit)
+
+        return self.semaphores[route], self.routes[route]
+
+    async def run(self, func, *args, **kwargs):
+        """
+        :param func: the blocking callable to run on the pool
+        :return: whatever func returns
+        """
+        route = current_route.get() or func.__name__
+        semaphore, stats = self.get_route(route)
+        queued_at = time.monotonic()
+
+        # flipped by whichever side takes the call off the queue first: the
+        # worker thread when it starts, or this coroutine if it is cancelled
+        ticket = {"dequeued": False}
+
+        with self.lock:
+            stats.queued += 1
+
+        try:
+            async with semaphore:
+                # copy the context so the route and request ids follow the call
+                context = contextvars.copy_context()
+                call = partial(context.run, self.call, stats, ticket, queued_at)
+
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.pool, partial(call, func, *args, **kwargs)
+                )
+
+        finally:
+            self.dequeue(stats, ticket)
+
+    def dequeue(self, stats: RouteStats, ticket: dict):
+        with self.lock:
+            if ticket["dequeued"]:
+                return
+            ticket["dequeued"] = True
+            stats.queued -= 1
+
+    def call(
+        self, stats: RouteStats, ticket: dict, queued_at: float, func, *args, **kwargs
+    ):
+        started_at = time.monotonic()
+        wait_time = started_at - queued_at
+
+        self.dequeue(stats, ticket)
+
+        with self.lock:
+            stats.running += 1
+            stats.wait_time_total += wait_time
+            stats.wait_time_max = max(stats.wait_time_max, wait_time)
+
+        try:
+            return func(*args, **kwargs)
+
+        except Exception:
+            with self.lock:
+                stats.errors += 1
+            raise
+
+        finally:
+            with self.lock:
+                stats.running -= 1
+                stats.calls += 1
+                stats.run_time_total += time.monotonic() - started_at
+
+    def get_stats(self):
+        """
+        :return: queue depth, wait time and run time per route
+        """
+        with self.lock:
+            routes = {route: stats.as_dict() for route, stats in self.routes.items()}
+
+        return {
+            "max_workers": self.max_workers,
+            "queued": sum(stats["queued"] for stats in routes.values()),
+            "running": sum(stats["running"] for stats in routes.values()),
+            "routes": routes,
+        }
+
+
+class ThreadPoolDbWrapper:
+    """
+    Awaitable facade over the synchronous DbWrapper: every method call is
+    executed on a DbExecutor instead of inline on the event loop. It exposes
+    the same surface as AsyncDbWrapper so main.py can use either.
+    """
+
+    # cheap helpers without I/O, called directly
+    inline_methods = {
+        "get_database",
+        "get_collection",
+        "verify",
+        "admin_verify",
+        "jwt_check_decorator",
+    }
+
+    def __init__(self, wrapper: DbWrapper = None, executor: DbExecutor = None):
+        self.wrapper = wrapper or DbWrapper()
+        self.executor = executor or DbExecutor.from_env()
+
+        logger.info(
+            "DbWrapper runs on a thread pool of %s workers.",
+            self.executor.max_workers,
+        )
+
+    def __getattr__(self, name: str):
+        if name == "wrapper":
+            raise AttributeError(name)
+
+        attr = getattr(self.wrapper, name)
+
+        if name in self.inline_methods or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.executor.run(attr, *args, **kwargs)
+
+        return method
+
+    def ip_rate_limit_decorator(self, func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            user_ip = kwargs["info"].client.host
+            response = await self.ip_rate_limit(user_ip)
+
+            if response.status_code == 200:
+                return await func(*args, **kwargs)
+            else:
+                return response.detail["message"]
+
+        return wrapper
+
+    def get_stats(self):
+        """
+        :return: runtime statistics of the wrapped DbWrapper and its thread pool
+        """
+        stats = self.wrapper.get_stats()
+        stats["executor"] = self.executor.get_stats()
+
+        return stats
@@ -0,0 +1,131 @@
+import random
+import threading
+
+from sync_driver import pause
+
+# attempts at a read-modify-write before giving up on a busy document
+VERSION_RETRIES = 5
+
+# full-jitter exponential backoff between attempts, in seconds
+BACKOFF_BASE = 0.005
+BACKOFF_MAX = 0.2
+
+
+class WriteRejected(Exception):
+    """
+    Raised by a plan when the document it is given no longer allows the write.
+    """
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class VersionConflict(WriteRejected):
+    def __init__(self, operation: str):
+        super().__init__(409, "The document kept changing, please try again")
+        self.operation = operation
+
+
+class ContentionStats:
+    """
+    Per operation counts of versioned writes and of the conflicts they hit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def record(self, operation: str, conflicts: int, exhausted: bool = False):
+        with self.lock:
+            stats = self.operations.setdefault(
+                operation,
+                {"writes": 0, "conflicts": 0, "exhausted": 0, "max_conflicts": 0},
+            )
+            stats["writes"] += 0 if exhausted else 1
+            stats["conflicts"] += conflicts
+            stats["exhausted"] += 1 if exhausted else 0
+            stats["max_conflicts"] = max(stats["max_conflicts"], conflicts)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                operation: dict(
+                    stats,
+                    conflict_rate=stats["conflicts"]
+                    / (stats["writes"] + stats["conflicts"]),
+                )
+                for operation, stats in self.operations.items()
+            }
+
+
+contention = ContentionStats()
+
+
+def version_filter(document: dict) -> dict:
+    """
+    :param document: a document as read
+    :return: the filter matching only that version of it (documents written
+    before versioning have no version field)
+    """
+    if "version" in document:
+        return {"version": document["version"]}
+
+    return {"version": {"$exists": False}}
+
+
+def bump(update: dict) -> dict:
+    """
+    :param update: an update document
+    :return: the update, also incrementing the version
+    """
+    update = dict(update)
+    update["$inc"] = dict(update.get("$inc", {}), version=1)
+
+    return update
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+async def update_versioned(
+    collection, query: dict, plan, operation: str, document: dict = None, **kwargs
+):
+    """
+    Reads the document, asks plan for the update and writes it only if the
+    document is still at the version that was read. On a conflict the
+    document is read again and planned again, after a backoff.
+
+    :param collection: the Motor collection, or a ready pymongo one
+    :param query: selects a single document
+    :param plan: takes the document, returns the update (None to skip) or
+    raises WriteRejected
+    :param operation: the name the contention is recorded under
+    :param document: the document if it was already read
+    :param kwargs: passed on to update_one, e.g. array_filters
+    :return: the document the update was planned from, None if not found
+    """
+    for attempt in range(VERSION_RETRIES):
+        if document is None:
+            document = await collection.find_one(query)
+            if document is None:
+                return None
+
+        update = plan(document)
+        if update is None:
+            return document
+
+        result = await collection.update_one(
+            dict(query, **version_filter(document)), bump(update), **kwargs
+        )
+        if result.matched_count:
+            contention.record(operation, attempt)
+            return document
+
+        document = None
+        await pause(backoff(attempt))
+
+    contention.record(operation, VERSION_RETRIES, exhausted=True)
+    raise VersionConflict(operation)